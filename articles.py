@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Index from the offers of a PriceMatrix back to the articles behind them.
+
+The matrix keeps one price per product and seller, but buying a basket needs
+the idArticle, and a seller can list the same product several times (another
+condition or language, or more copies). The index keeps every article that
+passed the search filters in parallel typed arrays, sorted by (prod_id,
+seller_id) and then price, with ptr pointing at the first article of every
+pair like the indptr of a PriceMatrix. Pairs are looked up by ids rather than
+row and column, so the index stays valid for the selected, regrouped and
+pruned matrices made from the same offers.
+"""
+
+import numpy as np
+
+# Best first, the same order as PyMkmApi.conditions
+CONDITIONS = ["MT", "NM", "EX", "GD", "LP", "PL", "PO"]
+CONDITION_CODES = {condition: code for code, condition in enumerate(CONDITIONS)}
+
+
+def condition_codes(conditions):
+    """int8 code per condition string, -1 for unknown ones."""
+    return np.fromiter(
+        (CONDITION_CODES.get(c, -1) for c in conditions), np.int8, len(conditions)
+    )
+
+
+class ArticleIndex:
+    def __init__(self, sellers, keys, ptr, article_ids, prices, counts, conditions, languages):
+        # Seller id table, and prod_id * len(sellers) + seller code per pair
+        self.sellers = np.asarray(sellers, dtype=np.int64)
+        self.keys = np.asarray(keys, dtype=np.int64)
+        self.ptr = np.asarray(ptr, dtype=np.int64)
+        self.article_ids = np.asarray(article_ids, dtype=np.int64)
+        self.prices = np.asarray(prices, dtype=np.float64)
+        self.counts = np.asarray(counts, dtype=np.int32)
+        self.conditions = np.asarray(conditions, dtype=np.int8)
+        self.languages = np.asarray(languages, dtype=np.int16)
+
+        # Copies up to every article, for the number available per pair
+        self._cum_counts = np.zeros(self.n_articles + 1, dtype=np.int64)
+        np.cumsum(self.counts, out=self._cum_counts[1:])
+
+    @classmethod
+    def from_articles(
+        cls, prod_ids, seller_ids, article_ids, prices, counts=None, conditions=None, languages=None
+    ):
+        """
+        Build from one entry per article, in any order. An article seen more
+        than once (a product in the list both directly and through a
+        metaproduct) is kept once.
+        """
+        prod_ids = np.asarray(prod_ids, dtype=np.int64)
+        seller_ids = np.asarray(seller_ids, dtype=np.int64)
+        article_ids = np.asarray(article_ids, dtype=np.int64)
+        prices = np.asarray(prices, dtype=np.float64)
+        n = len(prices)
+        counts = np.ones(n, dtype=np.int32) if counts is None else np.asarray(counts, dtype=np.int32)
+        conditions = np.full(n, -1, dtype=np.int8) if conditions is None else np.asarray(conditions)
+        languages = np.zeros(n, dtype=np.int16) if languages is None else np.asarray(languages)
+
+        sellers, codes = np.unique(seller_ids, return_inverse=True)
+        keys = prod_ids * max(len(sellers), 1) + codes
+
+        order = np.lexsort((article_ids, keys))
+        first = np.ones(n, dtype=bool)
+        first[1:] = (keys[order][1:] != keys[order][:-1]) | (
+            article_ids[order][1:] != article_ids[order][:-1]
+        )
+        # Cheapest first within a pair, the better condition on equal prices
+        order = order[first]
+        order = order[np.lexsort((conditions[order], prices[order], keys[order]))]
+
+        keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.zeros(0, int)
+        return cls(
+            sellers,
+            keys[starts],
+            np.r_[starts, len(keys)],
+            article_ids[order],
+            prices[order],
+            counts[order],
+            conditions[order],
+            languages[order],
+        )
+
+    @property
+    def n_pairs(self):
+        return len(self.keys)
+
+    @property
+    def n_articles(self):
+        return len(self.article_ids)
+
+    def find(self, prod_ids, seller_ids):
+        """Pair number of (prod_id, seller_id) pairs, -1 where there's no article."""
+        prod_ids = np.asarray(prod_ids, dtype=np.int64)
+        seller_ids = np.asarray(seller_ids, dtype=np.int64)
+        if self.n_pairs == 0:
+            return np.full(np.broadcast(prod_ids, seller_ids).shape, -1)
+        codes = np.minimum(np.searchsorted(self.sellers, seller_ids), len(self.sellers) - 1)
+        keys = prod_ids * len(self.sellers) + codes
+        pos = np.minimum(np.searchsorted(self.keys, keys), self.n_pairs - 1)
+        found = (self.sellers[codes] == seller_ids) & (self.keys[pos] == keys)
+        return np.where(found, pos, -1)
+
+    def best(self, prod_ids, seller_ids):
+        """Position of the cheapest article of every pair, -1 where there's none."""
+        pos = self.find(prod_ids, seller_ids)
+        return np.where(pos >= 0, self.ptr[np.maximum(pos, 0)], -1)
+
+    def available(self, prod_ids, seller_ids):
+        """Number of copies every seller has of the product, over all its articles."""
+        pos = self.find(prod_ids, seller_ids)
+        safe = np.maximum(pos, 0)
+        total = self._cum_counts[self.ptr[safe + 1]] - self._cum_counts[self.ptr[safe]]
+        return np.where(pos >= 0, total, 0)
+
+    def pick(self, prod_ids, seller_ids, quantities=1):
+        """
+        Articles to buy quantities copies of every pair, cheapest articles
+        first. Returns (entry, article position, amount) arrays, entry being
+        the index of the pair in the input; a pair without enough copies
+        gets what there is. A pair that is in the input more than once gets
+        the articles the earlier entries left.
+        """
+        pos = self.find(prod_ids, seller_ids)
+        quantities = np.broadcast_to(np.asarray(quantities, dtype=np.int64), pos.shape).ravel()
+        pos = pos.ravel()
+        entries = np.flatnonzero(pos >= 0)
+        pairs, wanted = pos[entries], np.maximum(quantities[entries], 0)
+
+        # Copies of a pair are numbered over its articles by _cum_counts, every
+        # entry takes the next ones after the earlier entries of the same pair
+        order = np.argsort(pairs, kind="stable")
+        before = np.cumsum(wanted[order]) - wanted[order]
+        group_start = np.r_[True, pairs[order][1:] != pairs[order][:-1]] if len(pairs) else np.zeros(0, bool)
+        offset = np.empty_like(before)
+        offset[order] = before - np.maximum.accumulate(np.where(group_start, before, 0))
+        first_copy = self._cum_counts[self.ptr[pairs]]
+        last_copy = self._cum_counts[self.ptr[pairs + 1]]
+        start = np.minimum(first_copy + offset, last_copy)
+        end = np.minimum(start + wanted, last_copy)
+
+        # Every article holding one of the copies in [start, end)
+        first = np.searchsorted(self._cum_counts, start, side="right") - 1
+        last = np.searchsorted(self._cum_counts, end, side="left") - 1
+        n_articles = np.where(end > start, last - first + 1, 0)
+        entry = np.repeat(np.arange(len(entries)), n_articles)
+        articles = np.repeat(first, n_articles) + np.arange(n_articles.sum()) - np.repeat(
+            np.cumsum(n_articles) - n_articles, n_articles
+        )
+        amounts = (
+            np.minimum(self._cum_counts[articles + 1], end[entry])
+            - np.maximum(self._cum_counts[articles], start[entry])
+        )
+        bought = amounts > 0
+        return entries[entry][bought], articles[bought], amounts[bought]
+
+    def cart_payload(self, prod_ids, seller_ids, quantities=1):
+        """Body of a PUT /shoppingcart that adds the picked articles."""
+        _, articles, amounts = self.pick(prod_ids, seller_ids, quantities)
+        return {
+            "action": "add",
+            "article": [
+                {"idArticle": int(article_id), "amount": int(amount)}
+                for article_id, amount in zip(self.article_ids[articles], amounts)
+            ],
+        }
+
+    def __repr__(self):
+        return f"ArticleIndex({self.n_articles} articles, {self.n_pairs} offers)"
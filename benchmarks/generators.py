@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Synthetic price matrices, modelled on the recorded ones in notebooks/.
+
+Those show a few things a uniform random matrix doesn't have:
+
+- Card prices are lognormal, most cards cost cents and a few cost euros.
+- Offers of the same card are spread around its price, not independent.
+- Seller sizes follow a power law, most sellers have one or two of the cards
+  and a handful have a large part of the wantlist.
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+from price_matrix import PriceMatrix
+
+NOTEBOOKS = Path(__file__).resolve().parent.parent / "notebooks"
+RECORDED = ("15x26", "25x33", "25x231")
+
+# Fitted on notebooks/25x231_price_mat.npy with profile(), seller_exponent is
+# the generator weight that reproduces its seller size slope of 0.82
+DEFAULT_PROFILE = {
+    "density": 0.12,
+    "log_price_mean": -0.74,
+    "log_price_sigma": 1.39,
+    "offer_spread": 0.65,
+    "seller_exponent": 0.9,
+}
+
+
+def recorded_price_matrix(name):
+    """One of the recorded dense matrices in notebooks/ as a PriceMatrix."""
+    return PriceMatrix.from_dense(np.load(NOTEBOOKS / f"{name}_price_mat.npy"))
+
+
+def profile(price_mat):
+    """Estimate the generator parameters of a dense price matrix (np.inf for no offer)."""
+    price_mat = np.asarray(price_mat, dtype=np.float64)
+    offered = np.isfinite(price_mat)
+    log_prices = np.where(offered, np.log(np.where(offered, price_mat, 1.0)), np.nan)
+    card_means = np.nanmedian(log_prices, axis=1)
+    seller_sizes = np.sort(offered.sum(axis=0))[::-1]
+    ranks = np.arange(1, len(seller_sizes) + 1)
+    used = seller_sizes > 0
+    slope = np.polyfit(np.log(ranks[used]), np.log(seller_sizes[used]), 1)[0]
+    return {
+        "density": float(offered.mean()),
+        "log_price_mean": float(np.mean(card_means)),
+        "log_price_sigma": float(np.std(card_means)),
+        "offer_spread": float(np.nanmean(np.nanstd(log_prices, axis=1))),
+        "seller_exponent": float(-slope),
+    }
+
+
+def synthetic_price_matrix(
+    n_cards, n_sellers, profile=None, metaproduct_fraction=0.0, printings=3, seed=0
+):
+    """
+    Random PriceMatrix with n_cards wants over n_sellers sellers. A
+    metaproduct_fraction of the wants are metaproducts with `printings` rows
+    each, so the matrix can have more rows than n_cards.
+    """
+    p = {**DEFAULT_PROFILE, **(profile or {})}
+    rng = np.random.default_rng(seed)
+
+    n_meta = int(round(n_cards * metaproduct_fraction))
+    rows_per_want = np.where(np.arange(n_cards) < n_meta, printings, 1)
+    n_rows = int(rows_per_want.sum())
+    want = np.repeat(np.arange(n_cards), rows_per_want)
+    metaprod_ids = np.where(want < n_meta, want + 1, np.nan).astype(np.float64)
+
+    weights = 1.0 / np.arange(1, n_sellers + 1) ** p["seller_exponent"]
+    weights = rng.permutation(weights / weights.sum())
+    n_offers = np.clip(rng.binomial(n_sellers, p["density"], size=n_rows), 2, n_sellers)
+
+    card_price = rng.normal(p["log_price_mean"], p["log_price_sigma"], size=n_cards)[want]
+    rows, sellers, prices = [], [], []
+    for row in range(n_rows):
+        chosen = rng.choice(n_sellers, size=n_offers[row], replace=False, p=weights)
+        rows.append(np.full(len(chosen), row))
+        sellers.append(chosen)
+        log_price = card_price[row] + rng.normal(0.0, p["offer_spread"], size=len(chosen))
+        prices.append(np.maximum(np.round(np.exp(log_price), 2), 0.02))
+
+    return PriceMatrix.from_offers(
+        np.concatenate(rows),
+        np.concatenate(sellers),
+        np.concatenate(prices),
+        np.arange(1, n_rows + 1) * 10,
+        metaprod_ids,
+    )
+
+
+def with_stock(price_mat, max_wanted=4, max_copies=3, seed=0):
+    """
+    price_mat with 1 to max_wanted copies wanted per card and a price ladder
+    per offer: 1 to max_copies copies at its price, plus a dearer tier for
+    about half of the offers.
+    """
+    rng = np.random.default_rng(seed)
+    pm = price_mat
+    dearer = rng.random(pm.n_offers) < 0.5
+    rows = np.r_[pm.rows, pm.rows[dearer]]
+    seller_ids = pm.seller_ids[np.r_[pm.sellers, pm.sellers[dearer]]]
+    prices = np.r_[pm.prices, np.round(pm.prices[dearer] * 1.5 + 0.1, 2)]
+    amounts = rng.integers(1, max_copies + 1, size=len(rows))
+    gidx = pm.group_index()
+    wanted = rng.integers(1, max_wanted + 1, size=gidx.max() + 1 if pm.n_rows else 0)[gidx]
+    return PriceMatrix.from_offers(rows, seller_ids, prices, pm.prod_ids, pm.metaprod_ids, wanted, amounts)
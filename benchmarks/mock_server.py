@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Local mock of the Cardmarket API, so the fetching code can be measured without
+spending request quota.
+
+Serves /account, /wantslist, /wantslist/:id, /metaproducts/:id and
+/articles/:id (with start/maxResults pagination, 206 and Content-Range) for a
+wantlist generated from a PriceMatrix. Latency, 429 responses and the request
+quota are configurable, and every request is counted per endpoint.
+
+The server runs in its own process by default, so it doesn't compete with the
+code being measured for the GIL. The counts are read back through /_mock/stats.
+"""
+
+import json
+import multiprocessing
+import random
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+API_PREFIX = "/ws/v2.0/output.json"
+COUNTRIES = ["NL", "DE", "FR", "BE", "IT", "ES", "AT"]
+CONDITIONS = ["MT", "NM", "EX", "GD", "LP", "PL", "PO"]
+# Same as the live API when no maxResults is given
+DEFAULT_PAGE_SIZE = 1000
+
+
+class MockCardmarket:
+    def __init__(
+        self,
+        price_mat,
+        latency=0.0,
+        jitter=0.0,
+        throttle_rate=0.0,
+        quota=100_000,
+        seed=0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.quota = quota
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.bytes_sent = 0
+        self.n_throttled = 0
+
+        self.wantlist, self.metaproducts, self.articles = self._build(price_mat, seed)
+        self._encoded = {}
+        self.server = None
+        self.thread = None
+        self.process = None
+        self.address = None
+
+    def _build(self, pm, seed):
+        rng = np.random.default_rng(seed)
+        seller_country = rng.choice(COUNTRIES, size=pm.n_sellers)
+
+        articles = {}
+        for row in range(pm.n_rows):
+            start, end = pm.indptr[row], pm.indptr[row + 1]
+            prod_id = int(pm.prod_ids[row])
+            order = np.argsort(pm.prices[start:end], kind="stable") + start
+            articles[prod_id] = [
+                {
+                    "idArticle": prod_id * 100_000 + int(i),
+                    "idProduct": prod_id,
+                    "language": {"idLanguage": 1, "languageName": "English"},
+                    "comments": "",
+                    "price": float(pm.prices[i]),
+                    "count": 1,
+                    "inShoppingCart": False,
+                    "condition": CONDITIONS[int(rng.integers(0, 3))],
+                    "isFoil": False,
+                    "isSigned": False,
+                    "isAltered": False,
+                    "isPlayset": False,
+                    "seller": {
+                        "idUser": int(pm.seller_ids[pm.sellers[i]]),
+                        "username": f"seller{int(pm.seller_ids[pm.sellers[i]])}",
+                        "isCommercial": 0,
+                        "reputation": 1,
+                        "shipsFast": 1,
+                        "sellCount": 100,
+                        "onVacation": False,
+                        "address": {"country": str(seller_country[pm.sellers[i]])},
+                    },
+                }
+                for i in order
+            ]
+
+        items = []
+        metaproducts = {}
+        seen = set()
+        for row in range(pm.n_rows):
+            metaprod = pm.metaprod_ids[row]
+            prod_id = int(pm.prod_ids[row])
+            if np.isnan(metaprod):
+                items.append({"idWant": f"w{prod_id}", "type": "product", "count": 1,
+                              "idProduct": prod_id})
+                continue
+            metaprod = int(metaprod)
+            metaproducts.setdefault(metaprod, []).append(
+                {"idProduct": prod_id, "idMetaproduct": metaprod}
+            )
+            if metaprod not in seen:
+                seen.add(metaprod)
+                items.append({"idWant": f"m{metaprod}", "type": "metaproduct", "count": 1,
+                              "idMetaproduct": metaprod})
+
+        wantlist = {"idWantsList": 1, "name": "Benchmark", "itemCount": len(items), "item": items}
+        metaproducts = {
+            metaprod: {"metaproduct": {"idMetaproduct": metaprod}, "product": products}
+            for metaprod, products in metaproducts.items()
+        }
+        return wantlist, metaproducts, articles
+
+    @property
+    def url(self):
+        host, port = self.address
+        return f"http://{host}:{port}{API_PREFIX}"
+
+    def _make_server(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                mock.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        server.daemon_threads = True
+        return server
+
+    def _serve(self, conn):
+        server = self._make_server()
+        conn.send(server.server_address[:2])
+        server.serve_forever()
+
+    def start(self, in_process=False):
+        if in_process:
+            self.server = self._make_server()
+            self.address = self.server.server_address[:2]
+            self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+            self.thread.start()
+        else:
+            ctx = multiprocessing.get_context("fork")
+            parent, child = ctx.Pipe()
+            self.process = ctx.Process(target=self._serve, args=(child,), daemon=True)
+            self.process.start()
+            self.address = parent.recv()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _stats(self):
+        with self.lock:
+            return {
+                "requests": sum(self.counts.values()),
+                "requests_per_endpoint": dict(sorted(self.counts.items())),
+                "throttled": self.n_throttled,
+                "bytes": self.bytes_sent,
+            }
+
+    def _reset(self):
+        with self.lock:
+            self.counts = {}
+            self.bytes_sent = 0
+            self.n_throttled = 0
+
+    def _control(self, action):
+        with urllib.request.urlopen(f"http://{self.address[0]}:{self.address[1]}/_mock/{action}") as r:
+            return json.loads(r.read())
+
+    def stats(self):
+        """Requests (total and per endpoint), 429s sent and bytes sent so far."""
+        return self._stats() if self.process is None else self._control("stats")
+
+    def reset_counts(self):
+        if self.process is None:
+            self._reset()
+        else:
+            self._control("reset")
+
+    def handle(self, request):
+        url = urlparse(request.path)
+        if url.path.startswith("/_mock/"):
+            if url.path == "/_mock/reset":
+                self._reset()
+            return self.send(request, 200, self._stats(), {})
+
+        parts = url.path[len(API_PREFIX):].strip("/").split("/")
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        endpoint = parts[0]
+
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+            n_requests = sum(self.counts.values())
+            throttled = self.rng.random() < self.throttle_rate or n_requests > self.quota
+            if throttled:
+                self.n_throttled += 1
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        headers = {
+            "X-Request-Limit-Count": str(n_requests),
+            "X-Request-Limit-Max": str(self.quota),
+        }
+        if throttled:
+            return self.send(request, 429, None, headers)
+
+        if endpoint == "account":
+            body = {"account": {"idUser": 1, "username": "benchmark",
+                                "name": {"firstName": "Bench", "lastName": "Mark"}}}
+            return self.send(request, 200, body, headers)
+        if endpoint == "wantslist" and len(parts) == 1:
+            summary = {k: v for k, v in self.wantlist.items() if k != "item"}
+            return self.send(request, 200, {"wantslist": [summary]}, headers)
+        if endpoint == "wantslist":
+            return self.send(request, 200, {"wantslist": self.wantlist}, headers)
+        if endpoint == "metaproducts" and int(parts[1]) in self.metaproducts:
+            return self.send(request, 200, self.metaproducts[int(parts[1])], headers)
+        if endpoint == "articles" and int(parts[1]) in self.articles:
+            return self.send_articles(request, self.articles[int(parts[1])], params, headers)
+        return self.send(request, 404, {"error": "Not found"}, headers)
+
+    def send_articles(self, request, articles, params, headers):
+        if "idLanguage" in params:
+            articles = [a for a in articles if a["language"]["idLanguage"] == int(params["idLanguage"])]
+        start = int(params.get("start", 0))
+        page_size = int(params.get("maxResults", DEFAULT_PAGE_SIZE))
+        page = articles[start:start + page_size]
+        if not page:
+            return self.send(request, 204, None, headers)
+        status = 200
+        if len(page) < len(articles):
+            status = 206
+            headers["Content-Range"] = f"{start}-{start + len(page) - 1}/{len(articles)}"
+
+        # Encoded once, so repeated runs measure the client and not json.dumps here
+        key = (page[0]["idProduct"], params.get("idLanguage"), start, page_size)
+        if key not in self._encoded:
+            self._encoded[key] = json.dumps({"article": page}).encode("utf-8")
+        return self.send(request, status, self._encoded[key], headers)
+
+    def send(self, request, status, body, headers):
+        if isinstance(body, bytes):
+            data = body
+        else:
+            data = json.dumps(body).encode("utf-8") if body is not None else b""
+        with self.lock:
+            self.bytes_sent += len(data)
+        request.send_response(status)
+        for key, value in headers.items():
+            request.send_header(key, value)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
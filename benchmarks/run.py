@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Runs the benchmarks and writes the results as JSON, so runs on different
+commits can be compared:
+
+    python -m benchmarks.run                      # everything
+    python -m benchmarks.run --quick --only fetch
+    python -m benchmarks.run --only optimizer --snapshots snapshots/wantlist_0
+    python -m benchmarks.run --compare benchmarks/results/old.json benchmarks/results/new.json
+
+- fetch: get_wantlist_data end to end against the mock server, wall time,
+  requests per endpoint, bytes and peak memory.
+- optimizer: time-to-quality of the solvers on the recorded and synthetic
+  matrices, and any wantlist snapshots given, as the gap to the best known
+  cost after a given time budget.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks.generators import RECORDED, recorded_price_matrix, synthetic_price_matrix
+from benchmarks.mock_server import MockCardmarket
+from optimizer import solve_annealing, solve_branch_and_bound, solve_milp
+from pruning import prune
+from snapshot import load_snapshot
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+# name: (wants, sellers, metaproduct fraction, latency, throttle rate, config overrides)
+FETCH_SCENARIOS = {
+    "fetch_small": (25, 231, 0.2, 0.02, 0.0, {}),
+    "fetch_large": (300, 1500, 0.2, 0.02, 0.0, {}),
+    "fetch_large_fast_json": (300, 1500, 0.2, 0.02, 0.0, {"fast_json": {"enabled": True}}),
+    "fetch_throttled": (100, 600, 0.2, 0.02, 0.05, {}),
+}
+QUICK_FETCH = ("fetch_small", "fetch_throttled")
+# name: (wants, sellers, metaproduct fraction)
+SYNTHETIC = {
+    "synthetic_100x500": (100, 500, 0.2),
+    "synthetic_300x1500": (300, 1500, 0.2),
+}
+BUDGETS = (0.1, 0.3, 1.0, 3.0)
+QUICK_BUDGETS = (0.1, 0.5)
+REFERENCE_TIME_LIMIT = 120
+
+
+def environment():
+    def git(*args):
+        try:
+            return subprocess.run(
+                ["git", *args], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    import scipy
+
+    return {
+        "commit": git("rev-parse", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def bench_config(url):
+    return {
+        "app_token": "benchmark",
+        "app_secret": "benchmark",
+        "access_token": "benchmark",
+        "access_token_secret": "benchmark",
+        "base_url": url,
+        "log_level": "ERROR",
+        "cardmarket_request_timeout": 30,
+        "search_filters": {"language": "English", "countries": ["NL", "DE", "BE", "FR"]},
+        "cache": {"enabled": False},
+        "retry": {"backoff_base": 0.05, "backoff_max": 1},
+    }
+
+
+def bench_fetch(n_wants, n_sellers, metaproduct_fraction, latency, throttle_rate, overrides=None, seed=0):
+    from buywizard_app import BuywizardApp
+
+    pm = synthetic_price_matrix(n_wants, n_sellers, metaproduct_fraction=metaproduct_fraction, seed=seed)
+    with MockCardmarket(pm, latency=latency, throttle_rate=throttle_rate, seed=seed) as server:
+        with contextlib.redirect_stdout(io.StringIO()):
+            app = BuywizardApp(config={**bench_config(server.url), **(overrides or {})})
+        server.reset_counts()
+
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            price_mat = app.get_wantlist_data(0)
+        wall = time.perf_counter() - started
+        result = {
+            "wall_s": wall,
+            **server.stats(),
+            "retries": app.api.retries_count,
+            "failed": len(app.api.failed_items),
+        }
+
+        # Second run for memory, tracemalloc slows everything down too much to time it
+        tracemalloc.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            app.get_wantlist_data(0)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        app.api.close()
+
+        return {
+            **result,
+            "peak_traced_mb": peak / 2 ** 20,
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "offers": price_mat.n_offers,
+            "shape": list(price_mat.shape),
+        }
+
+
+def time_to_quality(pm, budgets, seed=0):
+    started = time.perf_counter()
+    pruned, _ = prune(pm)
+    prune_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    reference = solve_milp(pruned, time_limit=REFERENCE_TIME_LIMIT)
+    milp_s = time.perf_counter() - started
+
+    curves = {"annealing": [], "branch_and_bound": []}
+    best = reference.total_cost
+    for budget in budgets:
+        for name, solve in (
+            ("annealing", lambda: solve_annealing(pruned, time_limit=budget, rng=seed)),
+            ("branch_and_bound", lambda: solve_branch_and_bound(pruned, time_limit=budget)),
+        ):
+            started = time.perf_counter()
+            solution = solve()
+            curves[name].append(
+                {
+                    "budget_s": budget,
+                    "wall_s": time.perf_counter() - started,
+                    "cost": solution.total_cost,
+                    "optimal": solution.optimal,
+                }
+            )
+            best = min(best, solution.total_cost)
+
+    for points in curves.values():
+        for point in points:
+            point["gap"] = (point["cost"] - best) / best
+    return {
+        "shape": list(pm.shape),
+        "offers": pm.n_offers,
+        "pruned_offers": pruned.n_offers,
+        "prune_s": prune_s,
+        "milp_s": milp_s,
+        "milp_optimal": reference.optimal,
+        "best_cost": best,
+        **curves,
+    }
+
+
+def snapshot_price_matrix(path):
+    return load_snapshot(path)[0]
+
+
+def run(only=None, quick=False, snapshots=()):
+    results = {}
+    if only in (None, "fetch"):
+        for name, scenario in FETCH_SCENARIOS.items():
+            if quick and name not in QUICK_FETCH:
+                continue
+            print(f"Running {name}...", file=sys.stderr)
+            results[name] = bench_fetch(*scenario)
+
+    if only in (None, "optimizer"):
+        budgets = QUICK_BUDGETS if quick else BUDGETS
+        matrices = {f"recorded_{name}": (recorded_price_matrix, (name,)) for name in RECORDED}
+        for name, (n_wants, n_sellers, fraction) in SYNTHETIC.items():
+            if quick and n_wants > 100:
+                continue
+            matrices[name] = (synthetic_price_matrix, (n_wants, n_sellers, None, fraction))
+        for path in snapshots:
+            matrices[f"snapshot_{Path(path).name}"] = (snapshot_price_matrix, (path,))
+        for name, (make, args) in matrices.items():
+            print(f"Running optimizer_{name}...", file=sys.stderr)
+            results[f"optimizer_{name}"] = time_to_quality(make(*args), budgets)
+    return results
+
+
+def flatten(results, prefix=""):
+    """{"a": {"b": 1}} -> {"a.b": 1}, lists of points are indexed by budget."""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, list) and value and isinstance(value[0], dict):
+            for point in value:
+                flat.update(flatten(point, f"{name}@{point['budget_s']}s."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(old_path, new_path):
+    old, new = (json.loads(Path(p).read_text()) for p in (old_path, new_path))
+    print(f"old: {old['environment']['commit']}  new: {new['environment']['commit']}")
+    old_flat, new_flat = flatten(old["results"]), flatten(new["results"])
+    width = max((len(k) for k in new_flat), default=0)
+    for key in sorted(set(old_flat) & set(new_flat)):
+        a, b = old_flat[key], new_flat[key]
+        ratio = f"{b / a:8.2f}x" if a else "         "
+        print(f"{key:<{width}}  {a:12.4g}  {b:12.4g}  {ratio}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mkm_buywizard benchmarks")
+    parser.add_argument("--only", choices=["fetch", "optimizer"])
+    parser.add_argument("--quick", action="store_true", help="Smaller scenarios and budgets")
+    parser.add_argument("--out", help="Results file, default benchmarks/results/<commit>.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--snapshots", nargs="+", default=[], help="Wantlist snapshots to add to the optimizer runs")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    logging.disable(logging.WARNING)
+    env = environment()
+    results = run(args.only, args.quick, args.snapshots)
+    out = Path(args.out) if args.out else RESULTS_DIR / f"{(env['commit'] or 'unknown')[:10]}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps({"environment": env, "results": results}, indent=2))
+    print(json.dumps(results, indent=2))
+    print(f"Results written to {out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
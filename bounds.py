@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Lower bounds on the cheapest basket, to tell how far a heuristic basket can
+be from optimal.
+
+- simple_bound: the cheapest offer of every card (the cheapest copies, with
+  quantities), plus the least shipping any split of that many cards over
+  sellers can cost, in the cheapest value bracket. Microseconds, no scipy.
+- lp_bound: the LP relaxation of the MILP in optimizer.solve_milp, with the
+  offer/seller linking rows that make it tight. One LP solve, which can take
+  longer than the heuristic it bounds on large lists, so it's opt-in.
+"""
+
+import numpy as np
+
+from optimizer import _milp_model
+from price_matrix import as_price_matrix
+from shipping import seller_shipping, shipping_cost_table
+
+
+def min_shipping(n_cards, ship=None):
+    """
+    Least total shipping of n_cards split in any way over any number of
+    sellers, ship being the shipping by number of cards.
+    """
+    ship = shipping_cost_table() if ship is None else ship
+    max_per_seller = len(ship) - 2
+    best = np.zeros(n_cards + 1)
+    for n in range(1, n_cards + 1):
+        k = np.arange(1, min(n, max_per_seller) + 1)
+        best[n] = np.min(ship[k] + best[n - k])
+    return best[n_cards]
+
+
+def simple_bound(price_mat, groups=None, shipping=None):
+    pm = as_price_matrix(price_mat, groups)
+    gidx = pm.group_index()
+    n_groups = gidx.max() + 1 if pm.n_rows else 0
+    # Every letter costs at least what the cheapest seller charges for that many cards
+    ship = seller_shipping(shipping, pm.seller_ids, value=None).min(axis=0) if pm.n_sellers else None
+    if pm.has_quantities:
+        demand = np.zeros(n_groups, dtype=np.int64)
+        demand[gidx] = pm.wanted
+        return float(cheapest_copies(pm, gidx, demand).sum() + min_shipping(int(demand.sum()), ship))
+
+    rows, _, prices = pm.coo()
+    cheapest = np.full(n_groups, np.inf)
+    np.minimum.at(cheapest, gidx[rows], prices)
+    return float(cheapest.sum() + min_shipping(n_groups, ship))
+
+
+def cheapest_copies(pm, gidx, demand):
+    """Per group, the cheapest demand copies over all its price ladder tiers, np.inf if there aren't enough."""
+    offers, prices, copies = pm.tiers()
+    groups = gidx[pm.rows[offers]]
+    order = np.lexsort((prices, groups))
+    groups, prices, copies = groups[order], prices[order], copies[order]
+    # Copies in the cheaper tiers of the same group
+    before = np.cumsum(copies) - copies
+    before -= before[np.searchsorted(groups, groups)]
+    take = np.clip(demand[groups] - before, 0, copies)
+    cost = np.bincount(groups, weights=take * prices, minlength=len(demand))
+    enough = np.bincount(groups, weights=take, minlength=len(demand)) >= demand
+    return np.where(enough, cost, np.inf)
+
+
+def lp_bound(price_mat, groups=None, shipping=None, time_limit=None):
+    """LP relaxation bound, -inf if it isn't solved within time_limit. Raises ImportError without scipy."""
+    from scipy.optimize import Bounds, LinearConstraint, milp
+
+    pm = as_price_matrix(price_mat, groups)
+    c, A, lb, ub, var_ub, _ = _milp_model(pm, linking=True, shipping=shipping)
+    options = {"time_limit": time_limit} if time_limit else {}
+    res = milp(c, bounds=Bounds(0, var_ub), constraints=LinearConstraint(A, lb, ub), options=options)
+    if res.status != 0:
+        return -np.inf
+    return float(res.fun)
+
+
+def lower_bound(price_mat, groups=None, lp=False, shipping=None, time_limit=None):
+    """Best of the bounds above, lp=True adds the LP solve, stopped after time_limit seconds."""
+    pm = as_price_matrix(price_mat, groups)
+    bound = simple_bound(pm, shipping=shipping)
+    if lp:
+        try:
+            bound = max(bound, lp_bound(pm, shipping=shipping, time_limit=time_limit))
+        except ImportError:
+            pass
+    return bound
@@ -11,12 +11,27 @@ import json
 import logging
 import logging.handlers
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
 
 from pprint import pprint as pp
 import numpy as np
 import pandas as pd
-
+from tabulate import tabulate
+
+from articles import CONDITIONS
+from bounds import lower_bound
+from combined import combine, optimize_combined
+from decomposition import solve_by_components
+from incremental import MAX_CHANGED_FRACTION, warm_solve
+from metrics import enable_metrics, get_metrics, timed
+from optimizer import optimize
+from price_matrix import PriceMatrixBuilder
+from pruning import format_report, prune
 from pymkmapi import PyMkmApi, CardmarketError
+from search_filters import compile_filters
+from shipping import ShippingTable
+from snapshot import load_snapshot, save_snapshot
 
 
 class BuywizardApp:
@@ -40,18 +55,31 @@ class BuywizardApp:
         sh.setFormatter(formatter)
         self.logger.addHandler(sh)
 
-        self.logger.debug(">> Loading config file")
-        try:
-            with open("config.json", "r") as config_file:
-                self.config = json.load(config_file)
-        except FileNotFoundError:
-            self.logger.error(
-                "You must copy config_template.json to config.json and populate the fields."
-            )
-            sys.exit(0)
+        if config is not None:
+            self.config = config
+        else:
+            self.logger.debug(">> Loading config file")
+            try:
+                with open("config.json", "r") as config_file:
+                    self.config = json.load(config_file)
+            except FileNotFoundError:
+                self.logger.error(
+                    "You must copy config_template.json to config.json and populate the fields."
+                )
+                sys.exit(0)
 
         fh.setLevel(self.config["log_level"])
         self.logger.setLevel(self.config["log_level"])
+        if self.config.get("metrics", {}).get("enabled", False):
+            enable_metrics()
+        # Shipping rates by seller country and basket value, flat brackets without
+        self.shipping = None
+        if self.config.get("shipping_rates"):
+            self.shipping = ShippingTable.load(self.config["shipping_rates"])
+        # idArticles behind the offers of the last fetch, when it started and the sellers' countries
+        self.articles = None
+        self.fetched_at = None
+        self.seller_countries = {}
         self.api = PyMkmApi(config=self.config)
         print("Fetching Cardmarket account data...")
         self.account = self.get_account_data()
@@ -69,88 +97,399 @@ class BuywizardApp:
         #
         # self.optimize_wantlist(choice)
 
-        self.optimize_wantlist(0)
+        # Indices into self.wantlists, several of them (or "all") runs the batch mode
+        wantlist_ids = getattr(args, "wantlists", None) or self.config.get("wantlists") or [0]
+        if wantlist_ids in ("all", ["all"]):
+            wantlist_ids = list(range(len(self.wantlists)))
+        wantlist_ids = [int(i) for i in wantlist_ids]
+        try:
+            if len(wantlist_ids) == 1:
+                self.optimize_wantlist(wantlist_ids[0])
+            elif getattr(args, "combined", False) or self.config.get("combined_basket", False):
+                self.optimize_combined_wantlists(wantlist_ids)
+            else:
+                self.optimize_wantlists(wantlist_ids)
+        finally:
+            self.api.close()
+            self.report_metrics()
+
+    def report_metrics(self):
+        metrics = get_metrics()
+        if not metrics.enabled:
+            return
+        print(f"\n{metrics.report()}")
+        export = self.config.get("metrics", {}).get("export")
+        if export:
+            metrics.export(export)
+            print(f"Metrics written to {export}")
 
     def get_account_data(self):
         return self.api.get_account()["account"]
 
-    def async_get_retry(self, item_type, item_id_list, **kwargs):
+    def async_get(self, item_type, item_id_list, on_response=None, **kwargs):
         print(f"Async fetching: {item_type}")
 
-        ret_list = [None]*len(item_id_list)
-        to_find = item_id_list.copy()
-
-        round = 1
-        while len([x for x in ret_list if x is not None]) < len(item_id_list):
-            print(f"Fetch round {round}: {len(to_find)} items left")
-            round += 1
-            results = self.api.get_items_async(
-                item_type=item_type,
-                item_id_list=to_find,
-                **kwargs
-            )
-
-            for ind in range(len(ret_list)):
-                if (ret_list[ind] is None) and (len(results) > 0):
-                    ret_list[ind] = results.pop(0)
-                    if ret_list[ind] is not None:
-                        to_find.pop(0)
+        responses = self.api.get_items_async(
+            item_type=item_type,
+            item_id_list=item_id_list,
+            on_response=on_response,
+            **kwargs
+        )
+        if self.api.failed_items:
+            print(f"Could not fetch {len(self.api.failed_items)} {item_type}, leaving them out:")
+            for item_id, error in self.api.failed_items.items():
+                print(f"\t{item_id}: {error}")
 
-        return ret_list
+        return responses
 
-    def get_wantlist_data(self, wantlist_id):
+    def get_wantlist_items(self, wantlist_id):
+        """({product id: copies}, {metaproduct id: copies}) wanted in a wantlist."""
         want_items = self.api.get_wantslist_items(self.wantlists[wantlist_id]['idWantsList']).get('item')
+        products, metaprods = {}, {}
+        for item in want_items:
+            wanted, key = (products, 'idProduct') if item['type'] == 'product' else (metaprods, 'idMetaproduct')
+            wanted[item[key]] = wanted.get(item[key], 0) + int(item.get('count', 1))
+        return products, metaprods
 
-        products = [x for x in want_items if x['type'] == 'product']
-        metaprod_wants = [x for x in want_items if x['type'] == 'metaproduct']
-
-        metaproducts = self.async_get_retry("metaproducts", [x['idMetaproduct'] for x in metaprod_wants])
-
-        product_ids = [prod['idProduct'] for prod in products]
-
-        for metaprod in metaproducts:
-            for prod in metaprod['product']:
-                product_ids.append(prod['idProduct'])
-
-        articles = self.async_get_retry("articles", product_ids, **self.config['search_filters'])
-
-        # Filter down to countries
-        for i in range(len(articles)):
-            for j, item in reversed(list(enumerate(articles[i]['article']))):
-                if item['seller']['address']['country'] not in self.config['search_filters']['countries']:
-                    del articles[i]['article'][j]
-
-        # Output formatting
-        prod_to_metaprod = {}
-        for metaprod in metaproducts:
-            for prod in metaprod['product']:
-                prod_to_metaprod[prod['idProduct']] = prod['idMetaproduct']
-
-        lod = []
-        for ind, prod_id in enumerate(product_ids):
-            seller_prices = {art['seller']['idUser']: art['price'] for art in articles[ind]['article']}
-            lod.append({
-                "prod_id": prod_id,
-                **seller_prices
-            })
-            if prod_id in prod_to_metaprod.keys():
-                lod[-1]['metaprod_id'] = prod_to_metaprod[prod_id]
-
-        # TODO: Create article_id dataframe (for translation back to article_id list)
-        price_df = pd.DataFrame(lod).set_index(['metaprod_id', 'prod_id']).fillna(np.inf)
-
-        zero_rows, *_ = np.where((price_df < np.inf).sum(axis=1) == 0)
-        if len(zero_rows) > 0:
-            print(f"There were {len(zero_rows)} cards with 0 sellers matching your search preferences."
-                  f"We are removing:")
-        price_df = price_df[~((price_df < np.inf).sum(axis=1) == 0)]
-
-        return price_df
+    @timed("get_wantlist_data")
+    def get_wantlist_data(self, wantlist_id):
+        price_mats, _ = self.get_wantlists_data([wantlist_id])
+        return price_mats[wantlist_id]
+
+    def get_wantlists_data(self, wantlist_ids):
+        """
+        PriceMatrix per wantlist, with every metaproduct and product shared
+        between the lists fetched only once. Returns ({wantlist_id:
+        PriceMatrix}, dedupe report).
+        """
+        self.fetched_at = datetime.now(timezone.utc)
+        with get_metrics().phase("wantlist"):
+            wants = {wantlist_id: self.get_wantlist_items(wantlist_id) for wantlist_id in wantlist_ids}
+
+        all_metaprod_ids = list(dict.fromkeys(m for _, metaprods in wants.values() for m in metaprods))
+        metaproducts = self.async_get("metaproducts", all_metaprod_ids)
+        metaprod_products = {
+            metaprod_id: [prod['idProduct'] for prod in metaprod['product']]
+            for metaprod_id, metaprod in metaproducts.items()
+        }
+
+        # Products per wantlist, directly and through its metaproducts, and the copies wanted of each
+        wanted = {}
+        copies = {}
+        for wantlist_id, (products, metaprods) in wants.items():
+            product_ids = list(products)
+            counts = list(products.values())
+            prod_to_metaprod = {}
+            for metaprod_id, count in metaprods.items():
+                for prod_id in metaprod_products.get(metaprod_id, []):
+                    product_ids.append(prod_id)
+                    counts.append(count)
+                    prod_to_metaprod[prod_id] = metaprod_id
+            wanted[wantlist_id] = (product_ids, prod_to_metaprod, counts)
+            for prod_id, count in zip(product_ids, counts):
+                copies[prod_id] = copies.get(prod_id, 0) + count
+        all_product_ids = list(dict.fromkeys(p for product_ids, _, _ in wanted.values() for p in product_ids))
+
+        # Offers are added to the matrix as the responses come in, the raw JSON isn't kept,
+        # the articles behind them go to self.articles
+        # Filters the API supports are sent along, the rest are applied as the offers come in
+        params, article_filter = compile_filters(self.config['search_filters'], self.api.languages)
+        builder = PriceMatrixBuilder(
+            all_product_ids, article_filter=article_filter, shipping=self.shipping, wanted=copies
+        )
+        self.async_get(
+            "articles",
+            all_product_ids,
+            on_response=builder.add_response,
+            page_size=article_filter.page_size,
+            more_pages=builder.wants_more,
+            **params
+        )
+        if self.api.cache is not None:
+            print(self.api.cache.summary())
+        with get_metrics().phase("build_matrix"):
+            all_offers = builder.build()
+            self.articles = builder.article_index()
+        self.seller_countries = builder.seller_countries
+        if self.shipping is not None:
+            self.shipping.set_seller_countries(builder.seller_countries)
+
+        union_row = {prod_id: row for row, prod_id in enumerate(all_product_ids)}
+        price_mats = {}
+        for wantlist_id, (product_ids, prod_to_metaprod, counts) in wanted.items():
+            price_mat = all_offers.select_rows([union_row[p] for p in product_ids]).regroup(
+                [prod_to_metaprod.get(p, np.nan) for p in product_ids]
+            ).with_wanted(counts)
+            n_empty = int((np.diff(price_mat.indptr) == 0).sum())
+            if n_empty > 0:
+                print(f"There were {n_empty} cards in {self.wantlists[wantlist_id]['name']} with 0 "
+                      f"sellers matching your search preferences. We are removing them.")
+            price_mats[wantlist_id] = price_mat.drop_empty_rows()
+
+        report = {
+            "wantlists": len(wantlist_ids),
+            "metaproducts": (sum(len(set(m)) for _, m in wants.values()), len(all_metaprod_ids)),
+            "products": (sum(len(set(p)) for p, _, _ in wanted.values()), len(all_product_ids)),
+        }
+        return price_mats, report
 
     def optimize_wantlist(self, wantlist_id):
 
         # TODO Filter items out using wantlist preferences
-        price_df = self.get_wantlist_data(wantlist_id)
+        price_mat = self.get_wantlist_data(wantlist_id)
+        self.save_snapshot(price_mat, wantlist_id)
+        warm_start = self.config.get("warm_start", {})
+        with get_metrics().phase("optimize"):
+            if warm_start.get("enabled", False):
+                price_mat, report, solution = warm_solve(
+                    price_mat,
+                    warm_start.get("path", "warm_start_{}.npz").format(wantlist_id),
+                    time_limit=self.config.get("optimizer_time_limit"),
+                    method=self.config.get("optimizer_method", "auto"),
+                    max_changed_fraction=warm_start.get("max_changed_fraction", MAX_CHANGED_FRACTION),
+                    shipping=self.shipping,
+                    **self.config.get("optimizer_options", {}),
+                )
+            else:
+                price_mat, report, solution = solve_wantlist(
+                    price_mat,
+                    time_limit=self.config.get("optimizer_time_limit"),
+                    method=self.config.get("optimizer_method", "auto"),
+                    shipping=self.shipping,
+                    decomposition=self.config.get("decomposition"),
+                    **self.config.get("optimizer_options", {}),
+                )
+        print(format_report(report))
+        basket = self.print_basket(price_mat, solution, self.shipping, self.articles)
+        self.save_cart(price_mat, solution, wantlist_id)
+        return basket
+
+    def optimize_wantlists(self, wantlist_ids):
+        """
+        Batch mode: fetch all wantlists at once, then optimize them in parallel
+        in a process pool. Returns {wantlist_id: basket}.
+        """
+        price_mats, dedupe = self.get_wantlists_data(wantlist_ids)
+        print(format_dedupe_report(dedupe))
+        for wantlist_id, price_mat in price_mats.items():
+            self.save_snapshot(price_mat, wantlist_id)
+
+        baskets = {}
+        with get_metrics().phase("optimize_batch"):
+            with ProcessPoolExecutor(self.config.get("batch_workers")) as pool:
+                futures = {
+                    wantlist_id: pool.submit(
+                        solve_wantlist,
+                        price_mat,
+                        time_limit=self.config.get("optimizer_time_limit"),
+                        method=self.config.get("optimizer_method", "auto"),
+                        shipping=self.shipping,
+                        decomposition=self.config.get("decomposition"),
+                        **self.config.get("optimizer_options", {}),
+                    )
+                    for wantlist_id, price_mat in price_mats.items()
+                }
+                for wantlist_id, future in futures.items():
+                    price_mat, report, solution = future.result()
+                    print(f"\n{self.wantlists[wantlist_id]['name']}")
+                    print(format_report(report))
+                    baskets[wantlist_id] = self.print_basket(price_mat, solution, self.shipping, self.articles)
+                    self.save_cart(price_mat, solution, wantlist_id)
+        return baskets
+
+    def optimize_combined_wantlists(self, wantlist_ids):
+        """
+        Buy all wantlists as one basket, sharing shipping between them, and
+        split the result back per wantlist. Returns {wantlist_id: basket}.
+        """
+        price_mats, dedupe = self.get_wantlists_data(wantlist_ids)
+        print(format_dedupe_report(dedupe))
+        if self.config.get("snapshot", {}).get("path"):
+            # The stacked lists, so the snapshot is optimized offline as the same one basket
+            stacked, label_owner, _ = combine(list(price_mats.values()))
+            names = [self.wantlists[wantlist_id]["name"] for wantlist_id in price_mats]
+            self.save_snapshot(
+                stacked, "combined", "Combined: " + ", ".join(names),
+                labels={"wantlist": np.array(names)[label_owner[stacked.metaprod_ids.astype(int)]]},
+            )
 
+        with get_metrics().phase("optimize_combined"):
+            price_mat, solution, shares = optimize_combined(
+                list(price_mats.values()),
+                time_limit=self.config.get("optimizer_time_limit"),
+                method=self.config.get("optimizer_method", "auto"),
+                shipping=self.shipping,
+                decomposition=self.config.get("decomposition"),
+                **self.config.get("optimizer_options", {}),
+            )
 
-        pass
+        baskets = {}
+        for wantlist_id, share in zip(price_mats, shares):
+            print(f"\n{self.wantlists[wantlist_id]['name']}")
+            baskets[wantlist_id] = self.basket_table(price_mat, solution, share["rows"], self.articles)
+            print(tabulate(baskets[wantlist_id], headers="keys"))
+            print(
+                f"\nArticles: {share['article_cost']:.2f}, share of shipping: "
+                f"{share['shipping_cost']:.2f} ({share['n_sellers']} sellers)"
+            )
+
+        print(
+            f"\nCombined basket, articles: {solution.article_cost:.2f}, shipping: "
+            f"{solution.shipping_cost:.2f} ({solution.n_sellers} sellers), "
+            f"total: {solution.total_cost:.2f}"
+        )
+        print(format_gap(price_mat, solution, self.shipping))
+        self.save_cart(price_mat, solution, "combined")
+        return baskets
+
+    def save_snapshot(self, price_mat, wantlist_id, name=None, labels=None):
+        """
+        Save the fetched wantlist to the snapshot path in the config, if there
+        is one. The path is formatted with wantlist_id, name defaults to the
+        wantlist's.
+        """
+        path = self.config.get("snapshot", {}).get("path")
+        if not path:
+            return
+        labels = dict(labels or {})
+        if self.seller_countries:
+            labels["seller_country"] = [self.seller_countries.get(s, "") for s in price_mat.seller_ids.tolist()]
+        save_snapshot(
+            path.format(wantlist_id),
+            price_mat,
+            fetched_at=self.fetched_at,
+            articles=self.articles,
+            labels=labels,
+            meta={
+                "wantlist": name or self.wantlists[wantlist_id]["name"],
+                "search_filters": self.config.get("search_filters"),
+            },
+        )
+        print(f"Snapshot written to {path.format(wantlist_id)}")
+
+    def save_cart(self, price_mat, solution, name):
+        """Write the shopping cart payload of a basket to the configured cart_file."""
+        path = self.config.get("cart_file")
+        if not path or self.articles is None:
+            return
+        amounts = solution.amounts if solution.amounts is not None else price_mat.offer_amounts(solution.assignment)
+        offers, *_ = np.where(amounts > 0)
+        payload = self.articles.cart_payload(
+            price_mat.prod_ids[price_mat.rows[offers]],
+            price_mat.seller_ids[price_mat.sellers[offers]],
+            amounts[offers],
+        )
+        with open(path.format(name), "w") as cart_file:
+            json.dump(payload, cart_file, indent=2)
+        print(f"Cart with {len(payload['article'])} articles written to {path.format(name)}")
+
+    @staticmethod
+    def basket_table(price_mat, solution, rows=None, articles=None):
+        if solution.amounts is not None:
+            # A line per offer with the copies bought, the price is for all of them
+            offers, *_ = np.where(solution.amounts > 0)
+            if rows is not None:
+                offers = offers[np.isin(price_mat.rows[offers], rows)]
+            rows, sellers = price_mat.rows[offers], price_mat.sellers[offers]
+            prices = price_mat.amount_cost(solution.amounts)[offers]
+        else:
+            if rows is None:
+                rows, *_ = np.where(solution.assignment >= 0)
+            sellers = solution.assignment[rows]
+            prices = price_mat.lookup(rows, sellers)
+        columns = {
+            "metaprod_id": price_mat.metaprod_ids[rows],
+            "prod_id": price_mat.prod_ids[rows],
+            "seller": price_mat.seller_ids[sellers],
+            "price": prices,
+        }
+        if solution.amounts is not None:
+            columns["amount"] = solution.amounts[offers]
+        if articles is not None and articles.n_articles:
+            best = articles.best(columns["prod_id"], columns["seller"])
+            found = best >= 0
+            # Unknown conditions and languages index the trailing ""
+            conditions = np.where(found, articles.conditions[best], -1)
+            languages = np.where(found, articles.languages[best], -1)
+            languages[languages >= len(PyMkmApi.languages)] = -1
+            columns["article"] = np.where(found, articles.article_ids[best], -1)
+            columns["condition"] = np.array(CONDITIONS + [""])[conditions]
+            columns["language"] = np.array(PyMkmApi.languages + [""])[languages]
+        return pd.DataFrame(columns).set_index(["metaprod_id", "prod_id"])
+
+    @classmethod
+    def print_basket(cls, price_mat, solution, shipping=None, articles=None):
+        basket = cls.basket_table(price_mat, solution, articles=articles)
+
+        print(f"Optimized {price_mat.n_rows} cards over {price_mat.n_sellers} sellers")
+        print(tabulate(basket, headers="keys"))
+        print(
+            f"\nArticles: {solution.article_cost:.2f}, shipping: {solution.shipping_cost:.2f} "
+            f"({solution.n_sellers} sellers), total: {solution.total_cost:.2f}"
+        )
+        print(format_gap(price_mat, solution, shipping))
+
+        return basket
+
+
+def solve_wantlist(price_mat, time_limit=None, method="auto", shipping=None, decomposition=None, **options):
+    """
+    Prune and optimize one wantlist, returns (pruned PriceMatrix, prune report,
+    Solution). decomposition are the solve_by_components options, if it's to
+    be split up.
+    """
+    price_mat, report = prune(price_mat, shipping)
+    if decomposition is not None:
+        solution = solve_by_components(
+            price_mat, optimize, time_limit=time_limit, method=method, shipping=shipping,
+            **decomposition, **options
+        )
+    else:
+        solution = optimize(price_mat, time_limit=time_limit, method=method, shipping=shipping, **options)
+    return price_mat, report, solution
+
+
+def optimize_snapshot(path, config):
+    """
+    Optimize a wantlist saved with the snapshot option, without going through
+    the API. Returns the basket like BuywizardApp.optimize_wantlist.
+    """
+    price_mat, articles, manifest = load_snapshot(path)
+    print(f"{manifest['meta'].get('wantlist', path)}, fetched at {manifest['fetched_at']}")
+    shipping = None
+    if config.get("shipping_rates"):
+        shipping = ShippingTable.load(config["shipping_rates"])
+        countries = manifest["labels"].get("seller_country")
+        if countries is not None:
+            shipping.set_seller_countries(dict(zip(price_mat.seller_ids.tolist(), countries.tolist())))
+    price_mat, report, solution = solve_wantlist(
+        price_mat,
+        time_limit=config.get("optimizer_time_limit"),
+        method=config.get("optimizer_method", "auto"),
+        shipping=shipping,
+        decomposition=config.get("decomposition"),
+        **config.get("optimizer_options", {}),
+    )
+    print(format_report(report))
+    return BuywizardApp.print_basket(price_mat, solution, shipping, articles)
+
+
+def format_gap(price_mat, solution, shipping=None):
+    if solution.optimal:
+        return "This is the cheapest basket."
+    if solution.lower_bound is None:
+        solution.lower_bound = lower_bound(price_mat, shipping=shipping)
+    return (
+        f"Not proven optimal, at most {solution.gap:.1%} above the cheapest basket "
+        f"(lower bound {solution.lower_bound:.2f})."
+    )
+
+
+def format_dedupe_report(report):
+    meta_requested, meta_fetched = report["metaproducts"]
+    prod_requested, prod_fetched = report["products"]
+    saved = meta_requested - meta_fetched + prod_requested - prod_fetched
+    return (
+        f"{report['wantlists']} wantlists share {meta_fetched}/{meta_requested} metaproducts and "
+        f"{prod_fetched}/{prod_requested} products, deduplication saved {saved} requests"
+    )
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Combined basket: several wantlists bought as one order, so cards from the same
+seller share one letter and pay shipping once. The lists are stacked into one
+PriceMatrix, solved together and the basket is split back per list, with
+every seller's shipping shared out over the lists by number of cards.
+
+Every list keeps its own metaproduct groups, a card wanted in two lists is
+bought twice. The lists share every seller's stock of a card, so a seller
+with one copy can only sell it to one of them. Matrices without price ladders
+(from dense arrays) don't know the stock, their rows are costed on their own.
+Pruning and the decomposition keep the shared stock, so the combined matrix
+is cut down and split like a single list.
+"""
+
+import numpy as np
+
+from decomposition import solve_by_components
+from optimizer import optimize
+from price_matrix import PriceMatrix
+from pruning import prune
+from shipping import shipping_cost_table
+
+
+def combine(price_mats):
+    """
+    Stack PriceMatrices on a shared seller axis. Every card gets its own group
+    label, so the stacked matrix' metaprod_ids index the returned arrays with
+    the list it came from and its original metaprod_id.
+    """
+    rows, seller_ids, prices, amounts, prod_ids, wanted, labels = [], [], [], [], [], [], []
+    label_owner, label_metaprod = [], []
+    offset = 0
+    for i, pm in enumerate(price_mats):
+        # One triplet per price ladder tier, so the ladders are rebuilt
+        offers, p, a = pm.tiers()
+        rows.append(pm.rows[offers].astype(np.int64) + offset)
+        seller_ids.append(pm.seller_ids[pm.sellers[offers]])
+        prices.append(p)
+        amounts.append(a)
+        prod_ids.append(pm.prod_ids)
+        wanted.append(pm.wanted)
+
+        # A group of one row is a plain product, same as NaN
+        gidx = pm.group_index()
+        n_groups = gidx.max() + 1 if pm.n_rows else 0
+        labels.append(len(label_owner) + gidx)
+        first = np.unique(gidx, return_index=True)[1]
+        label_owner.extend([i] * n_groups)
+        label_metaprod.extend(pm.metaprod_ids[first])
+        offset += pm.n_rows
+
+    combined = PriceMatrix.from_offers(
+        np.concatenate(rows),
+        np.concatenate(seller_ids),
+        np.concatenate(prices),
+        np.concatenate(prod_ids),
+        np.concatenate(labels).astype(np.float64),
+        np.concatenate(wanted),
+        np.concatenate(amounts) if all(pm.ladder is not None for pm in price_mats) else None,
+    )
+    return combined, np.array(label_owner, dtype=int), np.array(label_metaprod)
+
+
+def attribute(solution, pm, owner, n_lists, shipping=None):
+    """Per list: rows bought, article cost and its share of the shipping."""
+    amounts = solution.amounts if solution.amounts is not None else pm.offer_amounts(solution.assignment)
+    bought = amounts > 0
+    prices = np.where(bought, pm.amount_cost(amounts), 0.0)
+    seller_cards = np.bincount(pm.sellers, weights=amounts, minlength=pm.n_sellers).astype(int)
+    if shipping is None:
+        seller_shipping = shipping_cost_table()[seller_cards]
+    else:
+        seller_value = np.bincount(pm.sellers, weights=prices, minlength=pm.n_sellers)
+        seller_shipping = shipping.cost(pm.seller_ids, seller_cards, seller_value)
+
+    shares = []
+    for i in range(n_lists):
+        mine = bought & (owner[pm.rows] == i)
+        cards = np.bincount(pm.sellers[mine], weights=amounts[mine], minlength=pm.n_sellers)
+        used = cards > 0
+        shipping = float((seller_shipping[used] * cards[used] / seller_cards[used]).sum())
+        shares.append({
+            "rows": np.unique(pm.rows[mine]),
+            "article_cost": float(prices[mine].sum()),
+            "shipping_cost": shipping,
+            "n_sellers": int(used.sum()),
+        })
+    return shares
+
+
+def optimize_combined(price_mats, time_limit=None, method="auto", shipping=None, decomposition=None, **options):
+    """
+    Solve the lists as one basket like solve_wantlist: pruned, split into
+    independent seller clusters (and further with the solve_by_components
+    options in decomposition) and solved with optimize(..., **options).
+    Returns (combined PriceMatrix, Solution, per list attribution); the
+    matrix' metaprod_ids are the original ones again.
+    """
+    pm, label_owner, label_metaprod = combine(price_mats)
+    pm, _ = prune(pm, shipping)
+    solution = solve_by_components(
+        pm, optimize, time_limit=time_limit, method=method, shipping=shipping, **(decomposition or {}), **options
+    )
+
+    labels = pm.metaprod_ids.astype(int)
+    shares = attribute(solution, pm, label_owner[labels], len(price_mats), shipping)
+    return pm.regroup(label_metaprod[labels]), solution, shares
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Vectorized cost evaluation of seller assignments ("batchings").
+
+A batching holds one seller column per price matrix row, -1 for printings of a
+metaproduct that aren't bought. Many batchings are stacked as a 2-D array and
+scored in one pass.
+"""
+
+import numpy as np
+
+from price_matrix import as_price_matrix
+from shipping import shipping_cost_table
+
+# Upper bound on the (batchings x sellers) count matrix built per chunk
+CHUNK_CELLS = 4_000_000
+
+
+def evaluate_batchings(batchings, price_mat, ship_table=None, shipping=None):
+    """
+    Return (article_cost, shipping_cost, total) arrays, one entry per batching.
+    price_mat is a PriceMatrix or a dense array. ship_table is the shipping
+    cost by number of cards, for all sellers or one row per seller column.
+    With a ShippingTable as shipping, every letter is costed by its seller's
+    country, card count and value instead.
+    """
+    batchings = np.atleast_2d(np.asarray(batchings, dtype=np.int64))
+    pm = as_price_matrix(price_mat)
+    if ship_table is None:
+        ship_table = shipping_cost_table()
+    ship_table = np.broadcast_to(ship_table, (pm.n_sellers, np.shape(ship_table)[-1]))
+    seller_col = np.arange(pm.n_sellers)
+
+    n_batchings, n_rows = batchings.shape
+    n_sellers = pm.n_sellers
+    article = np.empty(n_batchings)
+    ship_cost = np.empty(n_batchings)
+
+    chunk = max(1, CHUNK_CELLS // max(n_sellers, 1))
+    row_ind = np.arange(n_rows)
+    for start in range(0, n_batchings, chunk):
+        batch = batchings[start:start + chunk]
+        n = len(batch)
+        bought = batch >= 0
+        cols = np.where(bought, batch, 0)
+
+        prices = pm.lookup(np.broadcast_to(row_ind, cols.shape), cols)
+        article[start:start + n] = np.where(bought, prices, 0.0).sum(axis=1)
+
+        # Offset every batching into its own block of seller ids so a single
+        # bincount gives the per-row seller counts
+        flat = (np.arange(n)[:, None] * n_sellers + cols)[bought]
+        counts = np.bincount(flat, minlength=n * n_sellers).reshape(n, n_sellers)
+        if shipping is not None:
+            values = np.bincount(flat, weights=prices[bought], minlength=n * n_sellers)
+            letters = shipping.cost(pm.seller_ids, counts, values.reshape(n, n_sellers))
+        else:
+            counts = np.minimum(counts, ship_table.shape[1] - 1)
+            letters = ship_table[seller_col, counts]
+        ship_cost[start:start + n] = letters.sum(axis=1)
+
+    return article, ship_cost, article + ship_cost
+
+
+def evaluate_amounts(amounts, price_mat, shipping=None):
+    """
+    evaluate_batchings for one basket given as the copies bought per offer,
+    every seller's letter holding all of its copies.
+    """
+    pm = as_price_matrix(price_mat)
+    amounts = np.asarray(amounts, dtype=np.int64)
+    offer_cost = pm.amount_cost(amounts)
+    counts = np.bincount(pm.sellers, weights=amounts, minlength=pm.n_sellers).astype(np.int64)
+    if shipping is not None:
+        values = np.bincount(pm.sellers, weights=np.where(amounts > 0, offer_cost, 0.0), minlength=pm.n_sellers)
+        letters = shipping.cost(pm.seller_ids, counts, values)
+    else:
+        ship_table = shipping_cost_table()
+        letters = ship_table[np.minimum(counts, len(ship_table) - 1)]
+    article = np.array([np.where(amounts > 0, offer_cost, 0.0).sum()])
+    ship_cost = np.array([letters.sum()])
+    return article, ship_cost, article + ship_cost
+
+
+def total_cost(batching, price_mat, separate=False):
+    article, shipping, total = evaluate_batchings(batching, price_mat)
+    if separate:
+        return article[0], shipping[0]
+    return total[0]
+
+
+def random_batchings(price_mat, n, groups=None, rng=None):
+    """Draw n random valid batchings, one printing per metaproduct."""
+    pm = as_price_matrix(price_mat, groups)
+    rng = np.random.default_rng(rng)
+    n_rows = pm.n_rows
+
+    n_valid = np.diff(pm.indptr)
+    if (n_valid == 0).any():
+        raise ValueError("Every row of the price matrix needs at least one seller.")
+
+    pick = (rng.random((n, n_rows)) * n_valid).astype(np.int64)
+    batchings = pm.sellers[pm.indptr[:-1] + pick].astype(np.int64)
+
+    gidx = pm.group_index()
+    for g in np.unique(gidx):
+        members, *_ = np.where(gidx == g)
+        if len(members) > 1:
+            keep = members[rng.integers(len(members), size=n)]
+            batchings[:, members] = np.where(members == keep[:, None], batchings[:, members], -1)
+
+    return batchings
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Splits a PriceMatrix into independent subproblems. Cards (metaproduct groups)
+and sellers form a bipartite graph with an edge per offer; cards in different
+connected components never share a seller, so each component can be solved on
+its own and the baskets put side by side without changing the optimum.
+
+Most sellers only have one or two of the cards, and those tail sellers are
+what usually ties a wantlist into one big component. With tail_size, sellers
+with at most that many cards are left out of the graph and split: each
+component gets its own copy of them. Once a seller has been split the
+stitched basket is no longer guaranteed optimal, and not even valid: merging
+the copies' letters can go over the most cards a seller can send, or into a
+dearer value bracket, and with price ladders the copies of its stock can be
+sold twice. The shared sellers are solved again together (see below), and a
+stitched basket that still doesn't fit is solved again for the cards bought
+from the overfilled sellers, and only as a whole if that fails.
+
+The parts' baskets are stitched by the copies bought per offer, so lists
+that want several copies of a card are split the same way.
+
+Components that are still too large are cut into parts of at most
+max_part_offers offers, keeping cards whose largest seller is the same
+together. The sellers they share are split the same way. After stitching,
+the cards bought from any split seller are solved once more together, with
+the rest of the basket fixed, so they can move between the parts' letters.
+
+A basket with split sellers isn't proven optimal. It comes with the
+simple_bound of the whole matrix, which is loose: on synthetic lists cut
+into a few parts the rejoined basket is typically within a percent of the
+optimum while the reported gap is 30-40%. Use tail_size=0 and no
+max_part_offers for exact components.
+"""
+
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from bounds import simple_bound
+from optimizer import Solution
+from shipping import max_cards, seller_shipping
+
+logger = logging.getLogger(__name__)
+
+# Small components are packed together until a subproblem has this many offers
+MIN_PART_OFFERS = 200
+# Times an overfilled stitched basket is solved again around the overfilled
+# sellers, taking in more of the basket every time, before it's solved as a whole
+REPAIR_ROUNDS = 3
+
+
+def components(pm, tail_size=0):
+    """
+    Component number per row, rows of the same metaproduct always share one.
+    Sellers with at most tail_size cards don't connect components. None
+    without scipy.
+    """
+    gidx = pm.group_index()
+    n_groups = gidx.max() + 1 if pm.n_rows else 0
+    if pm.n_offers == 0:
+        return gidx
+    try:
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+    except ImportError:
+        return None
+
+    rows, sellers, _ = pm.coo()
+    groups = gidx[rows]
+    if tail_size:
+        pairs = np.unique(groups.astype(np.int64) * pm.n_sellers + sellers)
+        n_cards = np.bincount(pairs % pm.n_sellers, minlength=pm.n_sellers)
+        core = n_cards[sellers] > tail_size
+        groups, sellers = groups[core], sellers[core]
+
+    n_nodes = n_groups + pm.n_sellers
+    graph = coo_matrix(
+        (np.ones(len(groups)), (groups, n_groups + sellers)), shape=(n_nodes, n_nodes)
+    )
+    _, labels = connected_components(graph, directed=False)
+    # Renumber so components are consecutive over the rows
+    _, row_labels = np.unique(labels[gidx], return_inverse=True)
+    return row_labels
+
+
+def _cut(pm, labels, max_offers):
+    """Split components with more than max_offers offers, by the largest seller of every card."""
+    gidx = pm.group_index()
+    n_groups = gidx.max() + 1
+    rows, sellers, _ = pm.coo()
+    groups = gidx[rows]
+    pairs = np.unique(groups.astype(np.int64) * pm.n_sellers + sellers)
+    n_cards = np.bincount(pairs % pm.n_sellers, minlength=pm.n_sellers)
+
+    # Anchor of a card: the seller with the most cards among its offers
+    order = np.lexsort((sellers, -n_cards[sellers], groups))
+    first = np.searchsorted(groups[order], np.arange(n_groups))
+    anchor = sellers[order][first]
+
+    group_label = np.zeros(n_groups, dtype=int)
+    group_label[gidx] = labels
+    group_offers = np.bincount(groups, minlength=n_groups)
+    label_offers = np.bincount(group_label, weights=group_offers)
+
+    chunk = np.zeros(n_groups, dtype=int)
+    for label in np.flatnonzero(label_offers > max_offers):
+        members = np.flatnonzero(group_label == label)
+        members = members[np.lexsort((members, anchor[members]))]
+        chunk[members] = np.cumsum(group_offers[members]) // max_offers
+    _, new_labels = np.unique(group_label * n_groups + chunk, return_inverse=True)
+    return new_labels[gidx]
+
+
+def split(pm, tail_size=0, min_offers=0, max_part_offers=None):
+    """
+    [(rows, seller columns, sub PriceMatrix)] per component, sellers
+    compacted. Components are packed together until a part has min_offers,
+    and cut up above max_part_offers.
+    """
+    labels = components(pm, tail_size)
+    if labels is None:
+        # Without scipy there are no components, and no _rejoin for a cut
+        return [(np.arange(pm.n_rows), np.arange(pm.n_sellers), pm)]
+    if max_part_offers and pm.n_offers > max_part_offers:
+        labels = _cut(pm, labels, max_part_offers)
+    n_labels = labels.max() + 1 if pm.n_rows else 0
+    offers = np.bincount(labels, weights=np.diff(pm.indptr), minlength=n_labels)
+
+    part_of = np.empty(n_labels, dtype=int)
+    part, size = 0, 0
+    for label in range(n_labels):
+        part_of[label] = part
+        size += offers[label]
+        if size >= min_offers:
+            part, size = part + 1, 0
+    row_parts = part_of[labels] if n_labels else labels
+
+    parts = []
+    for p in np.unique(row_parts):
+        rows, *_ = np.where(row_parts == p)
+        sub, cols = pm.select_rows(rows).compact_sellers()
+        parts.append((rows, cols, sub))
+    return parts
+
+
+def solve_by_components(
+    pm, solve, time_limit=None, tail_size=0, max_part_offers=None, workers=None, **kwargs
+):
+    """
+    Solve every component with solve(sub_matrix, time_limit=..., **kwargs) and
+    stitch the baskets together, in a process pool with workers > 1. The time
+    limit is shared out by number of offers, with at least a second per part.
+    """
+    min_offers = MIN_PART_OFFERS if tail_size or max_part_offers or (workers or 1) > 1 else 0
+    parts = split(pm, tail_size, min_offers, max_part_offers)
+    if len(parts) <= 1:
+        return solve(pm, time_limit=time_limit, **kwargs)
+
+    budgets = [None] * len(parts)
+    if time_limit:
+        budgets = [
+            max(time_limit * sub.n_offers / pm.n_offers, min(time_limit, 1.0)) for _, _, sub in parts
+        ]
+    if workers is not None and workers > 1:
+        with ProcessPoolExecutor(min(workers, len(parts))) as pool:
+            futures = [
+                pool.submit(solve, sub, time_limit=budget, **kwargs)
+                for (_, _, sub), budget in zip(parts, budgets)
+            ]
+            solutions = [future.result() for future in futures]
+    else:
+        solutions = [solve(sub, time_limit=budget, **kwargs) for (_, _, sub), budget in zip(parts, budgets)]
+
+    # Stitched by the copies bought per offer, which also holds a basket without quantities
+    amounts = np.zeros(pm.n_offers, dtype=np.int64)
+    n_parts = np.zeros(pm.n_sellers, dtype=int)
+    n_used = np.zeros(pm.n_sellers, dtype=int)
+    for (rows, cols, sub), solution in zip(parts, solutions):
+        sub_amounts = solution.amounts if solution.amounts is not None else sub.offer_amounts(solution.assignment)
+        bought = np.flatnonzero(sub_amounts)
+        amounts[pm.offer_index(rows[sub.rows[bought]], cols[sub.sellers[bought]])] = sub_amounts[bought]
+        n_parts[cols] += 1
+        n_used[np.unique(cols[sub.sellers[bought]])] += 1
+
+    shipping = kwargs.get("shipping")
+    # Optimality and bounds of the parts only carry over if no seller was split
+    independent = not (n_parts > 1).any()
+    if not independent:
+        amounts = _rejoin(pm, amounts, n_parts > 1, time_limit, shipping)
+    optimal = independent and all(s.optimal for s in solutions)
+    if independent and all(s.lower_bound is not None for s in solutions):
+        lower_bound = sum(s.lower_bound for s in solutions)
+    else:
+        lower_bound = simple_bound(pm, shipping=shipping)
+    logger.debug(f"Solved {len(parts)} parts of {pm.n_rows} cards, {int((n_parts > 1).sum())} sellers split")
+    solver = "+".join(sorted({s.solver for s in solutions}))
+    solution = _solution(pm, amounts, optimal=optimal, solver=solver, lower_bound=lower_bound, shipping=shipping)
+    if not np.isfinite(solution.total_cost):
+        # A split seller got more cards than it can send, or a stock more copies than it has
+        solution = _solution(
+            pm, _repair(pm, amounts, time_limit, shipping), optimal=optimal, solver=solver,
+            lower_bound=lower_bound, shipping=shipping,
+        )
+    if not np.isfinite(solution.total_cost):
+        logger.warning("The stitched basket doesn't fit in the sellers' letters, solving it as a whole")
+        return solve(pm, time_limit=time_limit, **kwargs)
+    return solution
+
+
+def _solution(pm, amounts, **kwargs):
+    """Solution of a basket given as the copies bought per offer."""
+    return Solution(pm.main_sellers(amounts), pm, amounts=amounts if pm.has_quantities else None, **kwargs)
+
+
+def resolve(pm, amounts, free_rows, time_limit=None, shipping=None):
+    """
+    The basket amounts (copies bought per offer) with the copies of free_rows
+    bought again by the MILP, the rest fixed and counted towards every
+    seller's shipping. free_rows should be closed over shared stock (see
+    PriceMatrix.stock_closure). Raises ImportError without scipy and
+    ValueError if there's no such basket.
+    """
+    from optimizer import solve_milp
+
+    free_offers = np.isin(pm.rows, free_rows)
+    fixed = np.where(free_offers, 0, amounts)
+    base_counts = np.bincount(pm.sellers, weights=fixed, minlength=pm.n_sellers)
+    base_values = np.bincount(
+        pm.sellers, weights=np.where(fixed > 0, pm.amount_cost(fixed), 0.0), minlength=pm.n_sellers
+    )
+    sub_pm = pm.select_rows(free_rows)
+    sub = solve_milp(
+        sub_pm, time_limit=time_limit, base_counts=base_counts, shipping=shipping, base_values=base_values
+    )
+    sub_amounts = sub.amounts if sub.amounts is not None else sub_pm.offer_amounts(sub.assignment)
+    bought = np.flatnonzero(sub_amounts)
+    resolved = fixed.copy()
+    resolved[pm.offer_index(free_rows[sub_pm.rows[bought]], sub_pm.sellers[bought])] = sub_amounts[bought]
+    return resolved
+
+
+def _fix_time(time_limit):
+    """Time limit for solving part of a stitched basket again."""
+    return min(time_limit / 4, 10.0) if time_limit else None
+
+
+def _rejoin(pm, amounts, shared, time_limit=None, shipping=None):
+    """
+    Re-solve the cards bought from the shared sellers together, the rest of the
+    basket fixed. Keeps the stitched basket if that's not possible or no
+    cheaper.
+    """
+    free = pm.stock_closure(pm.rows[(amounts > 0) & shared[pm.sellers]])
+    try:
+        rejoined = resolve(pm, amounts, np.flatnonzero(free), _fix_time(time_limit), shipping)
+    except (ImportError, ValueError) as err:
+        logger.debug(f"Kept the stitched basket: {err}")
+        return amounts
+
+    before, after = (_solution(pm, a, shipping=shipping).total_cost for a in (amounts, rejoined))
+    return rejoined if after <= before else amounts
+
+
+def _repair(pm, amounts, time_limit=None, shipping=None):
+    """
+    Fix a stitched basket that overfills a seller's letter or stock, by
+    solving again only the cards bought from there. When that has no
+    solution, the cards bought from any seller those cards have offers at
+    are added, a few times over. Returns the basket unchanged if that
+    doesn't help either.
+    """
+    counts = np.bincount(pm.sellers, weights=amounts, minlength=pm.n_sellers)
+    full = counts > max_cards(seller_shipping(shipping, pm.seller_ids))
+    oversold = (amounts > 0) & ~np.isfinite(pm.amount_cost(amounts))
+    free = pm.stock_closure(pm.rows[(amounts > 0) & (full[pm.sellers] | oversold)])
+    for _ in range(REPAIR_ROUNDS):
+        free_rows = np.flatnonzero(free)
+        try:
+            repaired = resolve(pm, amounts, free_rows, _fix_time(time_limit), shipping)
+        except ImportError:
+            return amounts
+        except ValueError:
+            repaired = None
+        if repaired is not None and np.isfinite(_solution(pm, repaired, shipping=shipping).total_cost):
+            logger.debug(f"Repaired the stitched basket by solving {len(free_rows)} of {pm.n_rows} rows again")
+            return repaired
+        near = np.zeros(pm.n_sellers, dtype=bool)
+        near[pm.sellers[free[pm.rows]]] = True
+        more = free | pm.stock_closure(pm.rows[(amounts > 0) & near[pm.sellers]])
+        if (more == free).all():
+            break
+        free = more
+    return amounts
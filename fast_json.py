@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+JSON decoding of API responses, with orjson when it's installed and the
+standard library otherwise.
+
+/articles responses are projected down to columns of the fields the buywizard
+uses while decoding, which makes them several times smaller to keep, cache
+and, when decoding runs in a process pool, to send back to the main process.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def project_articles(response):
+    """The fields of an /articles response the buywizard uses, as columns."""
+    articles = response.get("article", [])
+    return {
+        "article_columns": {
+            "idArticle": [art.get("idArticle", -1) for art in articles],
+            "price": [art["price"] for art in articles],
+            "count": [art.get("count", 1) for art in articles],
+            "condition": [art.get("condition") for art in articles],
+            "isFoil": [art.get("isFoil", False) for art in articles],
+            "idLanguage": [art["language"]["idLanguage"] for art in articles],
+            "idUser": [art["seller"]["idUser"] for art in articles],
+            "country": [art["seller"]["address"]["country"] for art in articles],
+        }
+    }
+
+
+# item_type: projection applied after decoding
+PROJECTIONS = {"articles": project_articles}
+
+
+def decode_response(item_type, data):
+    """Decode a response body, projected if item_type has a projection."""
+    response = loads(data)
+    project = PROJECTIONS.get(item_type)
+    return project(response) if project is not None else response
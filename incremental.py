@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Warm start for re-optimizing a wantlist after prices changed.
+
+The last PriceMatrix and basket are saved to a .npz file. On the next run the
+offers are diffed against the new matrix; cards whose offers changed, whose
+bought offer is gone, or that were bought from a seller with changed offers
+are re-optimized, with the rest of the previous basket kept as it was and
+counted towards every seller's shipping bracket.
+"""
+
+import logging
+import os
+
+import numpy as np
+
+from decomposition import resolve
+from metrics import timed
+from optimizer import Solution, optimize
+from price_matrix import PriceMatrix
+from pruning import prune
+
+logger = logging.getLogger(__name__)
+
+# Above this share of changed offers a cold solve is about as fast
+MAX_CHANGED_FRACTION = 0.2
+
+
+def basket_ids(pm, solution):
+    """The bought offers of solution as (prod_ids, metaprod_ids, seller_ids, copies bought)."""
+    amounts = solution.amounts if solution.amounts is not None else pm.offer_amounts(solution.assignment)
+    bought, *_ = np.where(amounts > 0)
+    rows = pm.rows[bought]
+    return pm.prod_ids[rows], pm.metaprod_ids[rows], pm.seller_ids[pm.sellers[bought]], amounts[bought]
+
+
+def save_state(path, pm, basket):
+    """Save the offers of pm, to diff the next run against, and basket from basket_ids."""
+    prod_ids, metaprod_ids, seller_ids, amounts = basket
+    ladder = {}
+    if pm.ladder is not None:
+        ladder = dict(zip(("ladder_ptr", "ladder_prices", "ladder_amounts"), pm.ladder))
+    np.savez_compressed(
+        path,
+        indptr=pm.indptr,
+        sellers=pm.sellers,
+        prices=pm.prices,
+        prod_ids=pm.prod_ids,
+        metaprod_ids=pm.metaprod_ids,
+        seller_ids=pm.seller_ids,
+        wanted=pm.wanted,
+        basket_prod_ids=prod_ids,
+        basket_metaprod_ids=metaprod_ids,
+        basket_seller_ids=seller_ids,
+        basket_amounts=amounts,
+        **ladder,
+    )
+
+
+def load_state(path):
+    """
+    (PriceMatrix, basket) from save_state, basket is (prod_ids, metaprod_ids,
+    seller_ids, copies bought). States saved before quantities were kept
+    bought one copy of every offer.
+    """
+    with np.load(path) as state:
+        ladder = None
+        if "ladder_ptr" in state.files:
+            ladder = (state["ladder_ptr"], state["ladder_prices"], state["ladder_amounts"])
+        pm = PriceMatrix(
+            state["indptr"], state["sellers"], state["prices"],
+            state["prod_ids"], state["metaprod_ids"], state["seller_ids"],
+            state["wanted"] if "wanted" in state.files else None, ladder,
+        )
+        seller_ids = state["basket_seller_ids"]
+        amounts = state["basket_amounts"] if "basket_amounts" in state.files else np.ones(len(seller_ids), dtype=int)
+        basket = (state["basket_prod_ids"], state["basket_metaprod_ids"], seller_ids, amounts)
+    return pm, basket
+
+
+def _offer_table(pm):
+    """(prod_ids, seller_ids, offer columns) per offer, the columns being its price, copies and stock value."""
+    rows, sellers, prices = pm.coo()
+    offers, tier_prices, copies = pm.tiers()
+    columns = np.stack([
+        prices,
+        pm.available(),
+        np.bincount(offers, weights=tier_prices * copies, minlength=pm.n_offers),
+    ])
+    if pm.ladder is None:
+        # Without stock the copies are the copies wanted, which don't change the offer
+        columns = columns[:1]
+    return pm.prod_ids[rows], pm.seller_ids[sellers], columns
+
+
+def diff_offers(old, new):
+    """
+    Offers that are new, removed, repriced or whose stock changed between two
+    matrices, as (prod_ids, seller_ids, old prices, new prices) with NaN for
+    a missing side.
+    """
+    old_prod, old_seller, old_columns = _offer_table(old)
+    new_prod, new_seller, new_columns = _offer_table(new)
+    prods = np.concatenate([old_prod, new_prod])
+    sellers = np.concatenate([old_seller, new_seller])
+    pairs, inverse = np.unique(np.stack([prods, sellers]), axis=1, return_inverse=True)
+    inverse = inverse.ravel()
+
+    # One matrix with stock and one without compare on their prices only
+    n_columns = min(len(old_columns), len(new_columns))
+    before = np.full((n_columns, pairs.shape[1]), np.nan)
+    after = np.full((n_columns, pairs.shape[1]), np.nan)
+    before[:, inverse[:len(old_prod)]] = old_columns[:n_columns]
+    after[:, inverse[len(old_prod):]] = new_columns[:n_columns]
+    same = (before == after) | (np.isnan(before) & np.isnan(after))
+    changed = ~same.all(axis=0)
+    return pairs[0][changed], pairs[1][changed], before[0][changed], after[0][changed]
+
+
+def map_basket(pm, basket):
+    """Copies of the previous basket bought per offer of pm, none where it no longer applies."""
+    prod_ids, metaprod_ids, seller_ids, copies = basket
+    amounts = np.zeros(pm.n_offers, dtype=np.int64)
+    row_of = {}
+    for row, (prod, meta) in enumerate(zip(pm.prod_ids, pm.metaprod_ids)):
+        row_of.setdefault((prod, meta if meta == meta else None), row)
+    col_of = {seller: col for col, seller in enumerate(pm.seller_ids)}
+    for prod, meta, seller, n in zip(prod_ids, metaprod_ids, seller_ids, copies):
+        row = row_of.get((prod, meta if meta == meta else None))
+        col = col_of.get(seller)
+        if row is not None and col is not None and np.isfinite(pm.lookup([row], [col])[0]):
+            amounts[pm.offer_index([row], [col])[0]] = n
+    return amounts
+
+
+@timed("reoptimize")
+def reoptimize(pm, basket, changes, time_limit=None, shipping=None):
+    """
+    Re-solve only the cards affected by changes (from diff_offers), keeping the
+    rest of the previous basket. Falls back to a cold solve without scipy.
+    """
+    changed_prods, changed_sellers, _, _ = changes
+    amounts = map_basket(pm, basket)
+    gidx = pm.group_index()
+    n_groups = gidx.max() + 1 if pm.n_rows else 0
+    demand = np.zeros(n_groups)
+    demand[gidx] = pm.wanted
+
+    settled = np.bincount(gidx[pm.rows], weights=amounts, minlength=n_groups) == demand
+    touched = np.zeros(n_groups, dtype=bool)
+    touched[gidx[np.isin(pm.prod_ids, changed_prods)]] = True
+    changed_cols = np.isin(pm.seller_ids, changed_sellers)
+    touched[gidx[pm.rows[(amounts > 0) & changed_cols[pm.sellers]]]] = True
+    affected = touched | ~settled
+
+    if affected.any():
+        try:
+            amounts = resolve(
+                pm, amounts, np.flatnonzero(pm.stock_closure(affected[gidx])), time_limit, shipping
+            )
+        except ImportError:
+            return optimize(pm, time_limit=time_limit, shipping=shipping)
+    return Solution(
+        pm.main_sellers(amounts), pm, optimal=False, solver="incremental" if affected.any() else "warm_start",
+        shipping=shipping, amounts=amounts if pm.has_quantities else None,
+    )
+
+
+def warm_solve(
+    price_mat, path, time_limit=None, method="auto", max_changed_fraction=MAX_CHANGED_FRACTION,
+    shipping=None, **options
+):
+    """
+    Like solve_wantlist, but re-optimizes from the state saved at path when
+    few offers changed since, and saves the new state there.
+    Returns (pruned PriceMatrix, prune report, Solution).
+    """
+    pruned, report = prune(price_mat, shipping)
+    solution = None
+    if os.path.exists(path):
+        old, basket = load_state(path)
+        changes = diff_offers(old, price_mat)
+        n_changed = len(changes[0])
+        if n_changed <= max_changed_fraction * max(price_mat.n_offers, 1):
+            logger.info(f"{n_changed} offers changed since the last run, re-optimizing")
+            solution = reoptimize(pruned, basket, changes, time_limit=time_limit, shipping=shipping)
+        else:
+            logger.info(f"{n_changed} offers changed since the last run, solving from scratch")
+    if solution is None:
+        solution = optimize(pruned, time_limit=time_limit, method=method, shipping=shipping, **options)
+    save_state(path, price_mat, basket_ids(pruned, solution))
+    return pruned, report, solution
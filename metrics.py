@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Instrumentation of a buywizard run: wall time per phase, requests, latency
+histograms and bytes per endpoint, retries and request quota used.
+
+Like logging, there is one process-wide instance, get_metrics(). Until
+enable_metrics() is called it is a NullMetrics whose methods do nothing, so
+instrumented code costs about one attribute lookup when metrics are off.
+"""
+
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from tabulate import tabulate
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+
+class Metrics:
+    enabled = True
+
+    def __init__(self):
+        self.phases = {}
+        self.requests = {}
+        self.counters = {}
+        self.quota = {"first": None, "last": None, "max": None}
+        self._stack = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Time a block, nested phases are recorded as parent/child."""
+        self._stack.append(name)
+        path = "/".join(self._stack)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(path, time.perf_counter() - started)
+            self._stack.pop()
+
+    def add_time(self, name, seconds):
+        """Add to a phase that isn't one block, like decoding spread over many requests."""
+        with self._lock:
+            phase = self.phases.setdefault(name, {"count": 0, "seconds": 0.0})
+            phase["count"] += 1
+            phase["seconds"] += seconds
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe_request(self, endpoint, latency, n_bytes=0, status=None):
+        with self._lock:
+            stats = self.requests.get(endpoint)
+            if stats is None:
+                stats = self.requests[endpoint] = {
+                    "count": 0,
+                    "bytes": 0,
+                    "seconds": 0.0,
+                    "status": {},
+                    "buckets": [0] * len(LATENCY_BUCKETS),
+                }
+            stats["count"] += 1
+            stats["bytes"] += n_bytes
+            stats["seconds"] += latency
+            key = str(status) if status is not None else "error"
+            stats["status"][key] = stats["status"].get(key, 0) + 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    stats["buckets"][i] += 1
+                    break
+
+    def update_quota(self, count, maximum):
+        with self._lock:
+            if self.quota["first"] is None:
+                # The count already includes the request that reported it
+                self.quota["first"] = count - 1
+            self.quota["last"], self.quota["max"] = count, maximum
+
+    @property
+    def quota_used(self):
+        if self.quota["first"] is None:
+            return None
+        return self.quota["last"] - self.quota["first"]
+
+    def to_dict(self):
+        return {
+            "phases": self.phases,
+            "requests": {
+                endpoint: {**stats, "bucket_bounds": [str(b) for b in LATENCY_BUCKETS]}
+                for endpoint, stats in self.requests.items()
+            },
+            "counters": self.counters,
+            "quota": {**self.quota, "used": self.quota_used},
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix="mkm"):
+        lines = [f"# TYPE {prefix}_phase_seconds_total counter"]
+        for name, phase in self.phases.items():
+            lines.append(f'{prefix}_phase_seconds_total{{phase="{name}"}} {phase["seconds"]}')
+
+        lines.append(f"# TYPE {prefix}_request_duration_seconds histogram")
+        for endpoint, stats in self.requests.items():
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS, stats["buckets"]):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else bound
+                lines.append(
+                    f'{prefix}_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{le}"}} {cumulative}'
+                )
+            lines.append(f'{prefix}_request_duration_seconds_sum{{endpoint="{endpoint}"}} {stats["seconds"]}')
+            lines.append(f'{prefix}_request_duration_seconds_count{{endpoint="{endpoint}"}} {stats["count"]}')
+
+        lines.append(f"# TYPE {prefix}_requests_total counter")
+        for endpoint, stats in self.requests.items():
+            for status, n in stats["status"].items():
+                lines.append(f'{prefix}_requests_total{{endpoint="{endpoint}",status="{status}"}} {n}')
+        lines.append(f"# TYPE {prefix}_response_bytes_total counter")
+        for endpoint, stats in self.requests.items():
+            lines.append(f'{prefix}_response_bytes_total{{endpoint="{endpoint}"}} {stats["bytes"]}')
+
+        for name, n in self.counters.items():
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {n}")
+        if self.quota_used is not None:
+            lines.append(f"# TYPE {prefix}_quota_used gauge")
+            lines.append(f"{prefix}_quota_used {self.quota_used}")
+            lines.append(f"# TYPE {prefix}_quota_max gauge")
+            lines.append(f"{prefix}_quota_max {self.quota['max']}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        """Write to path, as Prometheus text if it ends in .prom, JSON otherwise."""
+        with open(path, "w") as f:
+            f.write(self.to_prometheus() if str(path).endswith(".prom") else self.to_json())
+
+    def report(self):
+        phases = [
+            [name, phase["count"], f"{phase['seconds']:.3f}"]
+            for name, phase in self.phases.items()
+        ]
+        requests = []
+        for endpoint, stats in self.requests.items():
+            requests.append([
+                endpoint,
+                stats["count"],
+                f"{stats['seconds'] / stats['count']:.3f}",
+                f"{self._latency_quantile(stats, 0.95):g}",
+                f"{stats['bytes'] / 1024:.0f}",
+                ", ".join(f"{s}: {n}" for s, n in sorted(stats["status"].items())),
+            ])
+
+        parts = [
+            tabulate(phases, headers=["phase", "calls", "seconds"]),
+            tabulate(requests, headers=["endpoint", "requests", "mean s", "p95 <= s", "KiB", "status"]),
+        ]
+        extra = [f"{name}: {n}" for name, n in sorted(self.counters.items())]
+        if self.quota_used is not None:
+            extra.append(f"quota used: {self.quota_used} ({self.quota['last']}/{self.quota['max']})")
+        if extra:
+            parts.append(", ".join(extra))
+        return "\n\n".join(parts)
+
+    @staticmethod
+    def _latency_quantile(stats, q):
+        """Upper bound of the bucket holding the q quantile."""
+        target = q * stats["count"]
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS, stats["buckets"]):
+            cumulative += n
+            if cumulative >= target:
+                return bound
+        return LATENCY_BUCKETS[-1]
+
+
+_NULL_PHASE = nullcontext()
+
+
+class NullMetrics:
+    enabled = False
+
+    def phase(self, name):
+        return _NULL_PHASE
+
+    def add_time(self, name, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def observe_request(self, endpoint, latency, n_bytes=0, status=None):
+        pass
+
+    def update_quota(self, count, maximum):
+        pass
+
+
+_metrics = NullMetrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def enable_metrics():
+    """Start recording into a fresh Metrics, which is returned."""
+    global _metrics
+    _metrics = Metrics()
+    return _metrics
+
+
+def disable_metrics():
+    global _metrics
+    _metrics = NullMetrics()
+
+
+def timed(name):
+    """Decorator recording every call of the function as a phase."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _metrics.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,16 +1,38 @@
 #!/usr/bin/env python
 
 import argparse
+import json
+import sys
 
-from buywizard_app import BuywizardApp
+from buywizard_app import BuywizardApp, optimize_snapshot
 
 
 def main():
     parser = argparse.ArgumentParser(description="mkm_buywizard command line interface.")
-    parser = parser.add_argument("--config", default="config.json", help="Location of config.json")
+    parser.add_argument("--config", default="config.json", help="Location of config.json")
+    parser.add_argument(
+        "--wantlists", nargs="+", help="Wantlist numbers to optimize together, or all"
+    )
+    parser.add_argument(
+        "--combined", action="store_true", help="Buy the wantlists as one basket, sharing shipping"
+    )
+    parser.add_argument(
+        "--snapshot", help="Optimize a saved wantlist snapshot offline instead of fetching one"
+    )
+    args = parser.parse_args()
 
-    app = BuywizardApp()
-    app.start()
+    try:
+        with open(args.config, "r") as config_file:
+            config = json.load(config_file)
+    except FileNotFoundError:
+        sys.exit(f"{args.config} not found, copy config_template.json to it and populate the fields.")
+
+    if args.snapshot:
+        optimize_snapshot(args.snapshot, config)
+        return
+
+    app = BuywizardApp(config=config)
+    app.start(args)
 
 
 if __name__ == "__main__":
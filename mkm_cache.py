@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Persistent cache of Cardmarket API responses, so repeated runs don't spend the
+daily request quota on data that barely changed.
+
+Responses are stored in a local SQLite file keyed by item type, item id and the
+query parameters, each item type with its own time to live.
+"""
+
+import json
+import logging
+import sqlite3
+import time
+import zlib
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+class ResponseCache:
+    # Card data hardly ever changes, prices do
+    default_ttls = {
+        "metaproducts": 7 * DAY,
+        "products": 7 * DAY,
+        "articles": HOUR,
+    }
+
+    def __init__(self, path="mkm_cache.sqlite", ttls=None, default_ttl=HOUR, max_size_mb=200):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.ttls = {**self.default_ttls, **(ttls or {})}
+        self.default_ttl = default_ttl
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.hits = {}
+        self.misses = {}
+
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " item_type TEXT NOT NULL,"
+            " item_key TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " accessed REAL NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " body BLOB NOT NULL,"
+            " PRIMARY KEY (item_type, item_key))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.db.commit()
+
+    @classmethod
+    def from_config(cls, config):
+        # Opt-in with "cache": {"enabled": true}, it writes a file next to the config
+        cache_config = config.get("cache", {})
+        if not cache_config.get("enabled", False):
+            return None
+        return cls(
+            path=cache_config.get("path", "mkm_cache.sqlite"),
+            ttls=cache_config.get("ttl"),
+            max_size_mb=cache_config.get("max_size_mb", 200),
+        )
+
+    @staticmethod
+    def item_key(item_id, params=None):
+        return json.dumps([item_id, params or {}], sort_keys=True, default=str)
+
+    def ttl(self, item_type):
+        return self.ttls.get(item_type, self.default_ttl)
+
+    def get_many(self, item_type, item_id_list, params=None):
+        """Return {item_id: response} for the ids with a fresh cache entry."""
+        now = time.time()
+        oldest = now - self.ttl(item_type)
+        keys = {self.item_key(item_id, params): item_id for item_id in item_id_list}
+
+        found = {}
+        key_list = list(keys)
+        # Stay below SQLite's limit on the number of query parameters
+        for i in range(0, len(key_list), 500):
+            chunk = key_list[i : i + 500]
+            rows = self.db.execute(
+                f"SELECT item_key, body FROM responses WHERE item_type = ? AND created >= ?"
+                f" AND item_key IN ({','.join('?' * len(chunk))})",
+                [item_type, oldest, *chunk],
+            ).fetchall()
+            for key, body in rows:
+                found[keys[key]] = json.loads(zlib.decompress(body))
+
+        if found:
+            self.db.executemany(
+                "UPDATE responses SET accessed = ? WHERE item_type = ? AND item_key = ?",
+                [(now, item_type, self.item_key(item_id, params)) for item_id in found],
+            )
+            self.db.commit()
+
+        self.hits[item_type] = self.hits.get(item_type, 0) + len(found)
+        self.misses[item_type] = self.misses.get(item_type, 0) + len(keys) - len(found)
+        return found
+
+    def set_many(self, item_type, responses, params=None):
+        """Store {item_id: response}, None responses (failed requests) are skipped."""
+        now = time.time()
+        rows = []
+        for item_id, response in responses.items():
+            if response is None:
+                continue
+            body = zlib.compress(json.dumps(response).encode("utf-8"))
+            rows.append((item_type, self.item_key(item_id, params), now, now, len(body), body))
+
+        self.db.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.db.commit()
+        self.evict()
+
+    def evict(self):
+        """Drop expired entries, then least recently used ones until under max_size_mb."""
+        now = time.time()
+        item_types = [row[0] for row in self.db.execute("SELECT DISTINCT item_type FROM responses")]
+        for item_type in item_types:
+            self.db.execute(
+                "DELETE FROM responses WHERE item_type = ? AND created < ?",
+                (item_type, now - self.ttl(item_type)),
+            )
+
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total > self.max_bytes:
+            excess = total - self.max_bytes
+            freed = 0
+            victims = []
+            for item_type, item_key, size in self.db.execute(
+                "SELECT item_type, item_key, size FROM responses ORDER BY accessed"
+            ):
+                victims.append((item_type, item_key))
+                freed += size
+                if freed >= excess:
+                    break
+            self.db.executemany(
+                "DELETE FROM responses WHERE item_type = ? AND item_key = ?", victims
+            )
+            self.logger.debug(f">> Cache evicted {len(victims)} entries ({freed} bytes)")
+        self.db.commit()
+
+    def clear(self):
+        self.db.execute("DELETE FROM responses")
+        self.db.commit()
+
+    def stats(self):
+        item_types = sorted(set(self.hits) | set(self.misses))
+        return {
+            item_type: {
+                "hits": self.hits.get(item_type, 0),
+                "misses": self.misses.get(item_type, 0),
+            }
+            for item_type in item_types
+        }
+
+    def summary(self):
+        parts = [f"{t}: {s['hits']} hits/{s['misses']} misses" for t, s in self.stats().items()]
+        saved = sum(self.hits.values())
+        return f"Cache saved {saved} requests ({', '.join(parts)})"
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Parallel multi-start annealing.
+
+Annealing chains with different seeds are independent, so they run in a
+ProcessPoolExecutor and the cheapest basket wins. The offers are put in one
+shared memory block that the workers map, instead of pickling the matrix to
+every one of them; only the seed goes in and the assignment comes back.
+
+Chain i is seeded with the i-th child of SeedSequence(seed) and runs a fixed
+number of moves, so the result only depends on the seed and the number of
+chains (by default the number of workers), not on how the chains are scheduled.
+
+With quantities the copies wanted and the price ladders are shared too, and a
+chain sends back the copies bought per offer.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from metrics import timed
+from optimizer import Solution, solve_annealing
+from price_matrix import PriceMatrix, as_price_matrix
+
+# Moves per chain, about a second per chain on a laptop
+DEFAULT_MOVES = 2_000_000
+# Arrays the workers need to rebuild the matrix, seller ids for the shipping
+# lookups. Product ids only tell which rows share stock, so a code per product
+# will do.
+SHARED_FIELDS = ("indptr", "sellers", "prices", "metaprod_ids", "seller_ids", "wanted", "prod_codes")
+# The price ladders, when the matrix has them
+LADDER_FIELDS = ("ladder_ptr", "ladder_prices", "ladder_amounts")
+
+# The matrix mapped in a worker process, set by _attach
+_worker = {}
+
+
+def share(pm):
+    """Copy the arrays of pm into shared memory, returns (SharedMemory, layout)."""
+    _, prod_codes = np.unique(pm.prod_ids, return_inverse=True)
+    fields = {
+        **{field: getattr(pm, field) for field in SHARED_FIELDS[:-1]},
+        "prod_codes": prod_codes.ravel().astype(np.int64),
+    }
+    if pm.ladder is not None:
+        fields.update(zip(LADDER_FIELDS, pm.ladder))
+    size = sum(a.nbytes for a in fields.values())
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    layout, offset = [], 0
+    for field, a in fields.items():
+        np.ndarray(a.shape, a.dtype, buffer=shm.buf, offset=offset)[:] = a
+        layout.append((field, a.dtype.str, a.shape, offset))
+        offset += a.nbytes
+    return shm, layout
+
+
+def _attach(name, layout, shipping):
+    shm = shared_memory.SharedMemory(name=name)
+    arrays = {
+        field: np.ndarray(shape, dtype, buffer=shm.buf, offset=offset)
+        for field, dtype, shape, offset in layout
+    }
+    ladder = tuple(arrays[field] for field in LADDER_FIELDS) if LADDER_FIELDS[0] in arrays else None
+    _worker["shm"] = shm
+    _worker["shipping"] = shipping
+    _worker["pm"] = PriceMatrix(
+        arrays["indptr"], arrays["sellers"], arrays["prices"],
+        arrays["prod_codes"], arrays["metaprod_ids"], arrays["seller_ids"], arrays["wanted"], ladder,
+    )
+
+
+def _run_chain(seed, moves, time_limit, target_cost):
+    solution = solve_annealing(
+        _worker["pm"], time_limit=time_limit, rng=seed, max_moves=moves, target_cost=target_cost,
+        shipping=_worker["shipping"],
+    )
+    return solution.assignment, solution.amounts, solution.total_cost
+
+
+@timed("multistart")
+def solve_multistart(price_mat, groups=None, time_limit=None, chains=None, workers=None,
+                     seed=0, moves=DEFAULT_MOVES, target_cost=None, shipping=None):
+    """
+    Best basket of `chains` annealing runs over `workers` processes (both
+    default to the number of CPUs). time_limit caps every chain, a chain that
+    hits it makes the result depend on timing. Chains stop early once they
+    find a basket of at most target_cost.
+    """
+    pm = as_price_matrix(price_mat, groups)
+    workers = workers or os.cpu_count() or 1
+    chains = chains or workers
+    seeds = np.random.SeedSequence(seed).spawn(chains)
+
+    shm, layout = share(pm)
+    try:
+        with ProcessPoolExecutor(workers, initializer=_attach, initargs=(shm.name, layout, shipping)) as pool:
+            results = list(pool.map(
+                _run_chain, seeds, [moves] * chains, [time_limit] * chains, [target_cost] * chains
+            ))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    # min keeps the first chain on ties, so the order of completion doesn't matter
+    assignment, amounts, _ = min(results, key=lambda result: result[2])
+    return Solution(assignment, pm, optimal=False, solver="multistart", shipping=shipping, amounts=amounts)
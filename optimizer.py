@@ -0,0 +1,904 @@
+#!/usr/bin/env python3
+"""
+Optimization engine for finding the cheapest way to buy a wantlist.
+
+The input is a PriceMatrix with one row per (metaprod_id, prod_id) and one
+column per seller (dense arrays with np.inf for missing offers are converted).
+Rows that share a metaproduct are alternative printings of the same card, so
+exactly one of them is bought. Rows without a metaproduct (NaN) are always bought.
+
+When cards are wanted more than once (PriceMatrix.wanted), or a product is in
+several rows that share its sellers' stock (combined baskets), a basket is the
+number of copies bought per offer instead, split over sellers and printings
+as needed and limited by every seller's stock. The MILP has a variable per
+price ladder tier, the other solvers treat every copy wanted as a card of its
+own that buys the cheapest copy its offer's stock has left.
+"""
+
+import logging
+import time
+from bisect import bisect_right
+
+import numpy as np
+
+from costs import evaluate_amounts, evaluate_batchings
+from metrics import get_metrics, timed
+from price_matrix import as_price_matrix
+from shipping import count_brackets, has_value_brackets, seller_shipping, value_tables
+
+logger = logging.getLogger(__name__)
+
+# Moves drawn per batch of random numbers, and the share of them that are swaps
+ANNEAL_BATCH = 4096
+SWAP_PROBABILITY = 0.2
+# HiGHS' default relative gap, below it a MILP basket counts as optimal
+MILP_GAP = 1e-4
+# Below a value bracket means at least this much below, prices are in cents
+VALUE_EPS = 1e-3
+# Share of a heuristic's time limit that goes to the LP lower bound, when asked for
+LP_BOUND_SHARE = 0.25
+# Time limit of the branch and bound standing in for the MILP without scipy
+FALLBACK_TIME_LIMIT = 10.0
+
+
+class Solution:
+    def __init__(
+        self, assignment, price_mat, optimal=False, solver=None, lower_bound=None, shipping=None, amounts=None
+    ):
+        # Seller column per row, -1 for printings that aren't bought. With
+        # amounts, the seller most of the row's copies come from.
+        self.assignment = np.asarray(assignment, dtype=int)
+        # Copies bought per offer, when cards are wanted more than once
+        self.amounts = None if amounts is None else np.asarray(amounts, dtype=np.int64)
+        self.optimal = optimal
+        self.solver = solver
+        # Proven lower bound on the cheapest basket, None if there is none
+        self.lower_bound = lower_bound
+
+        if self.amounts is not None:
+            pm = as_price_matrix(price_mat)
+            article, ship_cost, _ = evaluate_amounts(self.amounts, pm, shipping=shipping)
+            self.n_sellers = len(np.unique(pm.sellers[self.amounts > 0]))
+        else:
+            article, ship_cost, _ = evaluate_batchings(self.assignment, price_mat, shipping=shipping)
+            self.n_sellers = len(np.unique(self.assignment[self.assignment >= 0]))
+        self.article_cost = float(article[0])
+        self.shipping_cost = float(ship_cost[0])
+
+    @property
+    def total_cost(self):
+        return self.article_cost + self.shipping_cost
+
+    @property
+    def gap(self):
+        """Relative distance to the lower bound, at least how far from optimal this could be."""
+        if self.optimal:
+            return 0.0
+        if self.lower_bound is None or not self.total_cost:
+            return None
+        return max(0.0, (self.total_cost - self.lower_bound) / self.total_cost)
+
+    def __repr__(self):
+        gap = f"{self.gap:.2%}" if self.gap is not None else None
+        return (
+            f"Solution(total={self.total_cost:.2f}, articles={self.article_cost:.2f}, "
+            f"shipping={self.shipping_cost:.2f}, sellers={self.n_sellers}, "
+            f"optimal={self.optimal}, gap={gap}, solver={self.solver})"
+        )
+
+
+def _milp_model(pm, base_counts=None, linking=False, shipping=None, base_values=None):
+    """
+    Objective, constraint matrix and bounds, variable upper bounds of the
+    integer program in solve_milp, plus the offer of every x variable. linking
+    adds x <= copies * sum(y of seller), which doesn't change the integer
+    optimum but makes the LP relaxation a lot tighter.
+
+    With quantities there is an x per tier of the price ladders, counting the
+    copies bought at that price, and a product that is in several rows shares
+    the stock of its sellers between them.
+
+    With value brackets in shipping there is a y per count and value bracket,
+    and the seller's basket value (plus base_values) has to lie in the value
+    bracket of its y.
+    """
+    from scipy.sparse import coo_matrix
+
+    gidx = pm.group_index()
+    n_groups = gidx.max() + 1 if pm.n_rows else 0
+    demand = np.ones(n_groups)
+
+    if pm.has_quantities:
+        offers, prices, copies = pm.tiers()
+        demand[gidx] = pm.wanted
+    else:
+        offers, prices, copies = np.arange(pm.n_offers), pm.prices, np.ones(pm.n_offers, dtype=np.int64)
+    rows, sellers = pm.rows[offers], pm.sellers[offers]
+    used_sellers, seller_pos = np.unique(sellers, return_inverse=True)
+    # A y per (seller, value bracket, count bracket), value brackets of all sellers stacked
+    tables = value_tables(shipping, pm.seller_ids[used_sellers])
+    n_values, n_sel = tables.shape[:2]
+    caps, costs = count_brackets(tables.reshape(n_values * n_sel, -1))
+    costs = costs.reshape(n_values, n_sel, -1).transpose(1, 0, 2)
+    n_off, n_brackets = len(rows), n_values * len(caps)
+    # Brackets a seller can't ship are fixed to 0
+    feasible = np.isfinite(costs).ravel()
+    y_cols = n_off + np.arange(n_sel * n_brackets)
+    y_seller = np.repeat(np.arange(n_sel), n_brackets)
+
+    # Group, capacity and single bracket constraints stacked in one sparse matrix
+    data = [
+        np.ones(n_off), np.ones(n_off), -np.tile(caps.astype(float), n_sel * n_values), np.ones(n_sel * n_brackets)
+    ]
+    row_ind = [gidx[rows], n_groups + seller_pos, n_groups + y_seller, n_groups + n_sel + y_seller]
+    col_ind = [np.arange(n_off), np.arange(n_off), y_cols, y_cols]
+    n_cons = n_groups + 2 * n_sel
+    base = np.zeros(n_sel) if base_counts is None else -np.asarray(base_counts)[used_sellers]
+    lb = [demand, np.full(2 * n_sel, -np.inf)]
+    ub = [demand, base, np.ones(n_sel)]
+
+    if n_values > 1:
+        # The value of a seller's letter lies within its value bracket:
+        # low * sum(y) <= base value + sum(price * x) <= high * sum(y)
+        base_value = np.zeros(n_sel) if base_values is None else np.asarray(base_values)[used_sellers]
+        most = np.bincount(seller_pos, weights=prices * copies, minlength=n_sel) + base_value + 1.0
+        starts = shipping.value_starts
+        low = np.tile(np.repeat(starts, len(caps)), n_sel)
+        high = np.repeat(np.r_[starts[1:] - VALUE_EPS, np.inf], len(caps))
+        high = np.minimum(high[None, :], most[:, None]).ravel()
+        for bound, sign in ((low, -1.0), (high, 1.0)):
+            data += [sign * prices, -sign * bound]
+            row_ind += [n_cons + seller_pos, n_cons + y_seller]
+            col_ind += [np.arange(n_off), y_cols]
+            lb.append(np.full(n_sel, -np.inf))
+            ub.append(-sign * base_value)
+            n_cons += n_sel
+
+    if pm.shares_stock:
+        # The same tier of a (product, seller) in several rows: one stock
+        _, prod_code = np.unique(pm.prod_ids[rows], return_inverse=True)
+        rank = np.arange(n_off) - pm.ladder[0][offers]
+        _, stock, n_rows = np.unique(
+            np.stack([prod_code, sellers, rank]), axis=1, return_inverse=True, return_counts=True
+        )
+        stock = stock.ravel()
+        shared = np.flatnonzero(n_rows[stock] > 1)
+        if len(shared):
+            _, stock_rows = np.unique(stock[shared], return_inverse=True)
+            stock_rows = n_cons + stock_rows.ravel()
+            n_stock = stock_rows.max() - n_cons + 1
+            stock_copies = np.zeros(n_stock)
+            stock_copies[stock_rows - n_cons] = copies[shared]
+            data.append(np.ones(len(shared)))
+            row_ind.append(stock_rows)
+            col_ind.append(shared)
+            lb.append(np.full(n_stock, -np.inf))
+            ub.append(stock_copies)
+            n_cons += n_stock
+
+    if linking:
+        # One row per offer: x - copies * sum(y of its seller) <= 0
+        offer_rows = n_cons + np.arange(n_off)
+        y_of_offer = n_off + seller_pos[:, None] * n_brackets + np.arange(n_brackets)
+        data += [np.ones(n_off), -np.repeat(copies.astype(float), n_brackets)]
+        row_ind += [offer_rows, np.repeat(offer_rows, n_brackets)]
+        col_ind += [np.arange(n_off), y_of_offer.ravel()]
+        lb.append(np.full(n_off, -np.inf))
+        ub.append(np.zeros(n_off))
+        n_cons += n_off
+
+    A = coo_matrix(
+        (np.concatenate(data), (np.concatenate(row_ind), np.concatenate(col_ind))),
+        shape=(n_cons, n_off + n_sel * n_brackets),
+    ).tocsr()
+    c = np.concatenate([prices, np.where(feasible, costs.ravel(), 0.0)])
+    var_ub = np.concatenate([copies.astype(float), feasible.astype(float)])
+    return c, A, np.concatenate(lb), np.concatenate(ub), var_ub, offers
+
+
+@timed("milp")
+def solve_milp(
+    price_mat, groups=None, time_limit=None, base_counts=None, gap=None, shipping=None, base_values=None
+):
+    """
+    Integer program over offer variables x[row, seller] and bracket variables
+    y[seller, bracket]:
+
+        min   sum(price * x) + sum(bracket_cost * y)
+        s.t.  sum(x over the rows of a group)   == wanted   for every group
+              sum(x of seller) - sum(cap * y)   <= -base    for every seller
+              sum(y of seller)                  <= 1        for every seller
+
+    x is 0/1 per offer, or with quantities the copies bought per price
+    ladder tier, at most what the tier has. With value brackets, y is per
+    seller, count bracket and value bracket (see _milp_model).
+
+    base_counts (per seller column, default 0) are cards already bought from
+    a seller outside this problem, they count towards its shipping bracket,
+    and base_values their value towards its value bracket.
+    With gap the solver stops once its basket is within that fraction of the
+    optimum.
+    """
+    from scipy.optimize import Bounds, LinearConstraint, milp
+
+    pm = as_price_matrix(price_mat, groups)
+    c, A, lb, ub, var_ub, offers = _milp_model(pm, base_counts, shipping=shipping, base_values=base_values)
+
+    options = {"time_limit": time_limit} if time_limit else {}
+    if gap is not None:
+        options["mip_rel_gap"] = gap
+    res = milp(
+        c,
+        integrality=np.ones(A.shape[1]),
+        bounds=Bounds(0, var_ub),
+        constraints=LinearConstraint(A, lb, ub),
+        options=options,
+    )
+    if res.x is None:
+        raise ValueError(f"No feasible basket found: {res.message}")
+
+    bought = np.bincount(offers, weights=np.round(res.x[:len(offers)]), minlength=pm.n_offers).astype(np.int64)
+    amounts = bought if pm.has_quantities else None
+    lower_bound = getattr(res, "mip_dual_bound", None)
+    optimal = res.status == 0 and (getattr(res, "mip_gap", 0.0) or 0.0) <= MILP_GAP
+    return Solution(
+        pm.main_sellers(bought), pm, optimal=optimal, solver="milp", lower_bound=lower_bound,
+        shipping=shipping, amounts=amounts,
+    )
+
+
+def _group_options(pm):
+    """Offers (rows, sellers, prices) per group, cheapest first."""
+    gidx = pm.group_index()
+    n_groups = gidx.max() + 1 if pm.n_rows else 0
+
+    rows, sellers, prices = pm.coo()
+    order = np.lexsort((prices, gidx[rows]))
+    rows, sellers, prices = rows[order], sellers[order], prices[order]
+    bounds = np.searchsorted(gidx[rows], np.arange(n_groups + 1))
+
+    options = []
+    for g in range(n_groups):
+        lo, hi = bounds[g], bounds[g + 1]
+        if lo == hi:
+            raise ValueError("No feasible basket found: a card has no sellers.")
+        options.append((rows[lo:hi], sellers[lo:hi], prices[lo:hi]))
+    return options
+
+
+def _letter_deltas(ship, shipping, seller_ids, sellers, counts, values, prices):
+    """
+    Extra shipping of adding a card at prices to the letters of sellers, which
+    hold counts cards worth values. ship is the shipping by number of cards
+    per seller, shipping the ShippingTable when letters depend on their value.
+    """
+    with np.errstate(invalid="ignore"):
+        if has_value_brackets(shipping):
+            deltas = shipping.delta(seller_ids[sellers], counts, values, 1, prices)
+        else:
+            deltas = ship[sellers, counts + 1] - ship[sellers, counts]
+    # A letter that is already over its cap stays impossible
+    return np.where(np.isnan(deltas), np.inf, deltas)
+
+
+def _greedy(options, n_rows, n_sellers, ship, shipping=None, seller_ids=None):
+    """
+    Add cards one at a time to the seller with the cheapest marginal cost,
+    ship being the shipping by number of cards per seller.
+    """
+    counts = np.zeros(n_sellers, dtype=int)
+    values = np.zeros(n_sellers)
+    assignment = np.full(n_rows, -1)
+    choice = np.zeros(len(options), dtype=int)
+    cost = 0.0
+    for g, (opt_rows, opt_sellers, opt_prices) in enumerate(options):
+        deltas = opt_prices + _letter_deltas(
+            ship, shipping, seller_ids, opt_sellers, counts[opt_sellers], values[opt_sellers], opt_prices
+        )
+        i = np.argmin(deltas)
+        counts[opt_sellers[i]] += 1
+        values[opt_sellers[i]] += opt_prices[i]
+        assignment[opt_rows[i]] = opt_sellers[i]
+        choice[g] = i
+        cost += deltas[i]
+    return assignment, cost, choice
+
+
+def _copy_options(pm):
+    """
+    The offers of every group as copies to buy, (options, demand, units).
+    options[g] is (offers, sellers, stock) of group g, cheapest first, stock
+    being what every offer sells from: with quantities and price ladders its
+    (product, seller) pair, which the rows of a product share, else the offer
+    itself. demand[g] is the copies group g wants and units[k] the price of
+    every copy of stock k, cheapest first and padded with np.inf.
+    """
+    gidx = pm.group_index()
+    n_groups = gidx.max() + 1 if pm.n_rows else 0
+    demand = np.ones(n_groups, dtype=np.int64)
+    if pm.has_quantities:
+        demand[gidx] = pm.wanted
+    offer_demand = demand[gidx[pm.rows]]
+
+    if pm.has_quantities and pm.ladder is not None:
+        _, prod_code = np.unique(pm.prod_ids, return_inverse=True)
+        pairs = prod_code.ravel()[pm.rows].astype(np.int64) * pm.n_sellers + pm.sellers
+        _, first, stock = np.unique(pairs, return_index=True, return_inverse=True)
+        stock = stock.ravel()
+        # A stock never sells more copies than all the rows it's in want
+        cap = np.minimum(np.bincount(stock, weights=offer_demand).astype(np.int64), pm.available()[first])
+        ptr, prices, amounts = pm.select_ladder(first)
+        tier_stock = np.repeat(np.arange(len(first)), np.diff(ptr))
+        before = np.cumsum(amounts) - amounts
+        before -= before[ptr[:-1]][tier_stock]
+        copies = np.clip(cap[tier_stock] - before, 0, amounts)
+        unit_stock, unit_prices = np.repeat(tier_stock, copies), np.repeat(prices, copies)
+    else:
+        stock, cap = np.arange(pm.n_offers), offer_demand
+        unit_stock, unit_prices = np.repeat(stock, cap), np.repeat(pm.prices, cap)
+    starts = np.cumsum(cap) - cap
+    units = np.full((len(cap), cap.max(initial=0) + 1), np.inf)
+    units[unit_stock, np.arange(len(unit_stock)) - starts[unit_stock]] = unit_prices
+
+    order = np.lexsort((units[stock, 0], gidx[pm.rows]))
+    bounds = np.searchsorted(gidx[pm.rows][order], np.arange(n_groups + 1))
+    options = []
+    for g in range(n_groups):
+        offers = order[bounds[g]:bounds[g + 1]]
+        if len(offers) == 0:
+            raise ValueError("No feasible basket found: a card has no sellers.")
+        options.append((offers, pm.sellers[offers], stock[offers]))
+    return options, demand, units
+
+
+def _greedy_copies(options, demand, units, n_sellers, ship, shipping=None, seller_ids=None):
+    """
+    _greedy for copies: every copy wanted in turn goes to the offer with the
+    cheapest next copy plus extra shipping. Returns (choice, cost), choice
+    holding the option of every copy, the copies of a group next to each other.
+    """
+    counts = np.zeros(n_sellers, dtype=int)
+    values = np.zeros(n_sellers)
+    taken = np.zeros(len(units), dtype=int)
+    last = units.shape[1] - 1
+    choice = []
+    cost = 0.0
+    for g, (_, sellers, stock) in enumerate(options):
+        for _ in range(demand[g]):
+            prices = units[stock, np.minimum(taken[stock], last)]
+            deltas = prices + _letter_deltas(
+                ship, shipping, seller_ids, sellers, counts[sellers], values[sellers], prices
+            )
+            i = int(np.argmin(deltas))
+            taken[stock[i]] += 1
+            counts[sellers[i]] += 1
+            values[sellers[i]] += prices[i]
+            choice.append(i)
+            cost += deltas[i]
+    return np.array(choice, dtype=int), cost
+
+
+def _copy_amounts(options, slot_group, choice, n_offers):
+    """Copies bought per offer, for the option picked by every copy."""
+    offers = [options[g][0][i] for g, i in zip(slot_group, choice)]
+    return np.bincount(np.array(offers, dtype=np.int64), minlength=n_offers).astype(np.int64)
+
+
+def _grows_with_value(shipping, seller_ids):
+    """Whether no letter gets cheaper when a card makes it worth more."""
+    if not has_value_brackets(shipping):
+        return True
+    tables = value_tables(shipping, seller_ids)[..., :-1]
+    return bool((np.diff(tables, axis=0) >= 0).all())
+
+
+class _Stop(Exception):
+    pass
+
+
+@timed("branch_and_bound")
+def solve_branch_and_bound(price_mat, groups=None, time_limit=None, target_cost=None, shipping=None):
+    """
+    Depth first branch and bound, used when scipy isn't available. Returns the
+    best basket found so far if the time limit runs out or a basket of at most
+    target_cost is found (optimal=False). With quantities it branches on every
+    copy wanted, the copies of a card going through its offers in order so
+    the same split isn't tried twice.
+    """
+    pm = as_price_matrix(price_mat, groups)
+    n_sellers = pm.n_sellers
+    options, demand, units = _copy_options(pm)
+    n_groups = len(options)
+    last = units.shape[1] - 1
+
+    ship = seller_shipping(shipping, pm.seller_ids)
+    # Cheapest possible shipping per card, whatever seller and bracket
+    cheapest = seller_shipping(shipping, pm.seller_ids, value=None)
+    per_card = cheapest[:, 1:] / np.arange(1, ship.shape[1])
+    rate = per_card[np.isfinite(per_card)].min()
+
+    # Most constrained groups first, then every copy of a group in turn
+    order = sorted(range(n_groups), key=lambda g: len(options[g][0]))
+    options = [options[g] for g in order]
+    demand = demand[order]
+    slot_group = np.repeat(np.arange(n_groups), demand)
+    group_end = np.cumsum(demand)
+    n_slots = len(slot_group)
+
+    # One copy per card: every offer costs its price, no need to look up stock
+    single = not pm.has_quantities
+    opt_prices = [units[o[2], 0] for o in options]
+
+    # Offers of the groups from g onwards, for the vectorized bound
+    suffix = []
+    for g in range(n_groups):
+        rest = options[g:]
+        starts = np.cumsum([0] + [len(o[0]) for o in rest[:-1]])
+        suffix.append((
+            np.concatenate([o[1] for o in rest]),
+            np.concatenate([o[2] for o in rest]),
+            np.concatenate(opt_prices[g:]),
+            starts,
+        ))
+
+    # Greedy incumbent so pruning has something to work with from the start
+    greedy_choice, greedy_cost = _greedy_copies(options, demand, units, n_sellers, ship, shipping, pm.seller_ids)
+    best = {"cost": greedy_cost, "choice": greedy_choice}
+    if not np.isfinite(greedy_cost):
+        best = {"cost": np.inf, "choice": None}
+
+    counts = np.zeros(n_sellers, dtype=int)
+    values = np.zeros(n_sellers)
+    taken = np.zeros(len(units), dtype=int)
+    current = np.zeros(n_slots, dtype=int)
+    deadline = time.monotonic() + time_limit if time_limit else None
+
+    def lower_bound(depth):
+        if depth == n_slots:
+            return 0.0
+        g = slot_group[depth]
+        sel, stock, price, starts = suffix[g]
+        if single:
+            return np.minimum.reduceat(price + rate * (counts[sel] == 0), starts).sum()
+        # Copies of a stock only get dearer, and a new letter costs at least rate per card
+        effective = units[stock, np.minimum(taken[stock], last)] + rate * (counts[sel] == 0)
+        copies = demand[g:].astype(float)
+        copies[0] = group_end[g] - depth
+        return np.minimum.reduceat(effective, starts) @ copies
+
+    def search(depth, cost):
+        if deadline is not None and time.monotonic() > deadline:
+            raise _Stop()
+        if target_cost is not None and best["cost"] <= target_cost:
+            raise _Stop()
+        if depth == n_slots:
+            if cost < best["cost"]:
+                best["cost"], best["choice"] = cost, current.copy()
+            return
+        if cost + lower_bound(depth) >= best["cost"] - 1e-9:
+            return
+
+        g = slot_group[depth]
+        _, opt_sellers, opt_stock = options[g]
+        # The copies of a group take their options in order
+        first = current[depth - 1] if depth > 0 and slot_group[depth - 1] == g else 0
+        prices = opt_prices[g] if single else units[opt_stock, np.minimum(taken[opt_stock], last)]
+        deltas = prices + _letter_deltas(
+            ship, shipping, pm.seller_ids, opt_sellers, counts[opt_sellers], values[opt_sellers], prices
+        )
+        for i in np.argsort(deltas, kind="stable"):
+            if not np.isfinite(deltas[i]):
+                break
+            if i < first:
+                continue
+            seller, stock = opt_sellers[i], opt_stock[i]
+            counts[seller] += 1
+            values[seller] += prices[i]
+            taken[stock] += 1
+            current[depth] = i
+            search(depth + 1, cost + deltas[i])
+            taken[stock] -= 1
+            values[seller] -= prices[i]
+            counts[seller] -= 1
+
+    # The bound counts on letters never getting cheaper with more cards or value
+    optimal = _grows_with_value(shipping, pm.seller_ids)
+    try:
+        search(0, 0.0)
+    except _Stop:
+        optimal = False
+        logger.debug("Branch and bound stopped early, returning best basket found")
+
+    if best["choice"] is None:
+        raise ValueError("No feasible basket found.")
+    amounts = _copy_amounts(options, slot_group, best["choice"], pm.n_offers)
+    return Solution(
+        pm.main_sellers(amounts), pm, optimal=optimal, solver="branch_and_bound", shipping=shipping,
+        amounts=amounts if pm.has_quantities else None,
+    )
+
+
+def _temperatures(t_start, time_limit, max_moves):
+    """
+    Annealing temperature for every batch of ANNEAL_BATCH moves, cooling from
+    t_start to a thousandth of it over time_limit seconds, or over max_moves
+    moves when given. Stops when either runs out.
+    """
+    if not time_limit and max_moves is None:
+        raise ValueError("Annealing needs a time_limit or max_moves")
+    t_end = t_start * 1e-3
+    started = time.monotonic()
+    deadline = started + time_limit if time_limit else None
+    moves = 0
+    while True:
+        now = time.monotonic()
+        if deadline is not None and now >= deadline:
+            return
+        if max_moves is not None:
+            if moves >= max_moves:
+                return
+            progress = moves / max_moves
+        else:
+            progress = (now - started) / time_limit
+        yield t_start * (t_end / t_start) ** progress
+        moves += ANNEAL_BATCH
+
+
+def _anneal_copies(pm, time_limit, rng, start_temperature, max_moves, target_cost, shipping):
+    """
+    solve_annealing with quantities. Every copy wanted moves between the
+    offers of its card on its own, taking the cheapest copy its stock has
+    left and giving back the dearest one its old stock sold, so a stock's
+    copies always cost the same as when bought cheapest first.
+    """
+    n_sellers = pm.n_sellers
+    options, demand, units = _copy_options(pm)
+    ship_table = seller_shipping(shipping, pm.seller_ids)
+    choice, _ = _greedy_copies(options, demand, units, n_sellers, ship_table, shipping, pm.seller_ids)
+    slot_group = np.repeat(np.arange(len(options)), demand)
+    stock_seller = np.zeros(len(units), dtype=int)
+    for _, sellers, stock in options:
+        stock_seller[stock] = sellers
+
+    # Plain lists are a lot quicker than numpy scalars in the inner loop
+    ship = ship_table.tolist()
+    by_value = has_value_brackets(shipping)
+    if by_value:
+        vship = value_tables(shipping, pm.seller_ids).transpose(1, 0, 2).tolist()
+        brackets = np.asarray(shipping.value_brackets, dtype=float).tolist()
+    n_cols, width = ship_table.shape[1], units.shape[1]
+    unit = units.tolist()
+    opt_sellers = [o[1].tolist() for o in options]
+    opt_stock = [o[2].tolist() for o in options]
+    seller_option = [{s: i for i, s in enumerate(sellers)} for sellers in opt_sellers]
+    groups = slot_group.tolist()
+    choice = choice.tolist()
+
+    counts, values, taken = [0] * n_sellers, [0.0] * n_sellers, [0] * len(units)
+    for g, i in zip(groups, choice):
+        counts[opt_sellers[g][i]] += 1
+        taken[opt_stock[g][i]] += 1
+
+    def letter(s, c, v):
+        if c >= n_cols:
+            return np.inf
+        if by_value:
+            return vship[s][bisect_right(brackets, v)][c]
+        return ship[s][c]
+
+    def price(k, t):
+        return unit[k][t] if 0 <= t < width else np.inf
+
+    def move_cost(g, i, j):
+        k1, s1, k2, s2 = opt_stock[g][i], opt_sellers[g][i], opt_stock[g][j], opt_sellers[g][j]
+        if k1 == k2:
+            return 0.0
+        p_out, p_in = price(k1, taken[k1] - 1), price(k2, taken[k2])
+        c1, v1 = counts[s1], values[s1]
+        if s1 == s2:
+            return p_in - p_out + letter(s1, c1, v1 - p_out + p_in) - letter(s1, c1, v1)
+        c2, v2 = counts[s2], values[s2]
+        return (
+            p_in - p_out
+            + letter(s2, c2 + 1, v2 + p_in) - letter(s2, c2, v2)
+            + letter(s1, c1 - 1, v1 - p_out) - letter(s1, c1, v1)
+        )
+
+    def move(g, i, j):
+        k1, s1, k2, s2 = opt_stock[g][i], opt_sellers[g][i], opt_stock[g][j], opt_sellers[g][j]
+        p_out, p_in = price(k1, taken[k1] - 1), price(k2, taken[k2])
+        taken[k1] -= 1
+        taken[k2] += 1
+        counts[s1] -= 1
+        counts[s2] += 1
+        values[s1] -= p_out
+        values[s2] += p_in
+
+    def exact_cost():
+        # Also resets the seller values, so rounding errors don't pile up
+        bought = np.arange(width) < np.asarray(taken)[:, None]
+        stock_cost = np.where(bought, units, 0.0).sum(axis=1)
+        values[:] = np.bincount(stock_seller, weights=stock_cost, minlength=n_sellers).tolist()
+        return stock_cost.sum() + sum(letter(s, c, v) for s, (c, v) in enumerate(zip(counts, values)))
+
+    cost = exact_cost()
+    best_cost, best_choice = cost, list(choice)
+    movable = np.array([q for q, g in enumerate(groups) if len(opt_sellers[g]) > 1])
+
+    t_start = start_temperature or float(ship_table[:, 1].min())
+    iterations = 0
+    for temp in _temperatures(t_start, time_limit, max_moves):
+        if len(movable) == 0:
+            break
+        q1s = movable[rng.integers(len(movable), size=ANNEAL_BATCH)].tolist()
+        q2s = rng.integers(len(groups), size=ANNEAL_BATCH).tolist()
+        picks = rng.random(ANNEAL_BATCH).tolist()
+        swaps = (rng.random(ANNEAL_BATCH) < SWAP_PROBABILITY).tolist()
+        thresholds = (-temp * np.log(rng.random(ANNEAL_BATCH) + 1e-300)).tolist()
+
+        for q1, q2, pick, swap, threshold in zip(q1s, q2s, picks, swaps, thresholds):
+            g1, i1 = groups[q1], choice[q1]
+            if swap:
+                # Exchange sellers between two copies, one move after the other
+                g2, i2 = groups[q2], choice[q2]
+                s1, s2 = opt_sellers[g1][i1], opt_sellers[g2][i2]
+                if s1 == s2:
+                    continue
+                j1, j2 = seller_option[g1].get(s2), seller_option[g2].get(s1)
+                if j1 is None or j2 is None:
+                    continue
+                delta = move_cost(g1, i1, j1)
+                if not delta < np.inf:
+                    continue
+                move(g1, i1, j1)
+                delta += move_cost(g2, i2, j2)
+                if not delta <= threshold:
+                    move(g1, j1, i1)
+                    continue
+                move(g2, i2, j2)
+                choice[q1], choice[q2] = j1, j2
+            else:
+                j = int(pick * (len(opt_sellers[g1]) - 1))
+                if j >= i1:
+                    j += 1
+                delta = move_cost(g1, i1, j)
+                if not delta <= threshold:
+                    continue
+                move(g1, i1, j)
+                choice[q1] = j
+
+            cost += delta
+            if cost < best_cost - 1e-9:
+                best_cost, best_choice = cost, list(choice)
+
+        iterations += ANNEAL_BATCH
+        cost = exact_cost()
+        if target_cost is not None and best_cost <= target_cost:
+            break
+
+    logger.debug(f"Annealing ran {iterations} moves over {len(groups)} copies, best cost {best_cost:.2f}")
+    get_metrics().count("annealing_moves", iterations)
+
+    amounts = _copy_amounts(options, slot_group, best_choice, pm.n_offers)
+    return Solution(
+        pm.main_sellers(amounts), pm, optimal=False, solver="annealing", shipping=shipping, amounts=amounts
+    )
+
+
+@timed("annealing")
+def solve_annealing(
+    price_mat, groups=None, time_limit=10.0, rng=None, start_temperature=None, max_moves=None,
+    target_cost=None, shipping=None,
+):
+    """
+    Anytime heuristic for lists that are too large to solve exactly: a greedy
+    start followed by simulated annealing over single card moves and pairwise
+    seller swaps. Card counts and price sums per seller are kept up to date so
+    every move is costed in O(1). Returns the best basket seen when the time
+    budget runs out. With quantities every copy wanted moves on its own, see
+    _anneal_copies.
+
+    With max_moves the cooling schedule follows the number of moves instead of
+    the clock, so a run with a fixed rng gives the same basket every time
+    (unless time_limit, if given, cuts it short). It also stops as soon as a
+    basket of at most target_cost is found.
+    """
+    pm = as_price_matrix(price_mat, groups)
+    rng = np.random.default_rng(rng)
+    if pm.has_quantities:
+        return _anneal_copies(pm, time_limit, rng, start_temperature, max_moves, target_cost, shipping)
+    n_rows, n_sellers = pm.shape
+    options = _group_options(pm)
+    n_groups = len(options)
+    ship_table = seller_shipping(shipping, pm.seller_ids)
+
+    _, _, choice = _greedy(options, n_rows, n_sellers, ship_table, shipping, pm.seller_ids)
+
+    # Plain lists are a lot quicker than numpy scalars in the inner loop, the
+    # extra column keeps an overfilled letter from indexing past the table
+    ship = np.pad(ship_table, ((0, 0), (0, 1)), constant_values=np.inf).tolist()
+    by_value = has_value_brackets(shipping)
+    if by_value:
+        # vship[seller][value bracket][count], the bracket found by bisecting brackets
+        tables = value_tables(shipping, pm.seller_ids)
+        vship = np.pad(tables, ((0, 0), (0, 0), (0, 1)), constant_values=np.inf).transpose(1, 0, 2).tolist()
+        brackets = np.asarray(shipping.value_brackets, dtype=float).tolist()
+    opt_sellers = [o[1].tolist() for o in options]
+    opt_prices = [o[2].tolist() for o in options]
+    seller_option = [{s: i for i, s in enumerate(sellers)} for sellers in opt_sellers]
+    choice = choice.tolist()
+
+    counts = [0] * n_sellers
+    price_sum = [0.0] * n_sellers
+    for g, i in enumerate(choice):
+        counts[opt_sellers[g][i]] += 1
+        price_sum[opt_sellers[g][i]] += opt_prices[g][i]
+
+    def exact_cost():
+        if by_value:
+            return sum(price_sum) + sum(
+                vship[s][bisect_right(brackets, v)][c] for s, (c, v) in enumerate(zip(counts, price_sum))
+            )
+        return sum(price_sum) + sum(ship[s][c] for s, c in enumerate(counts))
+
+    cost = exact_cost()
+    best_cost, best_choice = cost, list(choice)
+    movable = np.array([g for g in range(n_groups) if len(opt_sellers[g]) > 1])
+
+    t_start = start_temperature or float(ship_table[:, 1].min())
+    iterations = 0
+    for temp in _temperatures(t_start, time_limit, max_moves):
+        if len(movable) == 0:
+            break
+        # Draw the random numbers for a whole batch of moves at once
+        g1s = movable[rng.integers(len(movable), size=ANNEAL_BATCH)].tolist()
+        g2s = rng.integers(n_groups, size=ANNEAL_BATCH).tolist()
+        picks = rng.random(ANNEAL_BATCH).tolist()
+        swaps = (rng.random(ANNEAL_BATCH) < SWAP_PROBABILITY).tolist()
+        thresholds = (-temp * np.log(rng.random(ANNEAL_BATCH) + 1e-300)).tolist()
+
+        for g1, g2, pick, swap, threshold in zip(g1s, g2s, picks, swaps, thresholds):
+            i1 = choice[g1]
+            s1, p1 = opt_sellers[g1][i1], opt_prices[g1][i1]
+
+            if swap:
+                # Exchange sellers between two cards, seller counts don't change
+                i2 = choice[g2]
+                s2 = opt_sellers[g2][i2]
+                if s1 == s2:
+                    continue
+                j1, j2 = seller_option[g1].get(s2), seller_option[g2].get(s1)
+                if j1 is None or j2 is None:
+                    continue
+                delta = opt_prices[g1][j1] - p1 + opt_prices[g2][j2] - opt_prices[g2][i2]
+                if by_value:
+                    # Counts stay the same but the letters change value
+                    v1 = price_sum[s1] + opt_prices[g2][j2] - p1
+                    v2 = price_sum[s2] + opt_prices[g1][j1] - opt_prices[g2][i2]
+                    c1, c2 = counts[s1], counts[s2]
+                    delta += (
+                        vship[s1][bisect_right(brackets, v1)][c1]
+                        - vship[s1][bisect_right(brackets, price_sum[s1])][c1]
+                        + vship[s2][bisect_right(brackets, v2)][c2]
+                        - vship[s2][bisect_right(brackets, price_sum[s2])][c2]
+                    )
+                if not delta <= threshold:
+                    continue
+                price_sum[s2] += opt_prices[g1][j1] - opt_prices[g2][i2]
+                price_sum[s1] += opt_prices[g2][j2] - p1
+                choice[g1], choice[g2] = j1, j2
+            else:
+                # Move a card to another offer
+                j = int(pick * (len(opt_sellers[g1]) - 1))
+                if j >= i1:
+                    j += 1
+                s2, p2 = opt_sellers[g1][j], opt_prices[g1][j]
+                delta = p2 - p1
+                if by_value:
+                    c1, v1 = counts[s1], price_sum[s1]
+                    if s1 == s2:
+                        delta += (
+                            vship[s1][bisect_right(brackets, v1 - p1 + p2)][c1]
+                            - vship[s1][bisect_right(brackets, v1)][c1]
+                        )
+                    else:
+                        c2, v2 = counts[s2], price_sum[s2]
+                        delta += (
+                            vship[s2][bisect_right(brackets, v2 + p2)][c2 + 1]
+                            - vship[s2][bisect_right(brackets, v2)][c2]
+                            + vship[s1][bisect_right(brackets, v1 - p1)][c1 - 1]
+                            - vship[s1][bisect_right(brackets, v1)][c1]
+                        )
+                elif s1 != s2:
+                    c1, c2 = counts[s1], counts[s2]
+                    delta += ship[s2][c2 + 1] - ship[s2][c2] + ship[s1][c1 - 1] - ship[s1][c1]
+                if not delta <= threshold:
+                    continue
+                counts[s1] -= 1
+                counts[s2] += 1
+                price_sum[s1] -= p1
+                price_sum[s2] += p2
+                choice[g1] = j
+
+            cost += delta
+            if cost < best_cost - 1e-9:
+                best_cost, best_choice = cost, list(choice)
+
+        iterations += ANNEAL_BATCH
+        # Keep rounding errors of the running total from piling up
+        cost = exact_cost()
+        if target_cost is not None and best_cost <= target_cost:
+            break
+
+    logger.debug(f"Annealing ran {iterations} moves, best cost {best_cost:.2f}")
+    get_metrics().count("annealing_moves", iterations)
+
+    assignment = np.full(n_rows, -1)
+    for g, i in enumerate(best_choice):
+        assignment[options[g][0][i]] = options[g][1][i]
+    return Solution(assignment, pm, optimal=False, solver="annealing", shipping=shipping)
+
+
+def optimize(
+    price_mat, groups=None, time_limit=None, method="auto", gap=None, shipping=None, lp_bound=False, **options
+):
+    """
+    Find the cheapest basket. method is one of "auto" (MILP, branch and bound
+    for FALLBACK_TIME_LIMIT if scipy isn't installed), "milp", "branch_and_bound", "annealing" or
+    "multistart" (annealing chains in parallel processes, see multistart.py).
+    options are passed on to the multistart solver.
+
+    Every solution comes with a lower_bound (and so a gap). The heuristics get
+    the quick simple_bound, with lp_bound the LP relaxation too, which is
+    tighter but gets a share of time_limit. With gap, the solvers stop as soon
+    as their basket is proven within that fraction of the cheapest one.
+
+    shipping is a ShippingTable with the sellers' countries, None for the flat
+    brackets. All solvers cost letters by seller, card count and value, but
+    branch and bound only proves its basket optimal when no letter gets
+    cheaper as it's worth more.
+    """
+    from bounds import lower_bound
+
+    pm = as_price_matrix(price_mat, groups)
+    fallback = False
+    if method in ("auto", "milp"):
+        try:
+            return solve_milp(pm, time_limit=time_limit, gap=gap, shipping=shipping)
+        except ImportError:
+            if method == "milp":
+                raise
+            # Branch and bound can take forever where the MILP doesn't, so it gets a budget
+            time_limit = time_limit or FALLBACK_TIME_LIMIT
+            logger.warning(f"scipy not installed, falling back to branch and bound for {time_limit:g}s")
+            method = "branch_and_bound"
+            fallback = True
+
+    if method == "annealing":
+        time_limit = time_limit or 10.0
+    lp_time = None
+    if lp_bound and time_limit:
+        lp_time = time_limit * LP_BOUND_SHARE
+        time_limit -= lp_time
+    bound = lower_bound(pm, lp=lp_bound, shipping=shipping, time_limit=lp_time)
+    # gap = (cost - bound) / cost, so the gap is reached at cost = bound / (1 - gap)
+    target_cost = bound / (1 - gap) if gap is not None else None
+    if method == "annealing":
+        solution = solve_annealing(pm, time_limit=time_limit, target_cost=target_cost, shipping=shipping)
+    elif method == "multistart":
+        from multistart import solve_multistart
+
+        solution = solve_multistart(
+            pm, time_limit=time_limit, target_cost=target_cost, shipping=shipping, **options
+        )
+    elif method == "branch_and_bound":
+        solution = solve_branch_and_bound(
+            pm, time_limit=time_limit, target_cost=target_cost, shipping=shipping
+        )
+    else:
+        raise ValueError(f"Unknown optimizer method: {method}")
+
+    solution.lower_bound = max(bound, solution.lower_bound or -np.inf)
+    if fallback and not solution.optimal:
+        logger.warning("Branch and bound ran out of time, the basket isn't proven to be the cheapest")
+    return solution
@@ -0,0 +1,552 @@
+#!/usr/bin/env python3
+"""
+Sparse price matrix of a wantlist.
+
+Rows are products (prod_id, with the metaprod_id they were requested through or
+NaN) and columns are sellers. Only real offers are stored, in CSR layout: the
+offers of row r are sellers[indptr[r]:indptr[r + 1]] / prices[...], sorted by
+seller column.
+
+A wantlist can want more than one copy of a card (wanted, per row), and a
+seller can list a product several times at different prices with a number of
+copies each. That stock is kept per offer as a price ladder: the (price,
+copies) tiers of its articles, cheapest first, in the same CSR layout one
+level down (tiers ladder_ptr[o]:ladder_ptr[o + 1] of offer o). Without a
+ladder the stock isn't known and an offer sells any number of copies at its
+price. Rows are never repeated per copy.
+"""
+
+import heapq
+
+import numpy as np
+import pandas as pd
+
+from articles import ArticleIndex, condition_codes
+from search_filters import ArticleFilter
+from shipping import max_cards, max_shipping_step, shipping_cost_table
+
+# Tolerance for price comparisons
+EPS = 1e-9
+
+
+def group_index(groups, n_rows):
+    """Map metaprod_id labels (NaN for plain products) to consecutive group numbers."""
+    if groups is None:
+        return np.arange(n_rows)
+
+    index = np.empty(n_rows, dtype=int)
+    seen = {}
+    for row, label in enumerate(groups):
+        key = ("row", row) if label is None or label != label else label
+        index[row] = seen.setdefault(key, len(seen))
+    return index
+
+
+class PriceMatrix:
+    def __init__(
+        self, indptr, sellers, prices, prod_ids, metaprod_ids, seller_ids, wanted=None, ladder=None
+    ):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.sellers = np.asarray(sellers, dtype=np.int32)
+        self.prices = np.asarray(prices, dtype=np.float64)
+        self.prod_ids = np.asarray(prod_ids)
+        self.metaprod_ids = np.asarray(metaprod_ids, dtype=np.float64)
+        self.seller_ids = np.asarray(seller_ids)
+        # Copies wanted per row, the same for all rows of a metaproduct
+        self.wanted = np.ones(self.n_rows, dtype=np.int32) if wanted is None else np.asarray(wanted, dtype=np.int32)
+        # (ladder_ptr, ladder_prices, ladder_amounts), None if the stock isn't known
+        self.ladder = None
+        if ladder is not None:
+            ptr, ladder_prices, amounts = ladder
+            self.ladder = (
+                np.asarray(ptr, dtype=np.int64),
+                np.asarray(ladder_prices, dtype=np.float64),
+                np.asarray(amounts, dtype=np.int32),
+            )
+
+        # Row of every offer, and a global sort key for (row, seller) lookups
+        self.rows = np.repeat(np.arange(self.n_rows, dtype=np.int32), np.diff(self.indptr))
+        self._keys = self.rows.astype(np.int64) * self.n_sellers + self.sellers
+
+    @classmethod
+    def from_offers(cls, rows, seller_ids, prices, prod_ids, metaprod_ids=None, wanted=None, amounts=None):
+        """
+        Build from (row, seller id, price) triplets, keeping the cheapest offer
+        per pair. With the number of copies of every triplet in amounts, all
+        of them are kept as the pair's price ladder.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        prices = np.asarray(prices, dtype=np.float64)
+        n_rows = len(prod_ids)
+        if metaprod_ids is None:
+            metaprod_ids = np.full(n_rows, np.nan)
+
+        uniq_sellers, cols = np.unique(np.asarray(seller_ids), return_inverse=True)
+        if amounts is not None:
+            amounts = np.asarray(amounts, dtype=np.int64)
+            in_stock = amounts > 0
+            rows, cols, prices, amounts = rows[in_stock], cols[in_stock], prices[in_stock], amounts[in_stock]
+        order = np.lexsort((prices, cols, rows))
+        rows, cols, prices = rows[order], cols[order], prices[order]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+
+        ladder = None
+        if amounts is not None:
+            ladder = (np.r_[np.flatnonzero(first), len(rows)], prices, amounts[order])
+        rows, cols, prices = rows[first], cols[first], prices[first]
+
+        indptr = np.zeros(n_rows + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=n_rows))
+        return cls(indptr, cols, prices, prod_ids, metaprod_ids, uniq_sellers, wanted, ladder)
+
+    @classmethod
+    def from_dense(cls, price_mat, groups=None, prod_ids=None, seller_ids=None):
+        price_mat = np.asarray(price_mat, dtype=np.float64)
+        n_rows, n_cols = price_mat.shape
+        rows, cols = np.nonzero(np.isfinite(price_mat))
+        indptr = np.zeros(n_rows + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=n_rows))
+        return cls(
+            indptr,
+            cols,
+            price_mat[rows, cols],
+            np.arange(n_rows) if prod_ids is None else prod_ids,
+            np.full(n_rows, np.nan) if groups is None else groups,
+            np.arange(n_cols) if seller_ids is None else seller_ids,
+        )
+
+    @classmethod
+    def from_dataframe(cls, price_df):
+        """From the old dense (metaprod_id, prod_id) x seller DataFrame."""
+        return cls.from_dense(
+            price_df.to_numpy(dtype=np.float64),
+            groups=price_df.index.get_level_values("metaprod_id").to_numpy(dtype=np.float64),
+            prod_ids=price_df.index.get_level_values("prod_id").to_numpy(),
+            seller_ids=price_df.columns.to_numpy(),
+        )
+
+    @classmethod
+    def from_articles(cls, product_ids, articles, prod_to_metaprod=None, countries=None):
+        """
+        Build straight from /articles responses, articles[i] being the response
+        for product_ids[i].
+        """
+        builder = PriceMatrixBuilder(product_ids, prod_to_metaprod, countries)
+        for row, response in enumerate(articles):
+            builder.add_response_row(row, response)
+        return builder.build()
+
+    @property
+    def n_rows(self):
+        return len(self.indptr) - 1
+
+    @property
+    def n_sellers(self):
+        return len(self.seller_ids)
+
+    @property
+    def n_offers(self):
+        return len(self.prices)
+
+    @property
+    def shape(self):
+        return self.n_rows, self.n_sellers
+
+    @property
+    def has_quantities(self):
+        """
+        Whether the solvers need the copies bought per offer: a card is wanted
+        more than once, or its sellers' stock is shared by several rows.
+        """
+        return bool((self.wanted > 1).any()) or self.shares_stock
+
+    @property
+    def shares_stock(self):
+        """Whether a product with price ladders is in several rows, which then share its stock."""
+        return self.ladder is not None and len(np.unique(self.prod_ids)) < self.n_rows
+
+    def tiers(self):
+        """
+        (offer, price, copies) per tier of the price ladders. Without a ladder
+        every offer is one tier with as many copies as its row wants.
+        """
+        if self.ladder is None:
+            return np.arange(self.n_offers), self.prices, self.wanted[self.rows].astype(np.int64)
+        ptr, prices, amounts = self.ladder
+        return np.repeat(np.arange(self.n_offers), np.diff(ptr)), prices, amounts.astype(np.int64)
+
+    def available(self):
+        """Copies every offer has, over all of its tiers."""
+        offers, _, amounts = self.tiers()
+        return np.bincount(offers, weights=amounts, minlength=self.n_offers).astype(np.int64)
+
+    def amount_cost(self, amounts):
+        """
+        Cost of buying amounts[o] copies of every offer o, cheapest tiers
+        first, np.inf where an offer doesn't have that many. A product in
+        several rows shares the ladder, the earlier rows take the cheaper
+        copies.
+        """
+        amounts = np.asarray(amounts, dtype=np.int64)
+        offers, prices, tier_amounts = self.tiers()
+        # Copies in the cheaper tiers of the same offer
+        first = np.flatnonzero(np.r_[True, offers[1:] != offers[:-1]]) if len(offers) else offers
+        before = np.cumsum(tier_amounts) - tier_amounts
+        before -= np.repeat(before[first], np.diff(np.r_[first, len(offers)]))
+
+        # Copies of the same (product, seller) bought in earlier rows
+        taken = np.zeros(self.n_offers, dtype=np.int64)
+        if self.shares_stock:
+            _, prod_code = np.unique(self.prod_ids, return_inverse=True)
+            pairs = prod_code.ravel()[self.rows].astype(np.int64) * self.n_sellers + self.sellers
+            order = np.argsort(pairs, kind="stable")
+            cum = np.cumsum(amounts[order]) - amounts[order]
+            taken[order] = cum - cum[np.searchsorted(pairs[order], pairs[order])]
+
+        start = taken[offers] - before
+        take = np.clip(start + amounts[offers], 0, tier_amounts) - np.clip(start, 0, tier_amounts)
+        cost = np.bincount(offers, weights=take * prices, minlength=self.n_offers)
+        return np.where(taken + amounts <= self.available(), cost, np.inf)
+
+    def offer_amounts(self, assignment):
+        """Copies bought per offer for a seller column per row (-1 for none), each row's wanted."""
+        amounts = np.zeros(self.n_offers, dtype=np.int64)
+        bought = np.flatnonzero(np.asarray(assignment) >= 0)
+        amounts[self.offer_index(bought, np.asarray(assignment)[bought])] = self.wanted[bought]
+        return amounts
+
+    def group_index(self):
+        return group_index(self.metaprod_ids, self.n_rows)
+
+    def stock_closure(self, free):
+        """
+        Rows free (mask or indices) as a row mask, grown to whole groups and
+        to every group with a row that shares the stock of one of their
+        products, until nothing more joins. Buying the free rows again then
+        can't touch the other rows' copies.
+        """
+        gidx = self.group_index()
+        free = np.isin(gidx, gidx[free])
+        while self.shares_stock:
+            more = np.isin(gidx, gidx[np.isin(self.prod_ids, self.prod_ids[free])])
+            if (more == free).all():
+                break
+            free = more
+        return free
+
+    def coo(self):
+        return self.rows, self.sellers, self.prices
+
+    def lookup(self, rows, cols):
+        """Vectorized price of (row, seller column) pairs, np.inf where there's no offer."""
+        keys = np.asarray(rows, dtype=np.int64) * self.n_sellers + np.asarray(cols, dtype=np.int64)
+        if self.n_offers == 0:
+            return np.full(keys.shape, np.inf)
+        pos = np.minimum(np.searchsorted(self._keys, keys), self.n_offers - 1)
+        return np.where(self._keys[pos] == keys, self.prices[pos], np.inf)
+
+    def offer_index(self, rows, cols):
+        """Offer number of every (row, seller column) pair, all of them have to be offers."""
+        keys = np.asarray(rows, dtype=np.int64) * self.n_sellers + np.asarray(cols, dtype=np.int64)
+        return np.searchsorted(self._keys, keys)
+
+    def main_sellers(self, amounts):
+        """Seller column most of every row's copies are bought from, -1 for rows without any."""
+        assignment = np.full(self.n_rows, -1)
+        bought = np.flatnonzero(np.asarray(amounts) > 0)
+        # Largest amount first within a row, the last write of a row wins
+        order = bought[np.lexsort((-np.asarray(amounts)[bought], self.rows[bought]))][::-1]
+        assignment[self.rows[order]] = self.sellers[order]
+        return assignment
+
+    def select_rows(self, keep):
+        """New matrix with only the rows in keep (bool mask or indices), same sellers."""
+        keep = np.arange(self.n_rows)[keep]
+        counts = np.diff(self.indptr)[keep]
+        indptr = np.zeros(len(keep) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(counts)
+        offer_idx = np.repeat(self.indptr[keep] - indptr[:-1], counts) + np.arange(indptr[-1])
+        return PriceMatrix(
+            indptr, self.sellers[offer_idx], self.prices[offer_idx],
+            self.prod_ids[keep], self.metaprod_ids[keep], self.seller_ids,
+            self.wanted[keep], self.select_ladder(offer_idx),
+        )
+
+    def select_ladder(self, offer_idx):
+        """Price ladder of the offers in offer_idx, in that order, None without one."""
+        if self.ladder is None:
+            return None
+        ptr, prices, amounts = self.ladder
+        n_tiers = np.diff(ptr)[offer_idx]
+        new_ptr = np.zeros(len(offer_idx) + 1, dtype=np.int64)
+        new_ptr[1:] = np.cumsum(n_tiers)
+        tier_idx = np.repeat(ptr[offer_idx] - new_ptr[:-1], n_tiers) + np.arange(new_ptr[-1])
+        return new_ptr, prices[tier_idx], amounts[tier_idx]
+
+    def regroup(self, metaprod_ids):
+        """Same offers with other metaproduct labels for the rows."""
+        return PriceMatrix(
+            self.indptr, self.sellers, self.prices, self.prod_ids, metaprod_ids, self.seller_ids,
+            self.wanted, self.ladder,
+        )
+
+    def with_wanted(self, wanted):
+        """Same offers with other numbers of copies wanted per row."""
+        return PriceMatrix(
+            self.indptr, self.sellers, self.prices, self.prod_ids, self.metaprod_ids, self.seller_ids,
+            wanted, self.ladder,
+        )
+
+    def compact_sellers(self):
+        """Drop sellers without offers, returns (matrix, old column of every new column)."""
+        used = np.unique(self.sellers)
+        return PriceMatrix(
+            self.indptr, np.searchsorted(used, self.sellers), self.prices,
+            self.prod_ids, self.metaprod_ids, self.seller_ids[used], self.wanted, self.ladder,
+        ), used
+
+    def drop_empty_rows(self):
+        return self.select_rows(np.diff(self.indptr) > 0)
+
+    def to_dense(self):
+        price_mat = np.full(self.shape, np.inf)
+        price_mat[self.rows, self.sellers] = self.prices
+        return price_mat
+
+    def to_dataframe(self):
+        index = pd.MultiIndex.from_arrays(
+            [self.metaprod_ids, self.prod_ids], names=["metaprod_id", "prod_id"]
+        )
+        return pd.DataFrame(self.to_dense(), index=index, columns=self.seller_ids)
+
+    def __repr__(self):
+        copies = f", {int(self.wanted.sum())} copies" if self.has_quantities else ""
+        return f"PriceMatrix({self.n_rows} cards x {self.n_sellers} sellers, {self.n_offers} offers{copies})"
+
+
+class GrowableArray:
+    """Typed append-only array that doubles its capacity when full."""
+
+    def __init__(self, dtype, capacity=1024):
+        self.data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        n = len(values)
+        if self.size + n > len(self.data):
+            new_capacity = max(2 * len(self.data), self.size + n)
+            self.data = np.resize(self.data, new_capacity)
+        self.data[self.size:self.size + n] = values
+        self.size += n
+
+    def to_numpy(self):
+        return self.data[:self.size]
+
+    def __len__(self):
+        return self.size
+
+
+def _page_from(response, start):
+    """The articles of a (merged) /articles response from position start on."""
+    if "article_columns" in response:
+        return {"article_columns": {name: column[start:] for name, column in response["article_columns"].items()}}
+    return {"article": response.get("article", [])[start:]}
+
+
+class PriceMatrixBuilder:
+    """
+    Builds a PriceMatrix incrementally while /articles responses come in. Each
+    response is filtered and reduced to (row, seller, price) and the idArticle,
+    count, condition and language for the ArticleIndex right away, so the raw
+    JSON can be dropped as soon as it has been added.
+    """
+
+    def __init__(
+        self, product_ids, prod_to_metaprod=None, countries=None, article_filter=None, shipping=None,
+        wanted=None,
+    ):
+        prod_to_metaprod = prod_to_metaprod or {}
+        self.product_ids = list(product_ids)
+        # Copies wanted per product id, over all the lists it is in, for paging
+        self.wanted = wanted or {}
+        self.metaprod_ids = [prod_to_metaprod.get(prod_id, np.nan) for prod_id in self.product_ids]
+        self.filter = article_filter or ArticleFilter(countries=countries)
+
+        # A product can be in the list more than once (directly and through a metaproduct)
+        self.product_rows = {}
+        for row, prod_id in enumerate(self.product_ids):
+            self.product_rows.setdefault(prod_id, []).append(row)
+
+        # Same bound as the dominated offers rule in pruning: an offer with more than
+        # n_full sellers at least max_step cheaper for the same card is never needed
+        # n_full and max_step hold for any seller country and value bracket of the shipping table,
+        # and every copy wanted (of all the lists) can fill up a seller
+        n_cards = sum(self.wanted.values()) or len(set(group_index(self.metaprod_ids, len(self.product_ids))))
+        ship = shipping_cost_table() if shipping is None else shipping.count_table()
+        self.n_full = max(n_cards - 1, 0) // max_cards(ship)
+        self.max_step = max_shipping_step(ship if shipping is None else shipping.value_tables())
+
+        # Country per seller id, when shipping depends on it
+        self.collect_countries = shipping is not None and len(shipping.countries) > 1
+        self.seller_countries = {}
+        # Per product being paged through, what wants_more has seen of it so far,
+        # until its response is added
+        self.paging = {}
+
+        self.rows = GrowableArray(np.int32)
+        self.seller_ids = GrowableArray(np.int64)
+        self.prices = GrowableArray(np.float64)
+        self.article_ids = GrowableArray(np.int64)
+        self.counts = GrowableArray(np.int32)
+        self.conditions = GrowableArray(np.int8)
+        self.languages = GrowableArray(np.int16)
+
+    def add_response(self, product_id, response):
+        """Add the /articles response of a product, returns the number of offers kept."""
+        self.paging.pop(product_id, None)
+        columns = self._columns(response)
+        return sum(self._add(row, *columns) for row in self.product_rows[product_id])
+
+    def add_response_row(self, row, response):
+        return self._add(row, *self._columns(response))
+
+    def _columns(self, response):
+        """
+        Filtered (sellers, prices, article ids, countries, article details) of a
+        response, in the order the API sent them. The details are (counts,
+        condition codes, language ids).
+        """
+        response = response or {}
+        countries = None
+        if "article_columns" in response:
+            # Already projected to columns while decoding (fast_json)
+            columns = response["article_columns"]
+            sellers = np.asarray(columns["idUser"], dtype=np.int64)
+            prices = np.asarray(columns["price"], dtype=np.float64)
+            article_ids = np.asarray(columns["idArticle"], dtype=np.int64)
+            counts = np.asarray(columns["count"], dtype=np.int32)
+            conditions = condition_codes(columns["condition"])
+            languages = np.asarray(columns["idLanguage"], dtype=np.int64)
+            if self.filter.needs_country or self.collect_countries:
+                countries = np.asarray(columns["country"])
+        else:
+            articles = response.get("article", [])
+            n = len(articles)
+            sellers = np.fromiter((art["seller"]["idUser"] for art in articles), np.int64, n)
+            prices = np.fromiter((art["price"] for art in articles), np.float64, n)
+            article_ids = np.fromiter((art.get("idArticle", -1) for art in articles), np.int64, n)
+            counts = np.fromiter((art.get("count", 1) for art in articles), np.int32, n)
+            conditions = condition_codes([art.get("condition") for art in articles])
+            languages = np.fromiter((art["language"]["idLanguage"] for art in articles), np.int64, n)
+            if self.filter.needs_country or self.collect_countries:
+                countries = np.array([art["seller"]["address"]["country"] for art in articles])
+
+        keep = self.filter.mask(sellers, prices, countries, languages)
+        countries = countries[keep] if countries is not None else None
+        details = counts[keep], conditions[keep], languages[keep]
+        return sellers[keep], prices[keep], article_ids[keep], countries, details
+
+    def _add(self, row, sellers, prices, article_ids, countries, details):
+        counts, conditions, languages = details
+        self.rows.extend(np.full(len(sellers), row, dtype=np.int32))
+        self.seller_ids.extend(sellers)
+        self.prices.extend(prices)
+        self.article_ids.extend(article_ids)
+        self.counts.extend(counts)
+        self.conditions.extend(conditions)
+        self.languages.extend(languages)
+        if self.collect_countries and countries is not None:
+            self.seller_countries.update(zip(sellers.tolist(), countries.tolist()))
+        return len(sellers)
+
+    def wants_more(self, product_id, response):
+        """
+        Whether the next page of a product's articles could still matter. The
+        API lists articles cheapest first, so once the sellers at least
+        max_step cheaper than the last article seen have all the wanted copies
+        even without the n_full largest of them, every article on later pages
+        is dominated. With max_offers_per_country set, paging also stops when
+        every country has that many offers, which is a heuristic.
+
+        It's called with the response so far after every page, and only looks
+        at the articles added since the last call.
+        """
+        state = self.paging.get(product_id)
+        if state is None or state["response"] is not response:
+            n_countries = len(self.filter.countries) if self.filter.countries is not None else 1
+            state = self.paging[product_id] = {
+                "response": response, "seen": 0, "last_price": -np.inf, "sorted": True,
+                "pending": (np.empty(0), np.empty(0, dtype=np.int64), np.empty(0)),
+                "copies": {}, "total": 0.0, "per_country": np.zeros(n_countries),
+            }
+        page = _page_from(response, state["seen"])
+        if "article_columns" in page:
+            raw_prices = np.asarray(page["article_columns"]["price"], dtype=np.float64)
+        else:
+            raw_prices = np.array([art["price"] for art in page["article"]], dtype=np.float64)
+        if np.any(np.diff(np.r_[state["last_price"], raw_prices]) < 0):
+            state["sorted"] = False
+        state["seen"] += len(raw_prices)
+        if len(raw_prices):
+            state["last_price"] = raw_prices[-1]
+        if not state["sorted"] or state["seen"] == 0:
+            # Not sorted by price, nothing can be said about the next page
+            return True
+
+        sellers, prices, _, countries, (counts, _, _) = self._columns(page)
+        if self.filter.countries is not None:
+            state["per_country"] += (countries[:, None] == self.filter.countries).sum(axis=0)
+        else:
+            state["per_country"] += len(prices)
+
+        # Offers that got max_step cheaper than the last article are a prefix of the pending ones
+        pending = [np.r_[old, new] for old, new in zip(state["pending"], (prices, sellers, counts))]
+        n_cheaper = np.searchsorted(pending[0], state["last_price"] - self.max_step + EPS, side="right")
+        copies = state["copies"]
+        for seller, n in zip(pending[1][:n_cheaper].tolist(), pending[2][:n_cheaper].tolist()):
+            copies[seller] = copies.get(seller, 0) + n
+        state["total"] += pending[2][:n_cheaper].sum()
+        state["pending"] = tuple(column[n_cheaper:] for column in pending)
+        wanted = self.wanted.get(product_id, 1)
+        if state["total"] >= wanted:
+            if state["total"] - sum(heapq.nlargest(self.n_full, copies.values())) >= wanted:
+                return False
+
+        k = self.filter.max_offers_per_country
+        if k is not None:
+            return bool((state["per_country"] < k).any())
+        return True
+
+    @property
+    def n_offers(self):
+        return len(self.prices)
+
+    def build(self):
+        return PriceMatrix.from_offers(
+            self.rows.to_numpy(),
+            self.seller_ids.to_numpy(),
+            self.prices.to_numpy(),
+            self.product_ids,
+            self.metaprod_ids,
+            amounts=self.counts.to_numpy(),
+        )
+
+    def article_index(self):
+        """ArticleIndex of every article added, to map a basket back to idArticles."""
+        rows = self.rows.to_numpy()
+        return ArticleIndex.from_articles(
+            np.asarray(self.product_ids, dtype=np.int64)[rows],
+            self.seller_ids.to_numpy(),
+            self.article_ids.to_numpy(),
+            self.prices.to_numpy(),
+            self.counts.to_numpy(),
+            self.conditions.to_numpy(),
+            self.languages.to_numpy(),
+        )
+
+
+def as_price_matrix(price_mat, groups=None):
+    if isinstance(price_mat, PriceMatrix):
+        return price_mat
+    return PriceMatrix.from_dense(price_mat, groups)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Preprocessing that removes offers and sellers which can't be part of an
+optimal basket, so the solvers work on a smaller PriceMatrix.
+
+Every rule only drops an offer if there is an alternative that is at least as
+cheap for every possible basket:
+
+- Same seller printings: a seller offering several printings of the same
+  metaproduct only needs its cheapest one, the seller's card count is the same.
+- Dominated offers: moving a card to another seller adds at most the largest
+  single card shipping step, so an offer costing more than that above a
+  cheaper offer is never needed. With value brackets the step includes the
+  letters changing value bracket.
+- Dominated sellers: if another seller offers every card of a seller at the
+  same price or cheaper, moving those cards over never costs more as long as
+  shipping is subadditive, the same for both sellers, and the other seller
+  can't run out of room. Not with value brackets, moving many cards at once
+  can push the other letter into a dearer one.
+- Single card sellers: a seller left with one offer costs the first shipping
+  bracket on top of the price, buying the card elsewhere costs at most that.
+
+Sellers can be full (max_cards cards), so a dominating offer is only trusted
+if there are more of them than sellers that could possibly be full.
+
+When cards are wanted more than once a cheaper seller can also run out of
+copies. Every seller that sold all of its cheaper copies took at least one of
+the copies wanted of those products, so a dominated offer needs that many more
+cheaper sellers, and a dominating printing or seller needs enough copies of
+its own for all of them. Single card sellers are only dropped for cards wanted
+once, where the seller can't end up with more than one card.
+"""
+
+import numpy as np
+
+from metrics import timed
+from price_matrix import PriceMatrix
+from shipping import has_value_brackets, max_cards, max_shipping_step, seller_shipping, value_tables
+
+EPS = 1e-9
+
+
+@timed("prune")
+def prune(pm, shipping=None):
+    """
+    Return the pruned PriceMatrix and a dict reporting how much it shrank.
+    shipping is a ShippingTable, None for the flat brackets.
+    """
+    ship = seller_shipping(shipping, pm.seller_ids)
+    max_step = max_shipping_step(value_tables(shipping, pm.seller_ids))
+    # Per seller, how much more its one card letter costs than the largest step elsewhere
+    single_slack = seller_shipping(shipping, pm.seller_ids, value=None)[:, 1] - max_step
+    capacity = max_cards(ship) if pm.n_sellers else 0
+
+    gidx = pm.group_index()
+    n_groups = gidx.max() + 1 if pm.n_rows else 0
+    demand = np.ones(n_groups, dtype=np.int64)
+    if pm.has_quantities:
+        demand[gidx] = pm.wanted
+    n_full = max(int(demand.sum()) - 1, 0) // max(capacity, 1)
+    # Copies that can be bought from the stock of a group's offers: its own,
+    # plus those of other rows of the same products when they share stock
+    competing = demand.copy()
+    if pm.shares_stock:
+        _, prod_code = np.unique(pm.prod_ids, return_inverse=True)
+        prod_code = prod_code.ravel()
+        row_demand = demand[gidx]
+        prod_demand = np.bincount(prod_code, weights=row_demand)
+        competing += np.bincount(gidx, weights=prod_demand[prod_code] - row_demand, minlength=n_groups).astype(int)
+
+    rows, sellers, prices = pm.coo()
+    groups = gidx[rows]
+    need = competing[groups]
+    # Price of the need-th cheapest copy of every offer, what all copies it may sell cost at most
+    cover = _nth_copy_price(pm, need)
+    keep = np.ones(pm.n_offers, dtype=bool)
+    removed = {
+        "same_seller_printings": 0,
+        "dominated_sellers": 0,
+        "dominated_offers": 0,
+        "single_card_sellers": 0,
+    }
+
+    # Cheapest printing per (metaproduct, seller), if it has enough copies
+    order = np.lexsort((np.arange(pm.n_offers), prices, sellers, groups))
+    dup = np.zeros(pm.n_offers, dtype=bool)
+    dup[1:] = (groups[order][1:] == groups[order][:-1]) & (sellers[order][1:] == sellers[order][:-1])
+    cheapest = order[np.maximum.accumulate(np.where(dup, 0, np.arange(pm.n_offers)))]
+    dup &= cover[cheapest] <= prices[order] + EPS
+    keep[order[dup]] = False
+    removed["same_seller_printings"] = int(dup.sum())
+
+    uniform = not has_value_brackets(shipping) and (ship == ship[0]).all()
+    if pm.n_sellers and uniform and _is_subadditive(ship[0], capacity):
+        gone = _dominated_seller_offers(groups, sellers, prices, cover, need, keep, pm.n_sellers, capacity)
+        removed["dominated_sellers"] = len(np.unique(sellers[gone]))
+        keep &= ~gone
+
+    span = prices.max() + max_step + 1.0 if pm.n_offers else 1.0
+    while True:
+        idx, *_ = np.where(keep)
+        o = idx[np.lexsort((idx, prices[idx], groups[idx]))]
+        gs, ps, ss = groups[o], prices[o], sellers[o]
+        group_start = np.searchsorted(gs, gs, side="left")
+        sort_key = gs * span + ps
+        # Sellers counted once per group, at their cheapest offer
+        _, first = np.unique(gs.astype(np.int64) * pm.n_sellers + ss, return_index=True)
+        new_seller = np.zeros(len(o) + 1, dtype=np.int64)
+        new_seller[first + 1] = 1
+        n_new = np.cumsum(new_seller)
+
+        def n_at_most(threshold):
+            # Sellers of the same group sorted before this one with price <= threshold
+            pos = np.searchsorted(sort_key, gs * span + threshold + EPS, side="right")
+            end = np.maximum(np.minimum(pos, np.arange(len(o))), group_start)
+            return n_new[end] - n_new[group_start]
+
+        dominated = n_at_most(ps - max_step) > n_full + need[o] - 1
+        single = (np.bincount(ss, minlength=pm.n_sellers)[ss] == 1) & (need[o] == 1)
+        single_dominated = single & ~dominated & (n_at_most(ps + single_slack[ss]) > n_full)
+        if not (dominated.any() or single_dominated.any()):
+            break
+
+        removed["dominated_offers"] += int(dominated.sum())
+        removed["single_card_sellers"] += int(single_dominated.sum())
+        keep[o[dominated | single_dominated]] = False
+
+    used_sellers = np.unique(sellers[keep])
+    new_rows = rows[keep]
+    indptr = np.zeros(pm.n_rows + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(new_rows, minlength=pm.n_rows))
+    pruned = PriceMatrix(
+        indptr,
+        np.searchsorted(used_sellers, sellers[keep]),
+        prices[keep],
+        pm.prod_ids,
+        pm.metaprod_ids,
+        pm.seller_ids[used_sellers],
+        pm.wanted,
+        pm.select_ladder(np.flatnonzero(keep)),
+    ).drop_empty_rows()
+    return pruned, _report(pm, pruned, removed)
+
+
+def _report(pm, pruned, removed):
+    return {
+        "rows": (pm.n_rows, pruned.n_rows),
+        "sellers": (pm.n_sellers, pruned.n_sellers),
+        "offers": (pm.n_offers, pruned.n_offers),
+        **removed,
+    }
+
+
+def _is_subadditive(ship, capacity):
+    n = np.arange(1, capacity + 1)
+    a, b = np.meshgrid(n, n)
+    fits = a + b <= capacity
+    return bool((ship[(a + b)[fits]] <= ship[a[fits]] + ship[b[fits]] + EPS).all())
+
+
+def _nth_copy_price(pm, n):
+    """Price of the n[o]-th cheapest copy of every offer o, np.inf if it has fewer."""
+    offers, prices, copies = pm.tiers()
+    first = np.flatnonzero(np.r_[True, offers[1:] != offers[:-1]]) if len(offers) else offers
+    upto = np.cumsum(copies)
+    upto -= np.repeat(upto[first] - copies[first], np.diff(np.r_[first, len(offers)]))
+    enough = upto >= n[offers]
+    nth = np.full(pm.n_offers, np.inf)
+    np.minimum.at(nth, offers[enough], prices[enough])
+    return nth
+
+
+def _dominated_seller_offers(groups, sellers, prices, cover, need, keep, n_sellers, capacity):
+    """
+    Mask of the offers of sellers dominated by a seller with a superset of
+    cards, whose copies (cover, see prune) cost at most the other's prices.
+    """
+    idx, *_ = np.where(keep)
+    if len(idx) == 0:
+        return np.zeros(len(keep), dtype=bool)
+    keys = groups[idx].astype(np.int64) * n_sellers + sellers[idx]
+    # A seller's best printing of a group first
+    order = np.lexsort((cover[idx], keys))
+    keys, key_prices = keys[order], cover[idx][order]
+    counts = np.bincount(sellers[idx], minlength=n_sellers)
+    # Most cards a seller's letter can get
+    load = np.bincount(sellers[idx], weights=need[idx], minlength=n_sellers)
+
+    by_seller = idx[np.argsort(sellers[idx], kind="stable")]
+    seller_start = np.searchsorted(sellers[by_seller], np.arange(n_sellers + 1))
+    by_group = idx[np.argsort(groups[idx], kind="stable")]
+    group_sorted = groups[by_group]
+
+    def group_price(group_ids, seller_ids):
+        k = group_ids[None, :].astype(np.int64) * n_sellers + seller_ids[:, None]
+        pos = np.minimum(np.searchsorted(keys, k), len(keys) - 1)
+        return np.where(keys[pos] == k, key_prices[pos], np.inf)
+
+    dominated = np.zeros(n_sellers, dtype=bool)
+    for seller in np.argsort(counts, kind="stable"):
+        n_cards = counts[seller]
+        if n_cards == 0:
+            continue
+        offers = by_seller[seller_start[seller]:seller_start[seller + 1]]
+        g, p = groups[offers], prices[offers]
+
+        first = np.searchsorted(group_sorted, g[0], side="left")
+        last = np.searchsorted(group_sorted, g[0], side="right")
+        cands = sellers[by_group[first:last]]
+        cands = cands[(cands != seller) & (counts[cands] >= n_cards)
+                      & (load[cands] <= capacity)]
+        if len(cands) == 0:
+            continue
+
+        cand_p = group_price(g, cands)
+        at_most = (cand_p <= p + EPS).all(axis=1)
+        # Strict tie break, so two identical sellers don't remove each other
+        better = (cand_p < p - EPS).any(axis=1) | (counts[cands] > n_cards) | (cands < seller)
+        dominated[seller] = (at_most & better).any()
+
+    return keep & dominated[sellers]
+
+
+def format_report(report):
+    before, after = report["offers"]
+    s_before, s_after = report["sellers"]
+    r_before, r_after = report["rows"]
+    return (
+        f"Pruning kept {after}/{before} offers, {s_after}/{s_before} sellers "
+        f"and {r_after}/{r_before} printings "
+        f"({report['same_seller_printings']} same seller printings, "
+        f"{report['dominated_sellers']} dominated sellers, "
+        f"{report['dominated_offers']} dominated offers, "
+        f"{report['single_card_sellers']} single card sellers removed)"
+    )
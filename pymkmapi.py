@@ -12,18 +12,28 @@ import copy
 import json
 import logging
 import logging.handlers
+import random
 import re
 import sys
+import time
 import urllib.parse
 import base64, zlib
 import csv
 import codecs
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+import httpx
 import requests
 from json import JSONDecodeError
 from authlib.integrations.httpx_client import AsyncOAuth1Client, OAuth1Auth
 from requests import ConnectionError
-from requests_oauthlib import OAuth1Session
+from requests_oauthlib import OAuth1
+
+from fast_json import PROJECTIONS, decode_response, loads
+from metrics import get_metrics
+from mkm_cache import ResponseCache
+from rate_limiter import RateLimiter
 
 
 class CardmarketError(Exception):
@@ -45,6 +55,59 @@ class CardmarketError(Exception):
         return prefix_string + error_string
 
 
+def timed_signing(sign, *args, **kwargs):
+    """Call sign, adding the time it takes to the oauth_sign phase when metrics are on."""
+    metrics = get_metrics()
+    if not metrics.enabled:
+        return sign(*args, **kwargs)
+    started = time.perf_counter()
+    try:
+        return sign(*args, **kwargs)
+    finally:
+        metrics.add_time("oauth_sign", time.perf_counter() - started)
+
+
+class TimedOAuth1Auth(OAuth1Auth):
+    """OAuth1Auth of the async client, timing every signature."""
+
+    def prepare(self, *args, **kwargs):
+        return timed_signing(super().prepare, *args, **kwargs)
+
+
+class TimedAsyncOAuth1Client(AsyncOAuth1Client):
+    auth_class = TimedOAuth1Auth
+
+
+class RealmSession:
+    """
+    Signs requests for one OAuth realm (the request URL, as Cardmarket requires)
+    and sends them over the shared keep-alive session of PyMkmApi.
+    """
+
+    def __init__(self, session, auth):
+        self.session = session
+        self.auth = auth
+
+    def sign(self, request):
+        return timed_signing(self.auth, request)
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, auth=self.sign, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.session.put(url, auth=self.sign, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, auth=self.sign, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.session.delete(url, auth=self.sign, **kwargs)
+
+    def close(self):
+        # The connection pool is owned by PyMkmApi and outlives this request
+        pass
+
+
 class PyMkmApi:
     logger = None
     config = None
@@ -68,6 +131,12 @@ class PyMkmApi:
         "Czech",
         "Hungarian",
     ]
+    # Items per page for paginated (206 Partial Content) endpoints, and how many
+    # pages are requested per window (the rate limiter decides how many run at once)
+    PAGE_SIZE = 100
+    PAGE_CONCURRENCY = 10
+    # Streamed responses are written to the cache in batches of this size
+    CACHE_FLUSH_SIZE = 50
     ## These are from 2020-11-22, not the same as in the API specs:
     stock_csv_fieldnames = [
         "idArticle",
@@ -123,8 +192,58 @@ class PyMkmApi:
             sh.setFormatter(formatter)
             self.logger.addHandler(sh)
 
+        # Can point at the sandbox or a local mock server instead of the live API
+        self.base_url = self.config.get("base_url", self.base_url)
         self.requests_max = 0
         self.requests_count = 0
+        self.cache = ResponseCache.from_config(self.config)
+        self.limiter = RateLimiter.from_config(self.config)
+
+        retry_config = self.config.get("retry", {})
+        self.max_retries = retry_config.get("max_retries", 4)
+        self.backoff_base = retry_config.get("backoff_base", 0.5)
+        self.backoff_max = retry_config.get("backoff_max", 30)
+        self.retries_count = 0
+        self.failed_items = {}
+        self.truncated_items = set()
+
+        # Long-lived clients so requests reuse connections instead of doing a
+        # new TCP+TLS handshake every time
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=self.limiter.max_concurrency
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.__async_client = None
+        self.__async_loop = None
+
+        # Optional faster decoding: orjson if installed, /articles projected to the
+        # fields that are used, off the event loop in a thread or process pool
+        json_config = self.config.get("fast_json", {})
+        self.fast_json = json_config.get("enabled", False)
+        self.decode_pool_type = json_config.get("pool", "thread")
+        self.decode_workers = json_config.get("workers")
+        self.__decode_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+        if self.__decode_pool is not None:
+            self.__decode_pool.shutdown()
+            self.__decode_pool = None
+        if self.__async_client is not None:
+            if not self.__async_loop.is_closed():
+                self.__async_loop.run_until_complete(self.__async_client.aclose())
+            self.__async_client = None
 
     def __handle_response(self, response):
         handled_codes = (
@@ -152,6 +271,8 @@ class PyMkmApi:
         try:
             self.requests_count = int(response.headers["X-Request-Limit-Count"])
             self.requests_max = int(response.headers["X-Request-Limit-Max"])
+            self.limiter.update_quota(self.requests_count, self.requests_max)
+            get_metrics().update_quota(self.requests_count, self.requests_max)
             self.logger.debug(f">> Quota: {self.requests_count}/{self.requests_max}")
         except (AttributeError, KeyError) as err:
             self.logger.debug(f">> Attribute not found in header: {err}")
@@ -161,12 +282,15 @@ class PyMkmApi:
             return provided_oauth
         else:
             if self.config is not None:
-                oauth = OAuth1Session(
-                    self.config["app_token"],
-                    client_secret=self.config["app_secret"],
-                    resource_owner_key=self.config["access_token"],
-                    resource_owner_secret=self.config["access_token_secret"],
-                    realm=url,
+                oauth = RealmSession(
+                    self.session,
+                    OAuth1(
+                        self.config["app_token"],
+                        client_secret=self.config["app_secret"],
+                        resource_owner_key=self.config["access_token"],
+                        resource_owner_secret=self.config["access_token_secret"],
+                        realm=url,
+                    ),
                 )
 
                 if oauth is None:
@@ -220,7 +344,27 @@ class PyMkmApi:
         if r:
             return r.json()
 
+    def __check_quota(self, n_requests):
+        if not self.limiter.can_start(n_requests):
+            raise CardmarketError(
+                f"Request quota depleted: {n_requests} requests needed, "
+                f"{self.limiter.quota_remaining} left. :("
+            )
+
+    @staticmethod
+    def __response_ok(response):
+        return response is not None and response.status_code < 500 and (
+            response.status_code != requests.codes.too_many_requests
+        )
+
+    def __endpoint(self, url):
+        """First path segment after the base url, like "articles" or "wantslist"."""
+        return url[len(self.base_url):].strip("/").split("/")[0]
+
     def mkm_request(self, mkm_oauth, url, params=None):
+        self.limiter.acquire()
+        started = time.monotonic()
+        r = None
         try:
             r = mkm_oauth.get(url, params=params, allow_redirects=False)
             self.__read_request_limits_from_header(r)
@@ -237,6 +381,21 @@ class PyMkmApi:
             print(f"\n>> Cardmarket connection error: {err} for {url}")
             self.logger.error(f"{err} for {url}")
             # sys.exit(0)
+        finally:
+            latency = time.monotonic() - started
+            self.limiter.release(
+                latency,
+                ok=self.__response_ok(r),
+                throttled=r is not None and r.status_code == requests.codes.too_many_requests,
+            )
+            metrics = get_metrics()
+            if metrics.enabled:
+                metrics.observe_request(
+                    self.__endpoint(url),
+                    latency,
+                    len(r.content) if r is not None else 0,
+                    r.status_code if r is not None else None,
+                )
 
     def get_expansions(self, game_id, provided_oauth=None):
         url = f"{self.base_url}/games/{str(game_id)}/expansions"
@@ -269,58 +428,286 @@ class PyMkmApi:
         if r:
             return r.json()
 
-    async def fetch(self, sem, client, url, uri, item_type, item_id, progressbar=None, **kwargs):
-        async with sem:
-            client_auth = copy.copy(client.auth)
-            client_auth.realm = url
-            try:
-                resp = await client.get(url, auth=client_auth, params=kwargs)
-                self.__read_request_limits_from_header(resp)
-            except Exception as err:
-                self.logger.debug(f"Timeout on {item_type} {item_id}")
+    async def __fetch_once(self, client, url, item_type, item_id, **kwargs):
+        """One attempt, returns (response json, error). error is None on success."""
+        await self.limiter.acquire_async()
+        metrics = get_metrics()
+        started = time.monotonic()
+        resp = None
+        client_auth = copy.copy(client.auth)
+        client_auth.realm = url
+        try:
+            resp = await client.get(url, auth=client_auth, params=kwargs)
+            self.__read_request_limits_from_header(resp)
+        except Exception as err:
+            self.logger.debug(f"Timeout on {item_type} {item_id}: {err!r}")
+            return None, f"timeout ({type(err).__name__})"
+        finally:
+            latency = time.monotonic() - started
+            self.limiter.release(
+                latency,
+                ok=self.__response_ok(resp),
+                throttled=resp is not None and resp.status_code == requests.codes.too_many_requests,
+            )
+            if metrics.enabled:
+                metrics.observe_request(
+                    item_type,
+                    latency,
+                    len(resp.content) if resp is not None else 0,
+                    resp.status_code if resp is not None else None,
+                )
+
+        if resp.status_code == requests.codes.no_content:
+            return {}, None
+        elif resp.status_code == requests.codes.too_many_requests:
+            self.logger.warning(f"Throttled on {item_type} {item_id}")
+            return None, "429 too many requests"
+        elif resp.status_code >= 500:
+            return None, f"{resp.status_code} server error"
+        try:
+            if not metrics.enabled:
+                return await self.__decode(item_type, resp), None
+            started = time.perf_counter()
+            response = await self.__decode(item_type, resp)
+            metrics.add_time("json_decode", time.perf_counter() - started)
+            return response, None
+        except JSONDecodeError as err:
+            self.logger.error(f"Reponse: {resp.status_code}")
+            return None, f"{resp.status_code} invalid JSON"
+
+    def __get_decode_pool(self):
+        if self.__decode_pool is None and self.decode_pool_type is not None:
+            if self.decode_pool_type == "process":
+                self.__decode_pool = ProcessPoolExecutor(self.decode_workers)
             else:
-                try:
-                    json = resp.json()
-                    return json
-                except JSONDecodeError as err:
-                    self.logger.error(f"Reponse: {resp.status_code}")
-            finally:
-                if progressbar:
-                    progressbar.update()
-
-    async def get_items(self, item_type, item_id_list, progressbar=None, **kwargs):
-        async with AsyncOAuth1Client(
-            client_id=self.config["app_token"],
-            client_secret=self.config["app_secret"],
-            token=self.config["access_token"],
-            token_secret=self.config["access_token_secret"],
-            timeout=self.config["cardmarket_request_timeout"],
-        ) as client:
-            tasks = []
-            sem = asyncio.Semaphore(50)
-            for item_id in item_id_list:
-                tasks.append(
-                    asyncio.ensure_future(
-                        self.fetch(
-                            sem,
-                            client,
-                            f"{self.base_url}/{item_type}/{str(item_id)}",
-                            f"{self.base_url}/{item_type}/",
-                            item_type,
-                            item_id,
-                            progressbar,
-                            **kwargs
-                        )
+                self.__decode_pool = ThreadPoolExecutor(self.decode_workers)
+        return self.__decode_pool
+
+    async def __decode(self, item_type, resp):
+        if not self.fast_json:
+            return resp.json()
+        pool = self.__get_decode_pool()
+        if pool is None:
+            return decode_response(item_type, resp.content)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(pool, decode_response, item_type, resp.content)
+
+    def __loads(self, r):
+        return loads(r.content) if self.fast_json else r.json()
+
+    async def fetch(self, client, url, uri, item_type, item_id, progressbar=None, **kwargs):
+        """
+        Get one item, retrying timeouts, 429s and server errors with exponential
+        backoff and full jitter. Returns (response json, None) or (None, error)
+        once the retries are used up.
+        """
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+                await asyncio.sleep(random.uniform(0, delay))
+                self.retries_count += 1
+                get_metrics().count("retries")
+            response, error = await self.__fetch_once(client, url, item_type, item_id, **kwargs)
+            if error is None:
+                break
+        if progressbar:
+            progressbar.update()
+        return response, error
+
+    def __get_async_client(self):
+        # One client per event loop, httpx connections can't move between loops
+        loop = asyncio.get_event_loop()
+        if self.__async_client is None or self.__async_loop is not loop:
+            self.__async_client = TimedAsyncOAuth1Client(
+                client_id=self.config["app_token"],
+                client_secret=self.config["app_secret"],
+                token=self.config["access_token"],
+                token_secret=self.config["access_token_secret"],
+                timeout=self.config["cardmarket_request_timeout"],
+                http2=importlib.util.find_spec("h2") is not None,
+                limits=httpx.Limits(
+                    max_connections=self.limiter.max_concurrency,
+                    max_keepalive_connections=self.limiter.max_concurrency,
+                ),
+            )
+            self.__async_loop = loop
+        return self.__async_client
+
+    async def __fetch_pages(self, client, url, uri, item_type, item_id, page_size, more_pages, **kwargs):
+        """
+        Page through one item page_size entries at a time, until a page comes
+        back short or more_pages(item_id, response so far) says the rest isn't
+        needed. The pages are merged into one response.
+        """
+        merged = {}
+        start = 0
+        while True:
+            page, error = await self.fetch(
+                client, url, uri, item_type, item_id, start=start, maxResults=page_size, **kwargs
+            )
+            if error is not None:
+                return None, error
+            n_items = 0
+            for key, value in page.items():
+                if isinstance(value, list):
+                    merged.setdefault(key, []).extend(value)
+                    n_items = max(n_items, len(value))
+                elif isinstance(value, dict) and key.endswith("_columns"):
+                    # Projected by fast_json, one list per field
+                    columns = merged.setdefault(key, {name: [] for name in value})
+                    for name, column in value.items():
+                        columns[name].extend(column)
+                    n_items = max(n_items, len(next(iter(value.values()), [])))
+                else:
+                    merged.setdefault(key, value)
+            if n_items < page_size:
+                return merged, None
+            if more_pages is not None and not more_pages(item_id, merged):
+                # Only complete for the caller that cut it short, so it isn't cached
+                self.truncated_items.add(item_id)
+                return merged, None
+            start += page_size
+
+    async def __fetch_item(
+        self, client, item_type, item_id, progressbar, on_response, page_size, more_pages, **kwargs
+    ):
+        url = f"{self.base_url}/{item_type}/{str(item_id)}"
+        uri = f"{self.base_url}/{item_type}/"
+        if page_size is None:
+            response, error = await self.fetch(client, url, uri, item_type, item_id, progressbar, **kwargs)
+        else:
+            response, error = await self.__fetch_pages(
+                client, url, uri, item_type, item_id, page_size, more_pages, **kwargs
+            )
+            if progressbar:
+                progressbar.update()
+        if error is None and on_response is not None:
+            # Handled as soon as it arrives, while the other requests are in flight
+            metrics = get_metrics()
+            if not metrics.enabled:
+                return on_response(item_id, response), None
+            started = time.perf_counter()
+            result = on_response(item_id, response)
+            metrics.add_time(f"consume/{item_type}", time.perf_counter() - started)
+            return result, None
+        if error is not None:
+            get_metrics().count("failed_items")
+        return response, error
+
+    async def get_items(
+        self,
+        item_type,
+        item_id_list,
+        progressbar=None,
+        on_response=None,
+        page_size=None,
+        more_pages=None,
+        **kwargs
+    ):
+        self.__check_quota(len(item_id_list))
+        client = self.__get_async_client()
+        tasks = []
+        for item_id in item_id_list:
+            tasks.append(
+                asyncio.ensure_future(
+                    self.__fetch_item(
+                        client,
+                        item_type,
+                        item_id,
+                        progressbar,
+                        on_response,
+                        page_size,
+                        more_pages,
+                        **kwargs
                     )
                 )
-            responses = await asyncio.gather(*tasks, return_exceptions=False)
-            return responses
+            )
+        results = await asyncio.gather(*tasks, return_exceptions=False)
+        return dict(zip(item_id_list, results))
 
-    def get_items_async(self, item_type, item_id_list, progressbar=None, **kwargs):
-        loop = asyncio.get_event_loop()
-        return loop.run_until_complete(
-            self.get_items(item_type, item_id_list, progressbar, **kwargs)
-        )
+    def get_items_async(
+        self,
+        item_type,
+        item_id_list,
+        progressbar=None,
+        on_response=None,
+        page_size=None,
+        more_pages=None,
+        **kwargs
+    ):
+        """
+        Returns {item_id: response} for every id that could be fetched. Ids that
+        still failed after all retries are left out and listed with their last
+        error in self.failed_items.
+
+        With on_response(item_id, response), every response is handed over as
+        soon as it arrives and not kept, the result maps ids to what
+        on_response returned instead.
+
+        With page_size, every item is fetched in pages of that size (start and
+        maxResults), stopping early when more_pages(item_id, response so far)
+        returns False. Those cut short responses aren't cached, whether they
+        are complete enough depends on the caller.
+        """
+        cache_params = kwargs if page_size is None else {**kwargs, "maxResults": page_size}
+        if self.fast_json and item_type in PROJECTIONS:
+            # Projected responses are cached apart from full ones
+            cache_params = {**cache_params, "projection": "columns"}
+        cached = {}
+        if self.cache is not None:
+            cached = self.cache.get_many(item_type, item_id_list, cache_params)
+            get_metrics().count("cache_hits", len(cached))
+        if on_response is not None:
+            cached = {item_id: on_response(item_id, response) for item_id, response in cached.items()}
+
+        consume = on_response
+        pending = {}
+        if on_response is not None and self.cache is not None:
+            def consume(item_id, response):
+                if item_id not in self.truncated_items:
+                    pending[item_id] = response
+                if len(pending) >= self.CACHE_FLUSH_SIZE:
+                    self.cache.set_many(item_type, pending, cache_params)
+                    pending.clear()
+                return on_response(item_id, response)
+
+        # Only request what isn't cached, and every id just once
+        to_fetch = list(dict.fromkeys(x for x in item_id_list if x not in cached))
+        fetched = {}
+        self.failed_items = {}
+        self.truncated_items = set()
+        if to_fetch:
+            loop = asyncio.get_event_loop()
+            with get_metrics().phase(f"fetch/{item_type}"):
+                results = loop.run_until_complete(
+                    self.get_items(
+                        item_type,
+                        to_fetch,
+                        progressbar,
+                        on_response=consume,
+                        page_size=page_size,
+                        more_pages=more_pages,
+                        **kwargs
+                    )
+                )
+            for item_id, (response, error) in results.items():
+                if error is None:
+                    fetched[item_id] = response
+                else:
+                    self.failed_items[item_id] = error
+            if self.cache is not None:
+                complete = {k: v for k, v in fetched.items() if k not in self.truncated_items}
+                self.cache.set_many(
+                    item_type, pending if on_response is not None else complete, cache_params
+                )
+
+        if self.failed_items:
+            self.logger.error(
+                f"Giving up on {len(self.failed_items)} {item_type} after "
+                f"{self.max_retries} retries: {self.failed_items}"
+            )
+        return {**cached, **fetched}
 
 # TODO: Finish this
     # def find_products_async(self, name_list, progressbar=None):
@@ -616,9 +1003,30 @@ class PyMkmApi:
         provided_oauth=None,
         **kwargs,
     ):
-        INCREMENT = 100
+        return list(
+            self.iter_partial_content(
+                item_name,
+                url,
+                start,
+                avoid_redirect=avoid_redirect,
+                provided_oauth=provided_oauth,
+                **kwargs,
+            )
+        )
+
+    def iter_partial_content(
+        self,
+        item_name,
+        url,
+        start=0,
+        avoid_redirect=False,
+        provided_oauth=None,
+        **kwargs,
+    ):
+        # The first page tells us (Content-Range) how many pages there are, the
+        # rest are fetched concurrently and the items yielded page by page.
         params = kwargs.copy()
-        params.update({"start": start, "maxResults": INCREMENT})
+        params.update({"start": start, "maxResults": self.PAGE_SIZE})
 
         if avoid_redirect:
             tmp_url = f"{url}/{start}"
@@ -628,42 +1036,49 @@ class PyMkmApi:
         mkm_oauth = self.__setup_auth_session(tmp_url, provided_oauth)
         r = self.mkm_request(mkm_oauth, tmp_url, params=params)
 
-        max_items = 0
-        if r:
-            if r.status_code == requests.codes.partial_content:
-                max_items = self.__get_max_items_from_header(r)
-                self.logger.debug(
-                    f"> Content-Range header: {r.headers['Content-Range']}"
-                )
-                self.logger.debug(
-                    f"> # {item_name}s in response: {str(len(r.json()[item_name]))}"
-                )
-                next_start = start + INCREMENT
-                if next_start >= max_items and self.__handle_response(r):
-                    return r.json()[item_name]
-                else:
-                    self.logger.debug(
-                        f"-> get {item_name}s recurring to next_start={next_start}"
-                    )
-                    # item_name,url,start=0,avoid_redirect=False,provided_oauth=None,**kwargs,
-                    return r.json()[item_name] + self.handle_partial_content(
-                        item_name,
-                        url,
-                        # mkm_oauth,
-                        next_start,
-                        avoid_redirect=avoid_redirect,
-                        provided_oauth=provided_oauth,
-                        **kwargs,
-                    )
-            elif r.status_code == requests.codes.no_content:
-                raise CardmarketError(f"No {item_name}s found.")
-                return False
-            elif r.status_code == requests.codes.ok:
-                return r.json()[item_name]
-            else:
-                raise ConnectionError(r)
-        else:
-            pass
+        if not r:
+            return
+        elif r.status_code == requests.codes.no_content:
+            raise CardmarketError(f"No {item_name}s found.")
+        elif r.status_code == requests.codes.ok:
+            yield from self.__loads(r)[item_name]
+            return
+        elif r.status_code != requests.codes.partial_content:
+            raise ConnectionError(r)
+
+        max_items = self.__get_max_items_from_header(r)
+        self.logger.debug(f"> Content-Range header: {r.headers['Content-Range']}")
+        yield from self.__loads(r)[item_name]
+
+        page_starts = list(range(start + self.PAGE_SIZE, max_items, self.PAGE_SIZE))
+        if not page_starts:
+            return
+        self.logger.debug(f"-> get {len(page_starts)} more pages of {item_name}s")
+
+        # Pages are requested in windows, so only a window's worth is held in memory
+        loop = asyncio.get_event_loop()
+        for i in range(0, len(page_starts), self.PAGE_CONCURRENCY):
+            window = page_starts[i : i + self.PAGE_CONCURRENCY]
+            pages = loop.run_until_complete(
+                self.get_pages(url, window, avoid_redirect, **kwargs)
+            )
+            for page_start, (page, error) in zip(window, pages):
+                if error is not None or item_name not in page:
+                    self.logger.error(f"Failed to get {item_name}s starting at {page_start} for {url}")
+                    raise ConnectionError(f"Failed to get {item_name}s page for {url}")
+                yield from page[item_name]
+
+    async def get_pages(self, url, page_starts, avoid_redirect=False, **kwargs):
+        self.__check_quota(len(page_starts))
+        client = self.__get_async_client()
+        tasks = []
+        for page_start in page_starts:
+            params = {**kwargs, "start": page_start, "maxResults": self.PAGE_SIZE}
+            page_url = f"{url}/{page_start}" if avoid_redirect else url
+            tasks.append(
+                self.fetch(client, page_url, url, "page", page_start, **params)
+            )
+        return await asyncio.gather(*tasks)
 
     def find_product(self, search, provided_oauth=None, **kwargs):
         ## https://api.cardmarket.com/ws/documentation/API_2.0:Find_Products
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Adaptive rate limiting for Cardmarket API requests, shared by the sync and
+async code paths of PyMkmApi.
+
+- A token bucket caps the request rate (optional, requests_per_second).
+- The number of requests in flight is tuned with AIMD: it grows by one per
+  window of fast successful requests and is halved on errors, 429s and
+  latency spikes.
+- The X-Request-Limit-Count/Max headers are fed back in, and requests slow
+  down as the daily quota runs out.
+"""
+
+import asyncio
+import collections
+import logging
+import threading
+import time
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        max_concurrency=50,
+        min_concurrency=1,
+        start_concurrency=None,
+        requests_per_second=None,
+        quota_reserve=0,
+        slow_down_fraction=0.1,
+        latency_factor=3.0,
+        latency_floor=0.25,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = float(start_concurrency or max_concurrency)
+        self.requests_per_second = requests_per_second
+        # Requests kept back from the daily quota, for the things the user does by hand
+        self.quota_reserve = quota_reserve
+        self.slow_down_fraction = slow_down_fraction
+        self.latency_factor = latency_factor
+        # Latencies below this never count as a spike, however fast the best one was
+        self.latency_floor = latency_floor
+
+        self.in_flight = 0
+        self.tokens = float(max_concurrency)
+        self.last_refill = time.monotonic()
+        self.latency_ewma = None
+        self.latency_min = None
+        self.last_decrease = 0.0
+        self.paused_until = 0.0
+        self.quota_count = None
+        self.quota_max = None
+        self._lock = threading.Lock()
+        # (loop, future) of async requests waiting for a free slot
+        self._waiters = collections.deque()
+
+    @classmethod
+    def from_config(cls, config):
+        rate_config = config.get("rate_limit", {})
+        return cls(
+            max_concurrency=rate_config.get("max_concurrency", 50),
+            min_concurrency=rate_config.get("min_concurrency", 1),
+            start_concurrency=rate_config.get("start_concurrency"),
+            requests_per_second=rate_config.get("requests_per_second"),
+            quota_reserve=rate_config.get("quota_reserve", 0),
+        )
+
+    @property
+    def limit(self):
+        return max(self.min_concurrency, min(self.max_concurrency, int(self.concurrency)))
+
+    @property
+    def quota_remaining(self):
+        if self.quota_max is None:
+            return None
+        return max(self.quota_max - self.quota_count - self.quota_reserve, 0)
+
+    def update_quota(self, count, maximum):
+        with self._lock:
+            self.quota_count, self.quota_max = count, maximum
+
+    def can_start(self, n_requests):
+        """False if a batch of n_requests would run past the remaining quota."""
+        remaining = self.quota_remaining
+        return remaining is None or n_requests <= remaining
+
+    def _rate(self):
+        rate = self.requests_per_second
+        remaining = self.quota_remaining
+        if remaining is not None and self.quota_max:
+            # Ease off linearly over the last slow_down_fraction of the quota
+            fraction = remaining / (self.quota_max * self.slow_down_fraction)
+            if fraction < 1:
+                rate = max(fraction, 0.05) * (rate or self.limit)
+        return rate
+
+    def _try_acquire(self, waiter=None):
+        """
+        Take a slot if one is free, otherwise return how long to wait. With a
+        waiter and all slots taken, the waiter is woken by release() and None
+        is returned.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.in_flight >= self.limit:
+                if waiter is None:
+                    return 0.005
+                self._waiters.append(waiter)
+                return None
+
+            rate = self._rate()
+            if rate is not None:
+                self.tokens = min(
+                    self.tokens + (now - self.last_refill) * rate, max(rate, 1.0)
+                )
+                self.last_refill = now
+                if self.tokens < 1:
+                    return (1 - self.tokens) / rate
+                self.tokens -= 1
+
+            self.in_flight += 1
+            return 0.0
+
+    def acquire(self):
+        while True:
+            wait = self._try_acquire()
+            if wait == 0.0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            future = loop.create_future()
+            wait = self._try_acquire((loop, future))
+            if wait == 0.0:
+                return
+            if wait is None:
+                # Sleep until a release frees a slot, instead of polling with hundreds of tasks
+                try:
+                    await asyncio.wait_for(future, timeout=0.5)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(wait)
+
+    def _wake_waiters(self):
+        free = self.limit - self.in_flight
+        while free > 0 and self._waiters:
+            loop, future = self._waiters.popleft()
+            if future.done():
+                continue
+            loop.call_soon_threadsafe(_wake, future)
+            free -= 1
+
+    def release(self, latency=None, ok=True, throttled=False):
+        """Hand a slot back and adjust the concurrency to what the request saw."""
+        with self._lock:
+            self.in_flight -= 1
+            now = time.monotonic()
+
+            slow = False
+            if latency is not None and ok:
+                self.latency_min = latency if self.latency_min is None else min(self.latency_min, latency)
+                self.latency_ewma = (
+                    latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+                )
+                slow = self.latency_ewma > max(
+                    self.latency_factor * self.latency_min, self.latency_floor
+                )
+
+            if throttled:
+                # Server says slow down, back off completely for a moment
+                self.paused_until = now + max(1.0, self.latency_ewma or 1.0)
+
+            if throttled or not ok or slow:
+                # At most one decrease per round trip, one bad window shouldn't collapse it
+                if now - self.last_decrease > (self.latency_ewma or 0.5):
+                    self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+                    self.last_decrease = now
+                    self.logger.debug(f">> Lowering concurrency to {self.limit}")
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self._wake_waiters()
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Compiles the search_filters from config.json into the query parameters the
+/articles endpoint filters on server side, and an ArticleFilter for the rest,
+which is applied as a vectorized mask while the responses are read.
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Passed through to the API as they are
+API_PARAMS = ("idLanguage", "minCondition", "userType", "minUserScore", "minAvailable")
+# The API treats "False" as true, these have to be sent as "true"/"false"
+API_BOOL_PARAMS = ("isFoil", "isSigned", "isAltered", "isPlayset")
+# Largest page the /articles endpoint returns
+MAX_PAGE_SIZE = 1000
+
+
+class ArticleFilter:
+    def __init__(
+        self,
+        countries=None,
+        languages=None,
+        max_price=None,
+        excluded_sellers=None,
+        max_offers_per_country=None,
+        page_size=MAX_PAGE_SIZE,
+    ):
+        self.countries = np.array(sorted(countries)) if countries else None
+        self.languages = np.array(sorted(languages)) if languages else None
+        self.max_price = max_price
+        self.excluded_sellers = np.array(sorted(excluded_sellers)) if excluded_sellers else None
+        # Stop paging a product once every country has this many offers
+        self.max_offers_per_country = max_offers_per_country
+        self.page_size = page_size
+
+    @property
+    def needs_country(self):
+        return self.countries is not None or self.max_offers_per_country is not None
+
+    @property
+    def needs_language(self):
+        return self.languages is not None
+
+    def mask(self, sellers, prices, countries=None, languages=None):
+        keep = np.ones(len(prices), dtype=bool)
+        if self.countries is not None:
+            keep &= np.isin(countries, self.countries)
+        if self.languages is not None:
+            keep &= np.isin(languages, self.languages)
+        if self.max_price is not None:
+            keep &= prices <= self.max_price
+        if self.excluded_sellers is not None:
+            keep &= ~np.isin(sellers, self.excluded_sellers)
+        return keep
+
+
+def compile_filters(search_filters, languages):
+    """Split search_filters into (API query params, ArticleFilter)."""
+    params = {}
+    local = {}
+    for key, value in search_filters.items():
+        if key in API_PARAMS:
+            params[key] = value
+        elif key in API_BOOL_PARAMS:
+            params[key] = str(value).lower()
+        elif key == "language":
+            # One language can be filtered on server side, several only locally
+            names = [value] if isinstance(value, str) else list(value)
+            try:
+                ids = [languages.index(name) for name in names]
+            except ValueError:
+                raise Exception("Configuration error (search_filters, language).")
+            if len(ids) == 1:
+                params["idLanguage"] = ids[0]
+            else:
+                local["languages"] = ids
+        elif key == "countries":
+            local["countries"] = value
+        elif key == "maxPrice":
+            local["max_price"] = value
+        elif key == "excludedSellers":
+            local["excluded_sellers"] = value
+        elif key == "maxOffersPerCountry":
+            local["max_offers_per_country"] = value
+        elif key == "pageSize":
+            local["page_size"] = min(int(value), MAX_PAGE_SIZE)
+        else:
+            logger.warning(f"Unknown search filter {key}, ignoring it")
+    return params, ArticleFilter(**local)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Shipping cost model used by the buywizard optimizer.
+"""
+
+import json
+
+import numpy as np
+
+# (max cards in the letter, cost) for a single seller, cheapest bracket first.
+SHIPPING_BRACKETS = [(4, 1.26), (17, 2.22), (40, 3.38)]
+MAX_CARDS_PER_SELLER = SHIPPING_BRACKETS[-1][0]
+
+
+def calc_shipping_cost(n):
+    if n <= 0:
+        return 0.0
+    for max_cards, cost in SHIPPING_BRACKETS:
+        if n <= max_cards:
+            return cost
+    return np.inf
+
+
+def shipping_cost_table(max_cards=MAX_CARDS_PER_SELLER):
+    """Shipping cost indexed by number of cards, the last entry is the first infeasible count."""
+    return np.array([calc_shipping_cost(n) for n in range(max_cards + 2)])
+
+
+def max_shipping_step(ship=None):
+    """
+    Largest increase in shipping cost from moving one card from a seller's
+    letter to another's. ship is a table by number of cards, one row of it
+    per seller, or a stack of those per value bracket (see value_tables): the
+    card then can also take both letters to any other value bracket.
+    """
+    ship = shipping_cost_table() if ship is None else np.asarray(ship)
+    ship = ship.reshape((-1,) + ship.shape[-2:]) if ship.ndim > 1 else ship[None, None]
+    high, low = ship.max(axis=0), ship.min(axis=0)
+    with np.errstate(invalid="ignore"):
+        added = high[:, 1:] - low[:, :-1]
+        removed = high[:, :-1] - low[:, 1:]
+    added, removed = added[np.isfinite(added)], removed[np.isfinite(removed)]
+    step = added.max() if len(added) else 0.0
+    # Taking a card out of a letter only costs something if it can get cheaper with more cards
+    return step + max(removed.max() if len(removed) else 0.0, 0.0)
+
+
+def max_cards(ship):
+    """Most cards every seller of a shipping table (1-D, or one row per seller) can send."""
+    ship = np.atleast_2d(ship)
+    return int(np.isfinite(ship).sum(axis=1).min()) - 1
+
+
+def seller_shipping(shipping, seller_ids, value=0.0):
+    """
+    Shipping cost by number of cards per seller, shape (len(seller_ids),
+    max_cards + 2), at a basket value (None for the cheapest value bracket).
+    shipping is a ShippingTable, or None for the flat brackets.
+    """
+    if shipping is None:
+        table = shipping_cost_table()
+        return np.broadcast_to(table, (len(seller_ids), len(table)))
+    return shipping.count_table(seller_ids, value)
+
+
+def value_tables(shipping, seller_ids):
+    """seller_shipping for every value bracket, shape (value brackets, len(seller_ids), max_cards + 2)."""
+    if shipping is None:
+        return seller_shipping(shipping, seller_ids)[None]
+    return shipping.value_tables(seller_ids)
+
+
+def has_value_brackets(shipping):
+    """Whether letters cost more or less depending on the basket value."""
+    return shipping is not None and len(shipping.value_brackets) > 0
+
+
+class ShippingTable:
+    """
+    Shipping costs by (seller country, card count bracket, basket value
+    bracket), loaded once and queried with arrays of sellers.
+
+    count_brackets are the most cards each bracket holds, more than the last
+    one can't be sent. value_brackets are the basket values from which the
+    next bracket applies (e.g. tracked letters above 25 euro). costs has shape
+    (countries, count brackets, value brackets); sellers in countries that
+    aren't in the table, or whose country isn't known, use the "default" row.
+    """
+
+    def __init__(self, count_brackets, value_brackets, costs, countries=("default",), seller_countries=None):
+        self.count_brackets = np.asarray(count_brackets, dtype=np.int64)
+        self.value_brackets = np.asarray(value_brackets, dtype=np.float64)
+        self.countries = list(countries)
+        costs = np.asarray(costs, dtype=np.float64)
+        n_countries, _, n_values = costs.shape
+        # Index 0 is no cards (free), the last one more cards than fit (infeasible)
+        self.costs = np.concatenate(
+            [np.zeros((n_countries, 1, n_values)), costs, np.full((n_countries, 1, n_values), np.inf)],
+            axis=1,
+        )
+        self.default = self.countries.index("default") if "default" in self.countries else 0
+        self.seller_countries = {}
+        self._known_ids = np.zeros(0, dtype=np.int64)
+        self._known_rows = np.zeros(0, dtype=np.int64)
+        if seller_countries:
+            self.set_seller_countries(seller_countries)
+
+    @classmethod
+    def from_brackets(cls, brackets=SHIPPING_BRACKETS):
+        """The flat model, same costs for every country and basket value."""
+        return cls(
+            [cap for cap, _ in brackets], [], [[[cost] for _, cost in brackets]]
+        )
+
+    @classmethod
+    def load(cls, path):
+        """
+        From a JSON file like
+        {"count_brackets": [4, 17, 40], "value_brackets": [25],
+         "costs": {"default": [[1.26, 4.5], [2.22, 4.5], [3.38, 5.5]], "DE": ...}}
+        with a row per count bracket and a column per value bracket.
+        """
+        with open(path) as f:
+            spec = json.load(f)
+        countries = list(spec["costs"])
+        return cls(
+            spec["count_brackets"],
+            spec.get("value_brackets", []),
+            [spec["costs"][country] for country in countries],
+            countries,
+        )
+
+    @property
+    def max_cards(self):
+        return int(self.count_brackets[-1])
+
+    def set_seller_countries(self, seller_countries):
+        """Country code per seller id, for the lookups by seller."""
+        self.seller_countries.update(seller_countries)
+        row_of = {country: i for i, country in enumerate(self.countries)}
+        ids = np.fromiter(self.seller_countries, np.int64, len(self.seller_countries))
+        rows = np.array([row_of.get(c, self.default) for c in self.seller_countries.values()], dtype=np.int64)
+        order = np.argsort(ids)
+        self._known_ids, self._known_rows = ids[order], rows[order]
+
+    def country_rows(self, seller_ids):
+        """Row of the table for every seller id."""
+        seller_ids = np.asarray(seller_ids, dtype=np.int64)
+        if len(self._known_ids) == 0:
+            return np.full(seller_ids.shape, self.default)
+        pos = np.minimum(np.searchsorted(self._known_ids, seller_ids), len(self._known_ids) - 1)
+        return np.where(self._known_ids[pos] == seller_ids, self._known_rows[pos], self.default)
+
+    def count_index(self, counts):
+        counts = np.asarray(counts, dtype=np.int64)
+        index = np.searchsorted(self.count_brackets, counts, side="left") + 1
+        return np.where(counts <= 0, 0, index)
+
+    def value_index(self, values):
+        return np.searchsorted(self.value_brackets, np.asarray(values, dtype=np.float64), side="right")
+
+    def cost(self, seller_ids, counts, values=0.0):
+        """Shipping of a letter per seller, for arrays of sellers, card counts and values."""
+        return self.costs[self.country_rows(seller_ids), self.count_index(counts), self.value_index(values)]
+
+    def delta(self, seller_ids, counts, values, n=1, value=0.0):
+        """Extra shipping of adding n cards worth value to every seller's letter."""
+        return (
+            self.cost(seller_ids, np.asarray(counts) + n, np.asarray(values) + value)
+            - self.cost(seller_ids, counts, values)
+        )
+
+    def count_table(self, seller_ids=None, value=0.0):
+        """
+        Cost by number of cards (0 to max_cards + 1) per seller at a fixed
+        basket value, or per country of the table without seller_ids. With
+        value=None, the cheapest of all value brackets.
+        """
+        rows = np.arange(len(self.countries)) if seller_ids is None else self.country_rows(seller_ids)
+        index = self.count_index(np.arange(self.max_cards + 2))
+        if value is None:
+            return self.costs[rows[:, None], index[None, :]].min(axis=-1)
+        return self.costs[rows[:, None], index[None, :], self.value_index(value)]
+
+    @property
+    def value_starts(self):
+        """Lowest basket value of every value bracket."""
+        return np.r_[0.0, self.value_brackets]
+
+    def value_tables(self, seller_ids=None):
+        """count_table for every value bracket, stacked along a new first axis."""
+        return np.stack([self.count_table(seller_ids, value) for value in self.value_starts])
+
+
+def count_brackets(ship):
+    """
+    Brackets of a per seller table by number of cards: (caps, costs) where
+    every count up to caps[b] (and above caps[b - 1]) costs costs[seller, b],
+    np.inf where a seller can't send that many cards.
+    """
+    ship = np.atleast_2d(ship)
+    n = np.arange(1, ship.shape[1] - 1)
+    changes = (ship[:, n] != ship[:, n + 1]).any(axis=0)
+    caps = n[changes]
+    return caps, ship[:, caps]
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Snapshots of a fetched wantlist, to optimize it again offline and to
+benchmark on the same data.
+
+A snapshot is a directory with one .npy file per column and a manifest.json
+that holds the format version, the fetch timestamp and the dtype and shape of
+every column. The columns are the CSR offers and price ladders of the
+PriceMatrix, its id tables and metaproduct groups, optionally the articles
+of the ArticleIndex, and label tables such as the sellers' countries. .npy
+files are loaded memory-mapped, so opening a snapshot only reads the headers
+and the pages the solver touches.
+"""
+
+import json
+import os
+import shutil
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+from articles import ArticleIndex
+from price_matrix import PriceMatrix
+
+SNAPSHOT_FORMAT = "mkm_buywizard.snapshot"
+SNAPSHOT_VERSION = 1
+MANIFEST = "manifest.json"
+
+MATRIX_COLUMNS = ("indptr", "sellers", "prices", "prod_ids", "metaprod_ids", "seller_ids", "wanted")
+LADDER_COLUMNS = ("ladder_ptr", "ladder_prices", "ladder_amounts")
+ARTICLE_COLUMNS = (
+    "sellers", "keys", "ptr", "article_ids", "prices", "counts", "conditions", "languages"
+)
+
+
+def _columns(price_mat, articles=None, labels=None):
+    """{file name: array} of everything that goes in a snapshot."""
+    columns = {name: getattr(price_mat, name) for name in MATRIX_COLUMNS}
+    if price_mat.ladder is not None:
+        columns.update(zip(LADDER_COLUMNS, price_mat.ladder))
+    if articles is not None:
+        columns.update({f"articles.{name}": getattr(articles, name) for name in ARTICLE_COLUMNS})
+    for name, values in (labels or {}).items():
+        values = np.asarray(values)
+        if values.dtype == object:
+            values = values.astype(str)
+        columns[f"labels.{name}"] = values
+    return columns
+
+
+def save_snapshot(path, price_mat, fetched_at=None, articles=None, labels=None, meta=None):
+    """
+    Write price_mat (and the ArticleIndex behind it) to the directory path,
+    replacing what was there. labels are {name: array} tables, e.g. a
+    seller_country per seller column, meta is anything JSON, like the
+    wantlist name and the search filters. fetched_at defaults to now.
+    """
+    path = Path(path)
+    fetched_at = fetched_at or datetime.now(timezone.utc)
+    if isinstance(fetched_at, datetime):
+        fetched_at = fetched_at.isoformat(timespec="seconds")
+
+    # Written next to the target and moved in place, a reader never sees half a snapshot
+    tmp = path.with_name(f".{path.name}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    arrays = {}
+    for name, values in _columns(price_mat, articles, labels).items():
+        values = np.ascontiguousarray(values)
+        np.save(tmp / f"{name}.npy", values, allow_pickle=False)
+        arrays[name] = {"dtype": values.dtype.str, "shape": list(values.shape)}
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "version": SNAPSHOT_VERSION,
+        "fetched_at": fetched_at,
+        "shape": list(price_mat.shape),
+        "offers": price_mat.n_offers,
+        "arrays": arrays,
+        "meta": meta or {},
+    }
+    (tmp / MANIFEST).write_text(json.dumps(manifest, indent=2))
+
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+    return manifest
+
+
+def read_manifest(path):
+    manifest = json.loads((Path(path) / MANIFEST).read_text())
+    if manifest.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"{path} is not a buywizard snapshot")
+    if manifest.get("version", 0) > SNAPSHOT_VERSION:
+        raise ValueError(
+            f"{path} is a version {manifest['version']} snapshot, this version reads up to {SNAPSHOT_VERSION}"
+        )
+    return manifest
+
+
+def load_snapshot(path, mmap=True):
+    """
+    (PriceMatrix, ArticleIndex or None, manifest) of a snapshot, the
+    manifest with the label tables as manifest["labels"]. With mmap the
+    columns stay memory-mapped read-only instead of being read in.
+    """
+    path = Path(path)
+    manifest = read_manifest(path)
+    columns = {}
+    for name, spec in manifest["arrays"].items():
+        values = np.load(path / f"{name}.npy", mmap_mode="r" if mmap else None, allow_pickle=False)
+        if values.dtype.str != spec["dtype"] or list(values.shape) != spec["shape"]:
+            raise ValueError(f"Column {name} of {path} doesn't match its manifest")
+        columns[name] = values
+
+    ladder = None
+    if all(name in columns for name in LADDER_COLUMNS):
+        ladder = tuple(columns[name] for name in LADDER_COLUMNS)
+    price_mat = PriceMatrix(*(columns[name] for name in MATRIX_COLUMNS), ladder=ladder)
+
+    articles = None
+    if all(f"articles.{name}" in columns for name in ARTICLE_COLUMNS):
+        articles = ArticleIndex(*(columns[f"articles.{name}"] for name in ARTICLE_COLUMNS))
+
+    manifest["labels"] = {
+        name.split(".", 1)[1]: values for name, values in columns.items() if name.startswith("labels.")
+    }
+    return price_mat, articles, manifest
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from articles import ArticleIndex
+
+
+def random_index(seed, n=30):
+    rng = np.random.default_rng(seed)
+    prod_ids, seller_ids = rng.integers(0, 4, n), rng.integers(0, 4, n)
+    prices, counts = np.round(rng.uniform(0.1, 2.0, n), 1), rng.integers(1, 4, n)
+    return ArticleIndex.from_articles(prod_ids, seller_ids, np.arange(n), prices, counts), rng, (
+        prod_ids, seller_ids, prices, counts
+    )
+
+
+def brute_force_pick(articles, prod_ids, seller_ids, quantities):
+    """Every entry takes the cheapest copies of its pair the earlier entries left."""
+    all_prods, all_sellers, prices, counts = articles
+    left = counts.copy()
+    picked = []
+    for entry, (prod, seller, wanted) in enumerate(zip(prod_ids, seller_ids, quantities)):
+        for article in sorted(np.flatnonzero((all_prods == prod) & (all_sellers == seller)), key=prices.__getitem__):
+            amount = min(wanted, left[article])
+            if amount > 0:
+                left[article] -= amount
+                wanted -= amount
+                picked.append((entry, prices[article], amount))
+    return picked
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_pick_takes_the_cheapest_copies_left(seed):
+    index, rng, articles = random_index(seed)
+    prod_ids, seller_ids = rng.integers(0, 5, 12), rng.integers(0, 5, 12)
+    quantities = rng.integers(0, 5, 12)
+    entries, positions, amounts = index.pick(prod_ids, seller_ids, quantities)
+    picked = sorted(zip(entries.tolist(), index.prices[positions].tolist(), amounts.tolist()))
+    assert picked == sorted(brute_force_pick(articles, prod_ids, seller_ids, quantities))
+    # Never more copies of an article than it has
+    assert (np.bincount(positions, weights=amounts, minlength=index.n_articles) <= index.counts).all()
+
+
+def test_find_available_and_cart_payload():
+    index = ArticleIndex.from_articles([1, 1, 1, 2], [7, 7, 9, 7], [10, 11, 12, 13], [2.0, 1.0, 0.5, 3.0], [1, 2, 1, 1])
+    assert index.find([1, 1, 2, 2], [7, 9, 7, 9]).tolist()[3] == -1
+    assert index.available([1, 1, 2, 3], [7, 9, 7, 7]).tolist() == [3, 1, 1, 0]
+    assert index.cart_payload([1, 2], [7, 7], [3, 1])["article"] == [
+        {"idArticle": 11, "amount": 2}, {"idArticle": 10, "amount": 1}, {"idArticle": 13, "amount": 1},
+    ]
@@ -0,0 +1,87 @@
+import contextlib
+import io
+import json
+
+import numpy as np
+
+from benchmarks.generators import synthetic_price_matrix, with_stock
+from benchmarks.mock_server import MockCardmarket
+from benchmarks.run import bench_config, compare, flatten, time_to_quality
+from buywizard_app import BuywizardApp
+
+
+def offers(pm):
+    rows, sellers, prices = pm.coo()
+    return sorted(zip(pm.prod_ids[rows].tolist(), pm.seller_ids[sellers].tolist(), prices.tolist()))
+
+
+def test_mock_server_serves_the_matrix_it_was_made_from(tmp_path, monkeypatch):
+    # The app logs to a file in the working directory
+    monkeypatch.chdir(tmp_path)
+    pm = synthetic_price_matrix(10, 30, metaproduct_fraction=0.3, seed=0)
+    with MockCardmarket(pm, throttle_rate=0.05) as server:
+        config = {**bench_config(server.url), "search_filters": {"language": "English"}}
+        with contextlib.redirect_stdout(io.StringIO()):
+            app = BuywizardApp(config=config)
+            fetched = app.get_wantlist_data(0)
+        app.api.close()
+        assert server.stats()["requests_per_endpoint"]["articles"] >= len(set(pm.prod_ids.tolist()))
+    assert offers(fetched) == offers(pm.drop_empty_rows())
+    # Rows may come back in another order, metaproduct rows stay metaproduct rows
+    assert np.isnan(fetched.metaprod_ids).sum() == np.isnan(pm.drop_empty_rows().metaprod_ids).sum()
+
+
+def test_wantlists_share_their_fetches(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pm = synthetic_price_matrix(12, 30, metaproduct_fraction=0.3, seed=2)
+    with MockCardmarket(pm) as server:
+        with contextlib.redirect_stdout(io.StringIO()):
+            app = BuywizardApp(config={**bench_config(server.url), "optimizer_time_limit": 5})
+        products, metaprods = app.get_wantlist_items(0)
+        # A second list with half the products of the first one
+        half = dict(list(products.items())[: len(products) // 2])
+        app.wantlists.append({**app.wantlists[0], "name": "Half"})
+        monkeypatch.setattr(app, "get_wantlist_items", lambda i: (products, metaprods) if i == 0 else (half, {}))
+
+        server.reset_counts()
+        with contextlib.redirect_stdout(io.StringIO()):
+            price_mats, report = app.get_wantlists_data([0, 1])
+        batch_requests = server.stats()["requests_per_endpoint"]["articles"]
+        server.reset_counts()
+        with contextlib.redirect_stdout(io.StringIO()):
+            alone = app.get_wantlist_data(0)
+        assert server.stats()["requests_per_endpoint"]["articles"] == batch_requests
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            baskets = app.optimize_wantlists([0, 1])
+        app.api.close()
+
+    requested, fetched = report["products"]
+    # Every product of the second list was already fetched for the first one
+    assert requested - fetched == len(half)
+    assert fetched >= len(set(alone.prod_ids.tolist()))
+    assert offers(price_mats[0]) == offers(alone)
+    assert offers(price_mats[1]) == [offer for offer in offers(alone) if offer[0] in half]
+    assert sorted(baskets) == [0, 1]
+
+
+def test_time_to_quality_and_compare(tmp_path, capsys):
+    pm = synthetic_price_matrix(10, 20, seed=0)
+    result = time_to_quality(pm, (0.05,))
+    assert result["milp_optimal"]
+    assert all(point["gap"] >= 0 for point in result["annealing"] + result["branch_and_bound"])
+    assert "annealing@0.05s.gap" in flatten({"annealing": result["annealing"]})
+
+    for name, cost in (("old", 2.0), ("new", 1.0)):
+        (tmp_path / f"{name}.json").write_text(
+            json.dumps({"environment": {"commit": name}, "results": {"x": {"best_cost": cost}}})
+        )
+    compare(tmp_path / "old.json", tmp_path / "new.json")
+    assert "0.50x" in capsys.readouterr().out
+
+
+def test_time_to_quality_times_the_heuristics_with_copies():
+    pm = with_stock(synthetic_price_matrix(8, 15, seed=1), seed=1)
+    result = time_to_quality(pm, (0.05,))
+    assert len(result["annealing"]) == len(result["branch_and_bound"]) == 1
+    assert all(point["gap"] >= 0 for point in result["annealing"] + result["branch_and_bound"])
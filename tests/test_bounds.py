@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from benchmarks.generators import synthetic_price_matrix, with_stock
+from bounds import lp_bound, min_shipping, simple_bound
+from optimizer import optimize, solve_milp
+from shipping import ShippingTable
+
+SHIPPING = ShippingTable([4, 17, 40], [10.0], [[[1.26, 4.0], [2.22, 4.5], [3.38, 5.5]]])
+
+
+def test_min_shipping():
+    # Up to two cards a letter, two in one letter is cheaper than two letters
+    ship = np.array([0.0, 1.0, 1.2, np.inf])
+    assert [min_shipping(n, ship) for n in range(5)] == pytest.approx([0.0, 1.0, 1.2, 2.2, 2.4])
+
+
+@pytest.mark.parametrize("copies", [False, True])
+@pytest.mark.parametrize("seed", range(5))
+def test_bounds_stay_below_the_optimum(seed, copies):
+    pm = synthetic_price_matrix(10, 15, metaproduct_fraction=0.3, seed=seed)
+    if copies:
+        pm = with_stock(pm, max_wanted=3, seed=seed)
+    try:
+        optimum = solve_milp(pm, shipping=SHIPPING).total_cost
+    except ValueError:
+        pytest.skip("not enough copies for sale")
+    simple = simple_bound(pm, shipping=SHIPPING)
+    lp = lp_bound(pm, shipping=SHIPPING)
+    assert 0 < simple <= optimum + 1e-6
+    assert lp <= optimum + 1e-6
+
+
+@pytest.mark.parametrize("method", ["annealing", "branch_and_bound"])
+def test_heuristics_report_their_gap_and_stop_within_it(method):
+    pm = synthetic_price_matrix(25, 40, seed=0)
+    solution = optimize(pm, method=method, time_limit=5, gap=0.5, lp_bound=True)
+    assert solution.lower_bound <= solve_milp(pm).total_cost + 1e-6
+    assert 0 <= solution.gap <= 0.5
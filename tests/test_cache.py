@@ -0,0 +1,67 @@
+import pytest
+
+import mkm_cache
+from mkm_cache import HOUR, ResponseCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(mkm_cache.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ResponseCache(tmp_path / "cache.sqlite")
+    yield cache
+    cache.close()
+
+
+def test_entries_expire_by_item_type(cache, clock):
+    cache.set_many("articles", {1: {"article": [1]}, 2: None})
+    cache.set_many("products", {1: {"product": 1}})
+    assert cache.get_many("articles", [1, 2]) == {1: {"article": [1]}}
+
+    clock.now += HOUR + 1
+    assert cache.get_many("articles", [1]) == {}
+    assert cache.get_many("products", [1]) == {1: {"product": 1}}
+    assert cache.stats()["articles"] == {"hits": 1, "misses": 2}
+
+
+def test_params_are_part_of_the_key(cache, clock):
+    cache.set_many("articles", {1: {"article": [1]}}, {"minCondition": "NM"})
+    assert cache.get_many("articles", [1]) == {}
+    assert cache.get_many("articles", [1], {"minCondition": "NM"}) == {1: {"article": [1]}}
+
+
+def test_least_recently_used_are_evicted(cache, clock):
+    for item_id in range(3):
+        clock.now += 1
+        cache.set_many("products", {item_id: {"name": "x" * 100}})
+    size = cache.db.execute("SELECT MAX(size) FROM responses").fetchone()[0]
+    cache.max_bytes = 3 * size
+
+    # Reading 0 makes 1 the least recently used entry
+    clock.now += 1
+    cache.get_many("products", [0])
+    clock.now += 1
+    cache.set_many("products", {3: {"name": "y" * 100}})
+    assert set(cache.get_many("products", range(4))) == {0, 2, 3}
+
+
+def test_from_config_is_opt_in(tmp_path):
+    assert ResponseCache.from_config({}) is None
+    cache = ResponseCache.from_config(
+        {"cache": {"enabled": True, "path": str(tmp_path / "cache.sqlite"), "ttl": {"articles": 5}}}
+    )
+    assert cache.ttl("articles") == 5
+    cache.close()
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+import combined
+from benchmarks.generators import synthetic_price_matrix, with_stock
+from combined import combine, optimize_combined
+from optimizer import solve_milp
+
+
+def two_lists(seed):
+    """A list of playsets and one wanting every other card of it again, so they share the stock."""
+    a = with_stock(synthetic_price_matrix(12, 30, metaproduct_fraction=0.3, printings=2, seed=seed), 2, seed=seed)
+    return [a, a.select_rows(np.arange(0, a.n_rows, 2))]
+
+
+@pytest.mark.parametrize("decomposition", [None, {"tail_size": 3}])
+@pytest.mark.parametrize("seed", range(4))
+def test_shared_stock_is_pruned_and_split_without_losing_the_optimum(seed, decomposition):
+    price_mats = two_lists(seed)
+    stacked, _, _ = combine(price_mats)
+    assert stacked.shares_stock
+    pm, solution, shares = optimize_combined(price_mats, decomposition=decomposition)
+    assert solution.total_cost == pytest.approx(solve_milp(stacked).total_cost)
+    assert (solution.amounts <= pm.available()).all()
+    # The lists' shares add up to the basket
+    assert sum(s["article_cost"] + s["shipping_cost"] for s in shares) == pytest.approx(solution.total_cost)
+
+
+def test_optimizer_options_are_passed_on(monkeypatch):
+    seen = []
+
+    def optimize(pm, **kwargs):
+        seen.append(kwargs)
+        return solve_milp(pm)
+
+    monkeypatch.setattr(combined, "optimize", optimize)
+    optimize_combined(two_lists(0), time_limit=5, method="annealing", lp_bound=True)
+    assert seen and all(
+        kwargs["method"] == "annealing" and kwargs["lp_bound"] and kwargs["time_limit"] for kwargs in seen
+    )
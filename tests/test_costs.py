@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+
+from costs import evaluate_amounts, evaluate_batchings, random_batchings
+from price_matrix import PriceMatrix
+from shipping import ShippingTable, calc_shipping_cost
+
+SHIPPING = ShippingTable(
+    [2, 4], [3.0], [[[1.0, 2.5], [1.5, 3.0]], [[1.2, 2.0], [1.8, 2.6]]], ["default", "DE"], {1: "DE", 3: "DE"}
+)
+
+
+def random_matrix(rng, n_rows=5, n_sellers=4):
+    prices = np.round(rng.uniform(0.1, 2.0, (n_rows, n_sellers)), 2)
+    dense = np.where(rng.random((n_rows, n_sellers)) < 0.6, prices, np.inf)
+    dense[np.arange(n_rows), rng.integers(n_sellers, size=n_rows)] = 0.5
+    metaprod_ids = np.where(np.arange(n_rows) < 2, 7.0, np.nan)
+    return PriceMatrix.from_dense(dense, metaprod_ids, seller_ids=np.arange(n_sellers)), dense
+
+
+def brute_force_cost(batching, dense, shipping=None):
+    article, letters = 0.0, {}
+    for row, seller in enumerate(batching):
+        if seller >= 0:
+            article += dense[row, seller]
+            count, value = letters.get(seller, (0, 0.0))
+            letters[seller] = (count + 1, value + dense[row, seller])
+    if shipping is None:
+        return article, sum(calc_shipping_cost(count) for count, _ in letters.values())
+    return article, sum(float(shipping.cost([s], [c], [v])[0]) for s, (c, v) in letters.items())
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("shipping", [None, SHIPPING])
+def test_evaluate_batchings_matches_brute_force(seed, shipping):
+    rng = np.random.default_rng(seed)
+    pm, dense = random_matrix(rng)
+    batchings = random_batchings(pm, 30, rng=rng)
+    article, ship_cost, total = evaluate_batchings(batchings, pm, shipping=shipping)
+    for i, batching in enumerate(batchings):
+        expected_article, expected_shipping = brute_force_cost(batching, dense, shipping)
+        assert article[i] == pytest.approx(expected_article)
+        assert ship_cost[i] == pytest.approx(expected_shipping)
+        assert total[i] == pytest.approx(expected_article + expected_shipping)
+
+
+def test_evaluate_batchings_over_capacity_is_infeasible():
+    pm = PriceMatrix.from_dense(np.ones((41, 1)))
+    assert np.isinf(evaluate_batchings(np.zeros((1, 41), dtype=int), pm)[2][0])
+
+
+def random_ladders(rng):
+    """Product 1 in two rows and product 3 in one, 1-2 articles per (product, seller)."""
+    rows, seller_ids, prices, amounts = [], [], [], []
+    articles = {
+        prod: [
+            (seller, round(float(rng.uniform(0.1, 3.0)), 2), int(rng.integers(1, 3)))
+            for seller in range(3) for _ in range(rng.integers(0, 3))
+        ]
+        for prod in (1, 3)
+    }
+    prod_ids = [1, 1, 3]
+    for row, prod in enumerate(prod_ids):
+        for seller, price, amount in articles[prod]:
+            rows.append(row)
+            seller_ids.append(seller)
+            prices.append(price)
+            amounts.append(amount)
+    pm = PriceMatrix.from_offers(rows, seller_ids, prices, prod_ids, [np.nan, 7, 7], [2, 2, 2], amounts)
+    return pm, articles
+
+
+def brute_force_amount_cost(pm, articles, amounts):
+    """Every copy bought one at a time, cheapest article of the (product, seller) left first."""
+    left = {
+        (prod, seller): sorted(price for s, price, n in offers if s == seller for _ in range(n))
+        for prod, offers in articles.items() for seller in range(3)
+    }
+    cost = np.zeros(pm.n_offers)
+    for offer in range(pm.n_offers):
+        key = (int(pm.prod_ids[pm.rows[offer]]), int(pm.seller_ids[pm.sellers[offer]]))
+        for _ in range(amounts[offer]):
+            if not left[key]:
+                cost[offer] = np.inf
+                break
+            cost[offer] += left[key].pop(0)
+    return cost
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_amount_cost_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    pm, articles = random_ladders(rng)
+    for _ in range(10):
+        amounts = rng.integers(0, 3, size=pm.n_offers)
+        bought = amounts > 0
+        np.testing.assert_allclose(
+            pm.amount_cost(amounts)[bought], brute_force_amount_cost(pm, articles, amounts)[bought]
+        )
+
+
+def test_evaluate_amounts_shares_stock_between_rows():
+    # One copy each at sellers 1 and 2, two rows wanting the product once
+    pm = PriceMatrix.from_offers(
+        [0, 0, 1, 1], [1, 2, 1, 2], [1.0, 5.0, 1.0, 5.0], [10, 10], amounts=[1, 1, 1, 1]
+    )
+    assert pm.has_quantities
+    _, _, same_article = evaluate_amounts([1, 0, 1, 0], pm)
+    _, _, split = evaluate_amounts([1, 0, 0, 1], pm)
+    assert np.isinf(same_article[0])
+    assert split[0] == pytest.approx(6.0 + 2 * calc_shipping_cost(1))
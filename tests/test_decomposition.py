@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+import decomposition
+from benchmarks.generators import synthetic_price_matrix, with_stock
+from decomposition import solve_by_components, split
+from optimizer import optimize, solve_milp
+from price_matrix import PriceMatrix
+
+
+@pytest.fixture
+def small_parts(monkeypatch):
+    monkeypatch.setattr(decomposition, "MIN_PART_OFFERS", 0)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_components_keep_the_optimum_with_copies(seed):
+    pm = with_stock(synthetic_price_matrix(30, 150, seed=seed, profile={"density": 0.015}), max_wanted=2, seed=seed)
+    assert len(split(pm)) > 1
+    solution = solve_by_components(pm, optimize)
+    assert solution.optimal
+    assert solution.total_cost == pytest.approx(solve_milp(pm).total_cost)
+    assert (solution.amounts <= pm.available()).all()
+
+
+def test_stock_split_between_parts_is_only_sold_once(small_parts):
+    # Rows 0 and 1 both want product 10 twice, seller 0 only has two copies
+    # and is split between them, sellers 1 and 2 sell the rest dearer
+    pm = PriceMatrix.from_offers(
+        [0, 0, 1, 1], [0, 1, 0, 2], [0.5, 2.0, 0.5, 2.0], [10, 10], [1.0, 2.0], [2, 2], [2, 4, 2, 4]
+    )
+    assert len(split(pm, tail_size=2)) == 2
+    solution = solve_by_components(pm, optimize, tail_size=2)
+    assert solution.amounts.sum() == 4
+    assert solution.total_cost == pytest.approx(solve_milp(pm).total_cost)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_components_without_tail_are_optimal(seed):
+    pm = synthetic_price_matrix(30, 150, seed=seed, profile={"density": 0.015})
+    assert len(split(pm)) > 1
+    solution = solve_by_components(pm, optimize, tail_size=0)
+    assert solution.optimal
+    assert solution.total_cost == pytest.approx(solve_milp(pm).total_cost)
+    assert solution.lower_bound <= solution.total_cost + 1e-6
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_cut_parts_are_rejoined_and_bounded(seed):
+    pm = synthetic_price_matrix(40, 120, seed=seed)
+    assert len(split(pm, max_part_offers=300)) > 1
+    solution = solve_by_components(pm, optimize, max_part_offers=300)
+    expected = solve_milp(pm).total_cost
+    assert not solution.optimal
+    assert solution.lower_bound <= expected
+    # Rejoining the split sellers' cards gets within a percent of the optimum
+    assert expected <= solution.total_cost <= 1.01 * expected
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from benchmarks.generators import synthetic_price_matrix, with_stock
+from incremental import basket_ids, diff_offers, load_state, save_state, warm_solve
+from optimizer import Solution, solve_milp
+from price_matrix import PriceMatrix
+
+
+def playsets(seed):
+    base = synthetic_price_matrix(12, 20, metaproduct_fraction=0.3, printings=2, seed=seed)
+    return with_stock(base, max_wanted=2, seed=seed)
+
+
+def test_state_round_trip_keeps_copies(tmp_path):
+    pm = playsets(0)
+    solution = solve_milp(pm)
+    save_state(tmp_path / "state.npz", pm, basket_ids(pm, solution))
+    loaded, basket = load_state(tmp_path / "state.npz")
+    np.testing.assert_array_equal(loaded.wanted, pm.wanted)
+    np.testing.assert_array_equal(loaded.available(), pm.available())
+    assert basket[3].sum() == solution.amounts.sum()
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_warm_start_with_copies(tmp_path, seed):
+    pm = playsets(seed)
+    path = tmp_path / "state.npz"
+    _, _, cold = warm_solve(pm, path)
+    _, _, warm = warm_solve(pm, path)
+    assert warm.solver == "warm_start"
+    assert warm.total_cost == pytest.approx(cold.total_cost)
+    np.testing.assert_array_equal(warm.amounts, cold.amounts)
+
+    # Every offer of another matrix changed, so every card is bought again
+    other = playsets(seed + 10)
+    pruned, _, solution = warm_solve(other, path, max_changed_fraction=np.inf)
+    assert solution.solver == "incremental"
+    assert solution.total_cost == pytest.approx(solve_milp(pruned).total_cost)
+    assert (solution.amounts <= pruned.available()).all()
+
+
+def test_diff_offers():
+    old = PriceMatrix.from_offers([0, 0, 1], [5, 6, 5], [1.0, 2.0, 3.0], [10, 11])
+    new = PriceMatrix.from_offers([0, 1, 1], [5, 5, 6], [1.0, 3.5, 4.0], [10, 11])
+    prods, sellers, before, after = diff_offers(old, new)
+    # (10, 6) was removed, (11, 5) repriced and (11, 6) is new
+    assert list(zip(prods.tolist(), sellers.tolist())) == [(10, 6), (11, 5), (11, 6)]
+    np.testing.assert_array_equal(before, [2.0, 3.0, np.nan])
+    np.testing.assert_array_equal(after, [np.nan, 3.5, 4.0])
+
+
+def repriced(pm, offers, factor):
+    prices = pm.prices.copy()
+    prices[offers] *= factor
+    rows, sellers, _ = pm.coo()
+    return PriceMatrix.from_offers(rows, pm.seller_ids[sellers], prices, pm.prod_ids, pm.metaprod_ids, pm.wanted)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_small_change_only_rebuys_the_cards_it_touches(tmp_path, seed):
+    pm = synthetic_price_matrix(30, 40, seed=seed)
+    path = tmp_path / "state.npz"
+    before, _, cold = warm_solve(pm, path)
+    # The first bought card got dearer
+    row = np.flatnonzero(pm.prod_ids == before.prod_ids[0])[0]
+    col = np.flatnonzero(pm.seller_ids == before.seller_ids[cold.assignment[0]])[0]
+    changed = repriced(pm, pm.offer_index([row], [col]), 3.0)
+    after, _, warm = warm_solve(changed, path)
+    assert warm.solver == "incremental"
+    assert warm.total_cost >= solve_milp(after).total_cost - 1e-6
+    assert warm.total_cost <= Solution(cold.assignment, after).total_cost + 1e-6
+    # Cards bought from other sellers are kept
+    kept = before.seller_ids[cold.assignment] != before.seller_ids[cold.assignment[0]]
+    np.testing.assert_array_equal(
+        after.seller_ids[warm.assignment][kept], before.seller_ids[cold.assignment][kept]
+    )
+
+    # Above the share of changed offers it's a cold solve again
+    _, _, again = warm_solve(repriced(after, [0], 2.0), path, max_changed_fraction=0)
+    assert again.solver not in ("incremental", "warm_start")
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+import requests
+from requests_oauthlib import OAuth1
+
+from metrics import disable_metrics, enable_metrics, get_metrics, timed
+from pymkmapi import RealmSession, TimedOAuth1Auth
+
+
+@pytest.fixture
+def metrics():
+    yield enable_metrics()
+    disable_metrics()
+
+
+def test_phases_requests_and_export(metrics, tmp_path):
+    @timed("solve")
+    def solve():
+        return 1
+
+    with metrics.phase("fetch"):
+        metrics.observe_request("articles", 0.2, 1000, 200)
+        metrics.observe_request("articles", 3.0, 0, None)
+        solve()
+    metrics.count("retries", 2)
+    metrics.update_quota(11, 5000)
+    metrics.update_quota(20, 5000)
+
+    data = metrics.to_dict()
+    assert set(data["phases"]) == {"fetch", "fetch/solve"}
+    assert data["requests"]["articles"]["status"] == {"200": 1, "error": 1}
+    assert data["requests"]["articles"]["buckets"][2] == 1
+    assert data["quota"]["used"] == 10
+    metrics.export(tmp_path / "run.json")
+    assert json.loads((tmp_path / "run.json").read_text())["counters"] == {"retries": 2}
+
+    metrics.export(tmp_path / "run.prom")
+    prom = (tmp_path / "run.prom").read_text()
+    assert 'mkm_request_duration_seconds_bucket{endpoint="articles",le="+Inf"} 2' in prom
+    assert "mkm_retries_total 2" in prom
+    assert "mkm_quota_used 10" in prom
+
+
+def test_disabled_metrics_record_nothing():
+    disable_metrics()
+    with get_metrics().phase("fetch"):
+        get_metrics().count("retries")
+    assert not get_metrics().enabled
+
+
+def test_oauth_signing_is_timed(metrics):
+    session = RealmSession(requests.Session(), OAuth1("app", "secret", "token", "token secret", realm="x"))
+    request = requests.Request("GET", "https://api.cardmarket.com/ws/v2.0/output.json/games").prepare()
+    assert session.sign(request).headers["Authorization"].startswith(b"OAuth")
+
+    auth = TimedOAuth1Auth("app", "secret", "token", "token secret")
+    auth.prepare("GET", "https://api.cardmarket.com/ws/v2.0/output.json/games", {}, b"")
+    assert metrics.phases["oauth_sign"]["count"] == 2
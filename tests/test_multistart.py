@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from benchmarks.generators import synthetic_price_matrix, with_stock
+from multistart import solve_multistart
+from optimizer import solve_annealing, solve_milp
+from shipping import ShippingTable
+
+SHIPPING = ShippingTable([4, 17, 40], [10.0], [[[1.26, 4.0], [2.22, 4.5], [3.38, 5.5]]])
+
+
+def test_same_basket_for_any_number_of_workers():
+    pm = synthetic_price_matrix(15, 20, seed=0)
+    one, three = (
+        solve_multistart(pm, chains=3, workers=workers, seed=1, moves=5000, shipping=SHIPPING)
+        for workers in (1, 3)
+    )
+    np.testing.assert_array_equal(one.assignment, three.assignment)
+    # The chains run on the matrix rebuilt from shared memory like they would on pm
+    serial = min(
+        (solve_annealing(pm, time_limit=None, rng=seed, max_moves=5000, shipping=SHIPPING)
+         for seed in np.random.SeedSequence(1).spawn(3)),
+        key=lambda solution: solution.total_cost,
+    )
+    assert one.total_cost == pytest.approx(serial.total_cost)
+    np.testing.assert_array_equal(one.assignment, serial.assignment)
+
+
+def test_copies_are_shared_with_the_workers():
+    pm = with_stock(synthetic_price_matrix(10, 15, metaproduct_fraction=0.3, printings=2, seed=3), seed=3)
+    solution = solve_multistart(pm, chains=2, workers=2, moves=20000)
+    assert solution.solver == "multistart"
+    assert (solution.amounts <= pm.available()).all()
+    gidx = pm.group_index()
+    wanted = np.zeros(gidx.max() + 1)
+    wanted[gidx] = pm.wanted
+    np.testing.assert_array_equal(np.bincount(gidx[pm.rows], weights=solution.amounts), wanted)
+    assert solution.total_cost >= solve_milp(pm).total_cost - 1e-6
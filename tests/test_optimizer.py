@@ -0,0 +1,70 @@
+import itertools
+import logging
+
+import numpy as np
+import pytest
+
+import optimizer
+from benchmarks.generators import synthetic_price_matrix
+from costs import evaluate_batchings
+from optimizer import optimize, solve_annealing, solve_milp
+
+
+def brute_force(pm):
+    """Cheapest total over every choice of seller per card."""
+    batchings = np.array(list(itertools.product(range(pm.n_sellers), repeat=pm.n_rows)))
+    return evaluate_batchings(batchings, pm)[2].min()
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_milp_matches_brute_force(seed):
+    pm = synthetic_price_matrix(5, 4, seed=seed, profile={"density": 0.7})
+    solution = solve_milp(pm)
+    assert solution.optimal
+    assert solution.total_cost == pytest.approx(brute_force(pm))
+
+
+def test_fallback_without_scipy_gets_a_time_limit(monkeypatch, caplog):
+    def no_scipy(*args, **kwargs):
+        raise ImportError("scipy")
+
+    seen = {}
+
+    def branch_and_bound(pm, time_limit=None, **kwargs):
+        seen["time_limit"] = time_limit
+        return optimizer.Solution(np.zeros(pm.n_rows, dtype=int), pm)
+
+    monkeypatch.setattr(optimizer, "solve_milp", no_scipy)
+    monkeypatch.setattr(optimizer, "solve_branch_and_bound", branch_and_bound)
+    pm = synthetic_price_matrix(5, 4, seed=0)
+    with caplog.at_level(logging.WARNING, logger="optimizer"):
+        optimize(pm)
+    assert seen["time_limit"] == optimizer.FALLBACK_TIME_LIMIT
+    assert "isn't proven" in caplog.text
+    with pytest.raises(ImportError):
+        optimize(pm, method="milp")
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_annealing_is_costed_exactly_and_repeatable(seed):
+    pm = synthetic_price_matrix(20, 25, metaproduct_fraction=0.3, seed=seed)
+    solution = solve_annealing(pm, time_limit=None, max_moves=20000, rng=seed)
+    # The incrementally costed basket is what it costs from scratch
+    assert solution.total_cost == pytest.approx(evaluate_batchings(solution.assignment, pm)[2][0])
+    assert solution.total_cost >= solve_milp(pm).total_cost - 1e-6
+    again = solve_annealing(pm, time_limit=None, max_moves=20000, rng=seed)
+    np.testing.assert_array_equal(again.assignment, solution.assignment)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_annealing_finds_small_optima(seed):
+    pm = synthetic_price_matrix(5, 4, seed=seed, profile={"density": 0.7})
+    solution = solve_annealing(pm, time_limit=None, max_moves=5000, rng=seed)
+    assert solution.total_cost == pytest.approx(brute_force(pm))
+
+
+def test_annealing_stops_at_the_target():
+    pm = synthetic_price_matrix(20, 25, seed=0)
+    target = 1.05 * solve_milp(pm).total_cost
+    solution = solve_annealing(pm, time_limit=None, max_moves=10**7, rng=0, target_cost=target)
+    assert solution.total_cost <= target
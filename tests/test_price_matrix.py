@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+
+from costs import evaluate_batchings
+from price_matrix import PriceMatrix, PriceMatrixBuilder
+from search_filters import ArticleFilter
+
+
+def random_dense(seed, n_rows=8, n_sellers=6):
+    rng = np.random.default_rng(seed)
+    prices = np.round(rng.uniform(0.1, 3.0, (n_rows, n_sellers)), 2)
+    return np.where(rng.random((n_rows, n_sellers)) < 0.5, prices, np.inf)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_sparse_matches_dense(seed):
+    dense = random_dense(seed)
+    groups = np.array([1.0, 1.0, np.nan, 2.0, 2.0, 2.0, np.nan, np.nan])
+    pm = PriceMatrix.from_dense(dense, groups, seller_ids=np.arange(100, 106))
+    np.testing.assert_array_equal(pm.to_dense(), dense)
+    assert pm.n_offers == np.isfinite(dense).sum()
+    rows, cols = np.indices(dense.shape).reshape(2, -1)
+    np.testing.assert_array_equal(pm.lookup(rows, cols), dense[rows, cols])
+    # Rows of a metaproduct share a group, plain products get one each
+    assert pm.group_index().tolist()[:3] == [0, 0, 1]
+    assert len(set(pm.group_index().tolist())) == 5
+
+    again = PriceMatrix.from_dataframe(pm.to_dataframe())
+    np.testing.assert_array_equal(again.to_dense(), dense)
+    np.testing.assert_array_equal(again.seller_ids, pm.seller_ids)
+
+    keep = [0, 3, 6]
+    sub, cols = pm.select_rows(keep).compact_sellers()
+    np.testing.assert_array_equal(sub.to_dense(), dense[keep][:, cols])
+    assert np.isfinite(dense[keep][:, cols]).any(axis=0).all()
+
+
+def test_from_offers_keeps_the_cheapest_and_the_ladder():
+    pm = PriceMatrix.from_offers([0, 0, 0, 1], [5, 5, 9, 9], [2.0, 1.0, 3.0, 4.0], [10, 11], amounts=[1, 2, 1, 0])
+    assert pm.to_dense().tolist() == [[1.0, 3.0], [np.inf, np.inf]]
+    assert pm.available().tolist() == [3, 1]
+    # Three copies from seller 5: two at 1.0 and one at 2.0
+    assert pm.amount_cost([3, 0]).tolist()[0] == 4.0
+    assert np.isinf(pm.amount_cost([4, 0])[0])
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_costs_agree_on_dense_and_sparse(seed):
+    dense = random_dense(seed)
+    dense[:, 0] = 1.0
+    batchings = np.random.default_rng(seed).integers(0, dense.shape[1], (20, dense.shape[0]))
+    np.testing.assert_allclose(
+        evaluate_batchings(batchings, dense)[2], evaluate_batchings(batchings, PriceMatrix.from_dense(dense))[2]
+    )
+
+
+def article(price, seller, country="DE", count=1, language=1, article_id=None):
+    return {
+        "idArticle": seller if article_id is None else article_id, "price": price, "count": count, "condition": "NM",
+        "language": {"idLanguage": language},
+        "seller": {"idUser": seller, "address": {"country": country}},
+    }
+
+
+def as_columns(articles):
+    """A response like fast_json projects it."""
+    return {"article_columns": {
+        "idArticle": [a["idArticle"] for a in articles], "price": [a["price"] for a in articles],
+        "count": [a["count"] for a in articles], "condition": [a["condition"] for a in articles],
+        "idLanguage": [a["language"]["idLanguage"] for a in articles],
+        "idUser": [a["seller"]["idUser"] for a in articles],
+        "country": [a["seller"]["address"]["country"] for a in articles],
+    }}
+
+
+@pytest.mark.parametrize("columns", [False, True])
+def test_builder_filters_offers_as_they_come_in(columns):
+    responses = {
+        10: [article(1.0, 1, "DE"), article(0.5, 2, "FR"), article(2.0, 1, "DE", count=2, article_id=7)],
+        11: [article(3.0, 3, "DE", language=2), article(9.0, 4, "DE"), article(0.2, 5, "DE")],
+    }
+    article_filter = ArticleFilter(countries=["DE"], languages=[1], max_price=5.0, excluded_sellers=[5])
+    # Product 11 is in the list directly and through metaproduct 100
+    builder = PriceMatrixBuilder([10, 11, 11], {11: 100}, article_filter=article_filter)
+    for prod_id, articles in responses.items():
+        response = as_columns(articles) if columns else {"article": articles}
+        builder.add_response(prod_id, response)
+    pm = builder.build()
+
+    # Only seller 1's two articles of product 10 pass the filters
+    assert pm.n_offers == 1 and pm.to_dense().tolist() == [[1.0], [np.inf], [np.inf]]
+    assert pm.available().tolist() == [3]
+    index = builder.article_index()
+    assert index.available([10], [1]).tolist() == [3]
+    assert index.article_ids[index.best([10], [1])].tolist() == [1]
+
+
+def page_through(builder, product_id, articles, page_size=10, columns=False):
+    """Pages of the articles merged like the paginator does, until wants_more says stop."""
+    merged = {"article_columns": {}} if columns else {"article": []}
+    for start in range(0, len(articles), page_size):
+        page = articles[start:start + page_size]
+        if columns:
+            for name, column in as_columns(page)["article_columns"].items():
+                merged["article_columns"].setdefault(name, []).extend(column)
+        else:
+            merged["article"].extend(page)
+        if not builder.wants_more(product_id, merged):
+            return start + page_size
+    return len(articles)
+
+
+@pytest.mark.parametrize("columns", [False, True])
+def test_paging_stops_once_offers_per_country_are_in(columns):
+    articles = [article(1.0 + i / 10, i, "DE" if i % 3 else "FR") for i in range(100)]
+    # Dominance alone would need a 3 euro step, the country cut-off comes first
+    builder = PriceMatrixBuilder(
+        [1], article_filter=ArticleFilter(countries=["DE", "FR"], max_offers_per_country=8), wanted={1: 100}
+    )
+    # 8 French offers are in after 24 articles, so the third page is the last
+    assert page_through(builder, 1, articles, columns=columns) == 30
+
+
+def test_paging_stops_when_later_offers_are_dominated():
+    builder = PriceMatrixBuilder([1], wanted={1: 2})
+    # Plenty of sellers with two copies each far below the last price after two pages
+    articles = [article(0.5, i, count=2) for i in range(10)] + [article(5.0 + i, 10 + i) for i in range(50)]
+    assert page_through(builder, 1, articles) == 20
+    # A response out of price order never stops
+    assert page_through(PriceMatrixBuilder([1]), 1, articles[::-1]) == len(articles)
+
+
+def test_paging_state_is_per_response():
+    builder = PriceMatrixBuilder([1], article_filter=ArticleFilter(max_offers_per_country=5), wanted={1: 50})
+    articles = [article(1.0, i) for i in range(40)]
+    assert page_through(builder, 1, articles) == 10
+    # Fetched again from the start, the counts don't carry over
+    assert page_through(builder, 1, articles, page_size=3) == 6
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from benchmarks.generators import synthetic_price_matrix, with_stock
+from combined import combine
+from optimizer import solve_milp
+from price_matrix import PriceMatrix
+from pruning import prune
+from shipping import ShippingTable
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_prune_keeps_milp_optimum(seed):
+    pm = synthetic_price_matrix(12, 40, metaproduct_fraction=0.25, printings=2, seed=seed)
+    pruned, report = prune(pm)
+    assert report["offers"][1] <= report["offers"][0]
+    assert solve_milp(pruned).total_cost == pytest.approx(solve_milp(pm).total_cost)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_prune_keeps_milp_optimum_with_value_brackets(seed):
+    pm = synthetic_price_matrix(12, 40, seed=seed)
+    # Tracked letters from 5 euro, dearer in one country
+    shipping = ShippingTable(
+        [4, 17, 40], [5.0], [[[1.26, 4.0], [2.22, 4.5], [3.38, 5.5]], [[1.5, 6.0], [2.5, 6.5], [3.5, 7.5]]],
+        ["default", "DE"], {int(s): "DE" for s in pm.seller_ids[::3]},
+    )
+    pruned, _ = prune(pm, shipping)
+    assert solve_milp(pruned, shipping=shipping).total_cost == pytest.approx(
+        solve_milp(pm, shipping=shipping).total_cost
+    )
+
+
+def test_prune_keeps_the_cheaper_split_with_value_brackets():
+    # Buying both cards from seller 2 passes 25 euro, splitting them is cheaper
+    shipping = ShippingTable([4, 17, 40], [25.0], [[[1.0, 10.0], [1.0, 10.0], [1.0, 10.0]]])
+    pm = PriceMatrix.from_offers([0, 0, 1], [1, 2, 2], [13.0, 11.5, 14.0], np.array([10, 11]))
+    pruned, _ = prune(pm, shipping)
+    solution = solve_milp(pruned, shipping=shipping)
+    assert solution.total_cost == pytest.approx(29.0)
+    assert solution.optimal
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_prune_keeps_milp_optimum_with_copies(seed):
+    pm = with_stock(synthetic_price_matrix(12, 25, metaproduct_fraction=0.25, printings=2, seed=seed), seed=seed)
+    pruned, report = prune(pm)
+    assert report["offers"][1] < report["offers"][0]
+    assert solve_milp(pruned).total_cost == pytest.approx(solve_milp(pm).total_cost)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_prune_keeps_milp_optimum_with_shared_stock(seed):
+    pm = with_stock(
+        synthetic_price_matrix(8, 30, metaproduct_fraction=0.25, printings=2, seed=seed), max_wanted=2, seed=seed
+    )
+    # A second list wanting the same cards, buying from the same stock
+    wanted = np.random.default_rng(seed).integers(1, 3, size=pm.n_rows)[pm.group_index()]
+    combined, _, _ = combine([pm, pm.with_wanted(wanted)])
+    assert combined.shares_stock
+    pruned, _ = prune(combined)
+    assert solve_milp(pruned).total_cost == pytest.approx(solve_milp(combined).total_cost)
@@ -0,0 +1,136 @@
+import logging
+from contextlib import contextmanager
+
+import pytest
+
+import fast_json
+from benchmarks.generators import synthetic_price_matrix
+from benchmarks.mock_server import MockCardmarket
+from benchmarks.run import bench_config
+from fast_json import decode_response, project_articles
+from pymkmapi import PyMkmApi
+
+
+@contextmanager
+def mock_server(**kwargs):
+    """The mock API in a thread of this process, so the tests can look at its server."""
+    pm = synthetic_price_matrix(6, 40, seed=0, profile={"density": 0.5})
+    server = MockCardmarket(pm, seed=0, **kwargs).start(in_process=True)
+    try:
+        yield server
+    finally:
+        server.stop()
+
+
+@pytest.fixture
+def server():
+    with mock_server() as server:
+        yield server
+
+
+@pytest.fixture
+def api(server):
+    with PyMkmApi(config=bench_config(server.url), logger=logging.getLogger("tests")) as api:
+        yield api
+
+
+def prices(articles):
+    return [article["price"] for article in articles]
+
+
+def test_partial_content_is_paged_concurrently(server, api):
+    # Several windows of concurrent pages after the first one
+    api.PAGE_SIZE, api.PAGE_CONCURRENCY = 3, 2
+    prod_id, expected = max(server.articles.items(), key=lambda item: len(item[1]))
+    assert len(expected) > 3 * api.PAGE_CONCURRENCY
+    server.reset_counts()
+    articles = api.get_articles(prod_id)
+    assert [a["idArticle"] for a in articles] == [a["idArticle"] for a in expected]
+    assert server.stats()["requests"] == -(-len(expected) // 3)
+
+
+def test_items_are_paged_and_merged(server, api):
+    ids = list(server.articles)
+    responses = api.get_items_async("articles", ids, page_size=4)
+    assert {i: prices(r["article"]) for i, r in responses.items()} == {
+        i: prices(articles) for i, articles in server.articles.items()
+    }
+
+
+def test_paging_stops_when_asked(server, api):
+    prod_id = max(server.articles, key=lambda i: len(server.articles[i]))
+    response = api.get_items_async(
+        "articles", [prod_id], page_size=4, more_pages=lambda item_id, merged: len(merged["article"]) < 8
+    )[prod_id]
+    assert len(response["article"]) == 8
+    assert prod_id in api.truncated_items
+
+
+@pytest.mark.parametrize("pool", [None, "thread", "process"])
+def test_fast_json_projects_articles(server, pool):
+    ids = list(server.articles)
+    config = {**bench_config(server.url), "fast_json": {"enabled": True, "pool": pool, "workers": 2}}
+    with PyMkmApi(config=config, logger=logging.getLogger("tests")) as api:
+        responses = api.get_items_async("articles", ids, page_size=4)
+    assert responses == {i: project_articles({"article": articles}) for i, articles in server.articles.items()}
+    # Only /articles is projected
+    assert decode_response("metaproducts", b'{"product": [1]}') == {"product": [1]}
+
+
+def test_fast_json_without_orjson(monkeypatch):
+    monkeypatch.setattr(fast_json, "orjson", None)
+    assert decode_response("articles", b'{"article": []}') == project_articles({"article": []})
+
+
+def test_throttled_requests_are_retried():
+    with mock_server(throttle_rate=0.2) as server:
+        with PyMkmApi(config=bench_config(server.url), logger=logging.getLogger("tests")) as api:
+            responses = api.get_items_async("articles", list(server.articles), page_size=5)
+            assert set(responses) == set(server.articles)
+            assert api.retries_count == server.stats()["throttled"] > 0
+            assert not api.failed_items
+
+
+def test_errors_after_the_last_retry_are_reported():
+    with mock_server(throttle_rate=1.0) as server:
+        config = {**bench_config(server.url), "retry": {"max_retries": 1, "backoff_base": 0.01}}
+        with PyMkmApi(config=config, logger=logging.getLogger("tests")) as api:
+            ids = list(server.articles)[:2]
+            assert api.get_items_async("articles", ids) == {}
+            assert api.failed_items == {i: "429 too many requests" for i in ids}
+            assert server.stats()["requests"] == 4
+
+
+def test_no_content_is_an_empty_response(server, api):
+    prod_id = next(iter(server.articles))
+    assert api.get_items_async("articles", [prod_id], start=10**6) == {prod_id: {}}
+    assert not api.failed_items
+
+
+def count_connections(server):
+    connections = []
+    process_request = server.server.process_request
+
+    def counting(request, client_address):
+        connections.append(client_address)
+        return process_request(request, client_address)
+
+    server.server.process_request = counting
+    return connections
+
+
+def test_connections_are_reused(server):
+    config = {**bench_config(server.url), "rate_limit": {"max_concurrency": 2}}
+    with PyMkmApi(config=config, logger=logging.getLogger("tests")) as api:
+        connections = count_connections(server)
+        ids = list(server.articles)
+        api.get_items_async("articles", ids)
+        client = api._PyMkmApi__async_client
+        api.get_items_async("articles", ids)
+        assert api._PyMkmApi__async_client is client
+        assert len(connections) <= 2
+
+        del connections[:]
+        for _ in range(3):
+            api.get_account()
+        assert len(connections) == 1
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from benchmarks.generators import synthetic_price_matrix, with_stock
+from optimizer import optimize, solve_annealing, solve_branch_and_bound, solve_milp
+from price_matrix import PriceMatrix
+from shipping import ShippingTable
+
+
+def random_playsets(seed, n_cards=6, n_sellers=8):
+    base = synthetic_price_matrix(n_cards, n_sellers, metaproduct_fraction=0.3, printings=2, seed=seed)
+    return with_stock(base, seed=seed)
+
+
+def assert_buys_wanted(solution, pm):
+    gidx = pm.group_index()
+    wanted = np.zeros(gidx.max() + 1)
+    wanted[gidx] = pm.wanted
+    np.testing.assert_array_equal(np.bincount(gidx[pm.rows], weights=solution.amounts), wanted)
+
+
+@pytest.mark.parametrize("seed", range(15))
+def test_branch_and_bound_matches_milp_with_copies(seed):
+    pm = random_playsets(seed)
+    try:
+        expected = solve_milp(pm).total_cost
+    except ValueError:
+        pytest.skip("not enough copies for sale")
+    solution = solve_branch_and_bound(pm)
+    assert solution.optimal
+    assert solution.total_cost == pytest.approx(expected)
+    assert_buys_wanted(solution, pm)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_annealing_buys_every_copy_within_stock(seed):
+    pm = random_playsets(seed, n_cards=10, n_sellers=15)
+    shipping = ShippingTable([4, 17, 40], [10.0], [[[1.26, 4.0], [2.22, 4.5], [3.38, 5.5]]])
+    try:
+        expected = solve_milp(pm, shipping=shipping).total_cost
+    except ValueError:
+        pytest.skip("not enough copies for sale")
+    solution = solve_annealing(pm, time_limit=None, max_moves=20000, rng=seed, shipping=shipping)
+    assert np.isfinite(solution.total_cost)
+    assert solution.total_cost >= expected - 1e-6
+    assert_buys_wanted(solution, pm)
+    assert (solution.amounts <= pm.available()).all()
+
+
+def test_shared_stock_is_split_between_rows():
+    # Two rows of product 10, one copy each at sellers 1 and 2
+    pm = PriceMatrix.from_offers([0, 0, 1, 1], [1, 2, 1, 2], [1.0, 5.0, 1.0, 5.0], [10, 10], amounts=[1, 1, 1, 1])
+    for method in ("branch_and_bound", "annealing"):
+        solution = optimize(pm, method=method, time_limit=1)
+        assert solution.solver == method
+        assert np.isfinite(solution.total_cost)
+        assert solution.amounts.tolist() in ([1, 0, 0, 1], [0, 1, 1, 0])
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from rate_limiter import RateLimiter
+
+
+def test_concurrency_grows_additively_and_halves_on_errors():
+    limiter = RateLimiter(max_concurrency=16, start_concurrency=4)
+    for _ in range(4):
+        limiter.acquire()
+    for _ in range(4):
+        limiter.release(latency=0.01)
+    assert limiter.limit == 4 and limiter.concurrency > 4.9
+
+    limiter.acquire()
+    limiter.release(latency=0.01, ok=False)
+    assert limiter.limit == 2
+    # Only one decrease per round trip
+    limiter.acquire()
+    limiter.release(latency=0.01, ok=False)
+    assert limiter.limit == 2
+
+
+def test_slots_are_limited():
+    limiter = RateLimiter(max_concurrency=2)
+    limiter.acquire()
+    limiter.acquire()
+    assert limiter._try_acquire() > 0
+    limiter.release(latency=0.01)
+    assert limiter._try_acquire() == 0.0
+
+
+def test_throttling_pauses_and_backs_off():
+    limiter = RateLimiter(max_concurrency=8)
+    limiter.acquire()
+    limiter.release(latency=0.01, throttled=True)
+    assert limiter.limit == 4
+    assert limiter._try_acquire() >= 0.9
+
+
+def test_latency_spikes_back_off():
+    limiter = RateLimiter(max_concurrency=8, latency_floor=0.0)
+    for latency in (0.01, 0.01, 1.0):
+        limiter.acquire()
+        limiter.release(latency=latency)
+    assert limiter.limit < 8
+
+
+def test_quota():
+    limiter = RateLimiter(requests_per_second=100, quota_reserve=10)
+    assert limiter.can_start(10**6)
+    limiter.update_quota(4900, 5000)
+    assert limiter.quota_remaining == 90
+    assert limiter.can_start(90) and not limiter.can_start(91)
+    # The last tenth of the quota goes slower
+    assert limiter._rate() == pytest.approx(100 * 90 / 500)
+
+
+def test_async_requests_never_exceed_the_limit():
+    limiter = RateLimiter(max_concurrency=3)
+    in_flight = []
+
+    async def request():
+        await limiter.acquire_async()
+        in_flight.append(limiter.in_flight)
+        await asyncio.sleep(0.01)
+        limiter.release(latency=0.01)
+
+    async def main():
+        await asyncio.gather(*(request() for _ in range(30)))
+
+    asyncio.run(main())
+    assert len(in_flight) == 30 and max(in_flight) <= 3
+    assert limiter.in_flight == 0
@@ -0,0 +1,27 @@
+import pytest
+
+from pymkmapi import PyMkmApi
+from search_filters import MAX_PAGE_SIZE, compile_filters
+
+
+def test_supported_filters_go_to_the_api():
+    params, article_filter = compile_filters(
+        {
+            "language": "English", "minCondition": "EX", "isFoil": False, "countries": ["NL", "DE"],
+            "maxPrice": 2.5, "excludedSellers": [3], "maxOffersPerCountry": 5, "pageSize": 5000,
+        },
+        PyMkmApi.languages,
+    )
+    assert params == {"idLanguage": 1, "minCondition": "EX", "isFoil": "false"}
+    assert article_filter.countries.tolist() == ["DE", "NL"]
+    assert article_filter.max_price == 2.5
+    assert article_filter.max_offers_per_country == 5
+    assert article_filter.page_size == MAX_PAGE_SIZE
+
+
+def test_several_languages_are_filtered_locally():
+    params, article_filter = compile_filters({"language": ["English", "German"]}, PyMkmApi.languages)
+    assert params == {}
+    assert article_filter.languages.tolist() == [1, 3]
+    with pytest.raises(Exception, match="language"):
+        compile_filters({"language": "Klingon"}, PyMkmApi.languages)
@@ -0,0 +1,77 @@
+import json
+
+import numpy as np
+import pytest
+
+from benchmarks.generators import synthetic_price_matrix
+from optimizer import _greedy, _group_options, solve_annealing, solve_branch_and_bound, solve_milp
+from price_matrix import PriceMatrix
+from shipping import ShippingTable, calc_shipping_cost, seller_shipping
+
+# Tracked letters from 5 euro, dearer in one country
+TRACKED = ShippingTable(
+    [4, 17, 40], [5.0], [[[1.26, 4.0], [2.22, 4.5], [3.38, 5.5]], [[1.5, 6.0], [2.5, 6.5], [3.5, 7.5]]],
+    ["default", "DE"], {1: "DE", 4: "DE"},
+)
+
+
+def test_from_brackets_matches_flat_shipping():
+    table = ShippingTable.from_brackets()
+    counts = np.arange(1, table.max_cards + 1)
+    np.testing.assert_allclose(table.cost(np.zeros_like(counts), counts), [calc_shipping_cost(n) for n in counts])
+    assert table.cost([0], [0])[0] == 0.0
+    assert np.isinf(table.cost([0], [table.max_cards + 1])[0])
+
+
+def test_cost_by_country_and_value():
+    np.testing.assert_allclose(TRACKED.cost([0, 1, 2], [1, 1, 5], [4.99, 5.0, 5.0]), [1.26, 6.0, 4.5])
+    # Sellers whose country isn't known use the default row
+    assert TRACKED.cost([99], [20], [1.0])[0] == 3.38
+
+
+def test_delta_crossing_a_value_bracket():
+    np.testing.assert_allclose(TRACKED.delta([0, 0], [1, 4], [3.0, 3.0], 1, 2.5), [4.0 - 1.26, 4.5 - 1.26])
+
+
+def test_load(tmp_path):
+    path = tmp_path / "shipping.json"
+    path.write_text(json.dumps({
+        "count_brackets": [4, 17, 40], "value_brackets": [5.0],
+        "costs": {"default": [[1.26, 4.0], [2.22, 4.5], [3.38, 5.5]], "DE": [[1.5, 6.0], [2.5, 6.5], [3.5, 7.5]]},
+    }))
+    table = ShippingTable.load(path)
+    table.set_seller_countries({1: "DE", 4: "DE"})
+    np.testing.assert_allclose(table.value_tables([0, 1]), TRACKED.value_tables([0, 1]))
+
+
+def test_greedy_costs_letters_at_their_value():
+    pm = PriceMatrix.from_offers([0, 0, 1, 1], [0, 2, 0, 2], [3.0, 3.2, 3.0, 3.2], [10, 11])
+    ship = seller_shipping(TRACKED, pm.seller_ids)
+    # Both cards from seller 0 pass 5 euro, the second one goes to seller 2
+    assignment, cost, _ = _greedy(_group_options(pm), 2, 2, ship, TRACKED, pm.seller_ids)
+    assert assignment.tolist() == [0, 1]
+    assert cost == pytest.approx(6.2 + 2 * 1.26)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_branch_and_bound_with_value_brackets_is_optimal(seed):
+    pm = synthetic_price_matrix(8, 12, seed=seed)
+    shipping = ShippingTable(
+        [4, 17, 40], [5.0], [[[1.26, 4.0], [2.22, 4.5], [3.38, 5.5]]],
+    )
+    solution = solve_branch_and_bound(pm, shipping=shipping)
+    assert solution.optimal
+    assert solution.total_cost == pytest.approx(solve_milp(pm, shipping=shipping).total_cost)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_annealing_costs_value_brackets_exactly(seed):
+    pm = synthetic_price_matrix(15, 20, seed=seed)
+    solution = solve_annealing(pm, time_limit=None, max_moves=20000, rng=seed, shipping=TRACKED)
+    assert solution.total_cost >= solve_milp(pm, shipping=TRACKED).total_cost - 1e-6
+    # The greedy start is costed with the same letters, annealing only improves on it
+    options = _group_options(pm)
+    _, greedy_cost, _ = _greedy(
+        options, pm.shape[0], pm.shape[1], seller_shipping(TRACKED, pm.seller_ids), TRACKED, pm.seller_ids
+    )
+    assert solution.total_cost <= greedy_cost + 1e-6
@@ -0,0 +1,80 @@
+import json
+
+import numpy as np
+import pytest
+
+from articles import ArticleIndex
+from benchmarks.generators import synthetic_price_matrix, with_stock
+from buywizard_app import BuywizardApp, optimize_snapshot
+from optimizer import solve_milp
+from snapshot import load_snapshot, save_snapshot
+
+
+def playsets(seed):
+    return with_stock(synthetic_price_matrix(10, 15, metaproduct_fraction=0.3, printings=2, seed=seed), 2, seed=seed)
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_round_trip(tmp_path, mmap):
+    pm = playsets(0)
+    articles = ArticleIndex.from_articles([1, 1, 2], [7, 8, 7], [10, 11, 12], [1.0, 2.0, 0.5], [2, 1, 1])
+    countries = ["DE" if s % 2 else "FR" for s in pm.seller_ids.tolist()]
+    save_snapshot(tmp_path / "snap", pm, articles=articles, labels={"seller_country": countries}, meta={"a": 1})
+    loaded, loaded_articles, manifest = load_snapshot(tmp_path / "snap", mmap=mmap)
+
+    for name in ("indptr", "sellers", "prices", "prod_ids", "seller_ids", "wanted"):
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(pm, name))
+    np.testing.assert_array_equal(loaded.metaprod_ids, pm.metaprod_ids)
+    for saved, original in zip(loaded.ladder, pm.ladder):
+        np.testing.assert_array_equal(saved, original)
+    # Memory-mapped columns are read-only views of the files
+    assert loaded.prices.flags.writeable != mmap
+    np.testing.assert_array_equal(loaded_articles.article_ids, articles.article_ids)
+    assert manifest["labels"]["seller_country"].tolist() == countries
+    assert manifest["meta"] == {"a": 1}
+    assert solve_milp(loaded).total_cost == pytest.approx(solve_milp(pm).total_cost)
+
+
+def test_newer_versions_and_damaged_columns_are_refused(tmp_path):
+    save_snapshot(tmp_path / "snap", playsets(1))
+    manifest_path = tmp_path / "snap" / "manifest.json"
+    manifest = json.loads(manifest_path.read_text())
+    manifest["arrays"]["prices"]["shape"] = [1]
+    manifest_path.write_text(json.dumps(manifest))
+    with pytest.raises(ValueError, match="doesn't match"):
+        load_snapshot(tmp_path / "snap")
+    manifest["version"] += 1
+    manifest_path.write_text(json.dumps(manifest))
+    with pytest.raises(ValueError, match="version"):
+        load_snapshot(tmp_path / "snap")
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """An app that doesn't log in, with two lists already fetched."""
+    app = BuywizardApp.__new__(BuywizardApp)
+    app.config = {"snapshot": {"path": str(tmp_path / "snapshot_{}")}, "search_filters": {}}
+    app.shipping, app.articles, app.fetched_at, app.seller_countries = None, None, None, {}
+    app.wantlists = {1: {"name": "Deck"}, 2: {"name": "Sideboard"}}
+    price_mats = {1: playsets(2), 2: playsets(2).select_rows(np.arange(0, 6))}
+    monkeypatch.setattr(app, "get_wantlists_data", lambda ids: ({i: price_mats[i] for i in ids}, {}))
+    monkeypatch.setattr("buywizard_app.format_dedupe_report", lambda report: "")
+    return app
+
+
+def test_batch_saves_a_snapshot_per_list(app, tmp_path):
+    app.config["batch_workers"] = 1
+    app.optimize_wantlists([1, 2])
+    for wantlist_id, name in ((1, "Deck"), (2, "Sideboard")):
+        _, _, manifest = load_snapshot(tmp_path / f"snapshot_{wantlist_id}")
+        assert manifest["meta"]["wantlist"] == name
+
+
+def test_combined_snapshot_is_the_same_basket(app, tmp_path, capsys):
+    app.optimize_combined_wantlists([1, 2])
+    total = capsys.readouterr().out.split("total: ")[-1].split()[0]
+    stacked, _, manifest = load_snapshot(tmp_path / "snapshot_combined")
+    assert manifest["meta"]["wantlist"] == "Combined: Deck, Sideboard"
+    assert set(manifest["labels"]["wantlist"].tolist()) == {"Deck", "Sideboard"}
+    assert solve_milp(stacked).total_cost == pytest.approx(float(total))
+    optimize_snapshot(tmp_path / "snapshot_combined", {})